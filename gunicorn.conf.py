@@ -1,6 +1,19 @@
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from governor import apply_layout, choose_layout  # noqa: E402
+
 bind = "unix:stereo-tuning.sock"
 umask = 7
-workers = 3
+# Workers and OpenCV threads per worker are chosen from the available cores (cgroup quota included), see governor
+layout = choose_layout()
+workers = layout["workers"]
+# The app is imported once in the master and the workers are forked from it: they start without importing dash,
+# OpenCV and NumPy again, and share the loaded modules copy-on-write
+preload_app = True
 # Access log - records incoming HTTP requests
 accesslog = "/home/rudy/log/gunicorn.access.log"
 # Error log - records Gunicorn server goings-on
@@ -9,3 +22,19 @@ errorlog = "/home/rudy/log/gunicorn.error.log"
 capture_output = True
 # How verbose the Gunicorn error logs should be 
 loglevel = "info"
+# The app modules log with logging.getLogger(__name__): their records go to stderr, captured in the error log, with
+# their level. Configured in the master, the workers inherit the handler.
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(process)d] [%(levelname)s] %(name)s: %(message)s")
+
+
+def when_ready(server):
+    # The app is already imported (preload_app), prepare what the workers will share before they are forked
+    import app
+    app.preload()
+
+
+def post_fork(server, worker):
+    # The OpenCV thread pool is per process, it is sized in each worker
+    apply_layout(layout)
+    server.log.info(f"Worker {worker.pid}: {layout['threads']} OpenCV threads ({layout['workers']} workers, "
+                    f"{layout['cores']} cores, {layout['source']})")
@@ -1,29 +1,69 @@
 import argparse
+import base64
+import functools
+import gc
 import pathlib
 import uuid
 import json
+import logging
 import dash
 import os
+import time
 
 import dash_core_components as dcc
 import dash_html_components as html
-from PIL import Image
+import flask
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
 import dash_reusable_components as drc
-from disparity_map import *
-from filtering import filtering
+from generation import Superseded, generations
+from governor import apply_layout, choose_layout, current_layout
+from disparity_stats import disparity_statistics
+from image_cache import decode_upload, decoded_images, load_decoded, load_pyramid_level
+from image_store import content_hash, image_store
+from jobs import JOB_POLL_MS, JOB_TIMEOUT, JOB_WORKERS, QueueFull, job_queue
+from matcher_pool import get_matcher_set, matcher_pool
+from parameter_space import SLIDERS, neighbor_values
+from pipeline import build_parameters, clamp_box, compute_disparity, compute_roi_disparity, effective_parameters, \
+    normalize_disparity, polygon_mask, roi_window
+from prefetch import prefetcher
+from preview import MAX_PREVIEW_LEVEL, get_preview_controller, scale_parameters
+from rendering import DISPARITY_ENCODER, LEFT_IMAGE_ENCODER, MIMETYPES, PREVIEW_ENCODER, RENDERED_NAMESPACE, \
+    RENDERED_ROUTE, is_rendered, render_image
+from result_cache import raw_disparities, result_cache, result_key
+from timing import label_request, resolution_bucket, stage, stage_metrics, start_timer, stop_timer
+from utils import default_image_string, show_disparity_histogram
 
 DEBUG = True
 LOCAL = False
 APP_PATH = str(pathlib.Path(__file__).parent.resolve())
+MAX_UPLOAD_MB = int(os.environ.get("STEREO_MAX_UPLOAD_MB", 64))
+
+# Handles of the images received by the upload route, per session, until the upload callback picks them up
+UPLOADS_NAMESPACE = "uploads"
+
+SLIDER_TITLES = ["Block size", "Number of disparities", "Min disparity", "P1 (only SGBM)", "P2 (only SGBM)",
+                 "Disp 12 Max Diff", "Uniqueness Ratio", "Pre Filter Cap", "Pre Filter Size (only BM)",
+                 "Speckle Windows Size", "Speckle Range", "Texture Threshold (only BM)", "Lambda (WLS Filter)",
+                 "Sigma (WLS Filter)"]
+SLIDER_PARAMETERS = {title: name for title, name, _, _, _, _ in SLIDERS}
 
 app = dash.Dash(__name__)
 app.title = 'Stereo Tuner'
 server = app.server
 
 
+def is_session_id(session_id):
+    """
+    :return: whether session_id has the format serve_layout generates, the only ids the store accepts from clients
+    """
+    try:
+        return str(uuid.UUID(session_id)) == session_id
+    except (TypeError, ValueError):
+        return False
+
+
 def serve_layout():
     # Generates a session ID
     session_id = str(uuid.uuid4())
@@ -34,7 +74,14 @@ def serve_layout():
         children=[
             # Session ID
             html.Div(session_id, id="session-id"),
+            # Clicked by assets/upload.js once the upload route has stored new images
+            html.Button(id="direct-upload-done", style=dict(display="none")),
             dcc.Store(id='local', storage_type='local'),
+            # Disparity job of the session: its id while it runs in the background, then its result
+            dcc.Store(id='job'),
+            # Region selected on the left image, see select_region
+            dcc.Store(id='selection'),
+            dcc.Interval(id='job-poll', interval=JOB_POLL_MS, disabled=True),
             # Main body
             html.Div(
                 id="app-container",
@@ -49,7 +96,12 @@ def serve_layout():
                             html.Div(
                                 id="div-interactive-image",
                                 children=[],
-                            )
+                            ),
+                            # Left image on which a box or lasso selects the region to compute, a double click
+                            # clears the selection
+                            dcc.Graph(id="selection-image", style=dict(display="none")),
+                            # Histogram, valid ratio and percentiles of the displayed disparities
+                            dcc.Graph(id="disparity-stats", style=dict(display="none")),
                         ],
                     ),
                 ],
@@ -156,21 +208,8 @@ def serve_layout():
                         ]
                     ),
                     drc.Card(
-                        [drc.CustomSlider("Block size", min=1, max=255, step=2, value=5),
-                         drc.CustomSlider("Number of disparities", min=16, max=2048, step=16, value=64),
-                         drc.CustomSlider("Min disparity", min=-1, max=255, step=1, value=0),
-                         drc.CustomSlider("P1 (only SGBM)", min=0, max=2048, step=1, value=0),
-                         drc.CustomSlider("P2 (only SGBM)", min=0, max=2048, step=1, value=0),
-                         drc.CustomSlider("Uniqueness Ratio", min=0, max=255, step=1, value=0),
-                         drc.CustomSlider("Pre Filter Cap", min=1, max=63, step=1, value=1),
-                         drc.CustomSlider("Pre Filter Size (only BM)", min=5, max=255, step=2, value=5),
-                         drc.CustomSlider("Disp 12 Max Diff", min=-1, max=255, step=1, value=-1),
-                         drc.CustomSlider("Speckle Windows Size", min=0, max=2048, step=1, value=0),
-                         drc.CustomSlider("Speckle Range", min=0, max=255, step=1, value=0),
-                         drc.CustomSlider("Texture Threshold (only BM)", min=0, max=255, step=1, value=0),
-                         drc.CustomSlider("Lambda (WLS Filter)", min=0, max=100000, step=1, value=8000),
-                         drc.CustomSlider("Sigma (WLS Filter)", min=0, max=10, step=0.01, value=1)
-                         ]
+                        [drc.CustomSlider(title, min=minimum, max=maximum, step=step, value=value)
+                         for title, _, minimum, maximum, step, value in SLIDERS]
                     )
                 ],
             ),
@@ -181,6 +220,125 @@ def serve_layout():
 app.layout = serve_layout
 
 
+@server.route(f"{RENDERED_ROUTE}/<key>.<fmt>")
+def serve_rendered_image(key, fmt):
+    """
+    Serves rendered images by content hash. Since the content of a URL never changes, browsers can cache
+    them forever and revalidate with the ETag.
+    """
+    if fmt not in MIMETYPES:
+        flask.abort(404)
+    if flask.request.if_none_match.contains(key):
+        response = flask.Response(status=304)
+    else:
+        data = image_store.get(RENDERED_NAMESPACE, key)
+        if data is None:
+            flask.abort(404)
+        response = flask.Response(data, mimetype=MIMETYPES[fmt])
+    response.set_etag(key)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@server.route("/upload", methods=["POST"])
+def upload_images():
+    """
+    Receives the left and/or right image as raw multipart files, without the base64 data URL of dcc.Upload, and
+    decodes them straight to grayscale along with their preview levels. The handles are kept for the session
+    until the upload callback, triggered by the direct-upload-done button, moves them to the local storage.
+    """
+    if flask.request.content_length and flask.request.content_length > MAX_UPLOAD_MB * 1024 * 1024:
+        flask.abort(413)
+    session_id = flask.request.form.get("session", "")
+    if not is_session_id(session_id):
+        return flask.jsonify(error="Invalid session id"), 400
+    pending_key = content_hash(session_id.encode("utf-8"))
+    pending = json.loads((image_store.get(UPLOADS_NAMESPACE, pending_key) or b"{}").decode("utf-8"))
+    handles = {}
+    for side in ("left", "right"):
+        upload = flask.request.files.get(side)
+        if upload is None:
+            continue
+        image_bytes = upload.read()
+        try:
+            # Decoded first, so that only images the matchers can read are stored
+            key = content_hash(image_bytes)
+            shape = decode_upload(key, image_bytes, MAX_PREVIEW_LEVEL)
+            image_store.put(session_id, image_bytes)
+        except (ValueError, OSError) as e:
+            # Undecodable image
+            return flask.jsonify(error=str(e)), 400
+        handles[side] = dict(filename=upload.filename, session=session_id, hash=key)
+        server.logger.info("Uploaded %s image %s: %dx%d, %d bytes", side, upload.filename, shape[1], shape[0],
+                           len(image_bytes))
+    if not handles:
+        return flask.jsonify(error="No left or right file"), 400
+    pending.update(handles)
+    image_store.write(UPLOADS_NAMESPACE, pending_key, json.dumps(pending).encode("utf-8"))
+    return flask.jsonify(handles)
+
+
+@server.before_request
+def start_request_timer():
+    # Only the Dash callbacks are timed, static files and rendered images are not
+    if flask.request.path.endswith("_dash-update-component"):
+        start_timer()
+        # Speculative computations give way to the callbacks
+        prefetcher.begin_request()
+        flask.g.prefetch_paused = True
+
+
+@server.after_request
+def add_server_timing(response):
+    timer = stop_timer()
+    if timer is not None and timer.durations:
+        response_bytes = response.calculate_content_length()
+        response.headers["Server-Timing"] = timer.server_timing(response_bytes)
+        stage_metrics.record(timer, response_bytes)
+    return response
+
+
+@server.teardown_request
+def clear_request_timer(_):
+    # after_request is skipped when a request fails, the timer must not leak to the next request of the thread
+    stop_timer()
+    if flask.g.pop("prefetch_paused", False):
+        prefetcher.end_request()
+
+
+@server.route("/metrics")
+def metrics():
+    """
+    p50/p95/p99 of the stage timings (ms) and response sizes (bytes) of the callbacks, per stage, algorithm and
+    resolution bucket. ?scope=process reports this worker only.
+    """
+    return flask.jsonify(stage_metrics.snapshot(shared=flask.request.args.get("scope") != "process"))
+
+
+@server.route("/stats/cache")
+def cache_stats():
+    return flask.jsonify(decoded_images=decoded_images.stats(), results=result_cache.stats(),
+                         matcher_pool=matcher_pool.stats(), raw_disparities=raw_disparities.stats(),
+                         image_store=image_store.stats())
+
+
+@server.route("/stats/layout")
+def layout_stats():
+    """
+    Cores, gunicorn workers and OpenCV threads chosen by the governor, as applied to the answering worker
+    """
+    return flask.jsonify(current_layout())
+
+
+@server.route("/stats/requests")
+def request_stats():
+    return flask.jsonify(generations=generations.stats(), jobs=job_queue.stats(), prefetch=prefetcher.stats())
+
+
+def _has_image(data, side):
+    return bool(data and data.get(side) and data[side].get('hash'))
+
+
 @app.callback([Output("slider-Block size", "min"),
                Output("slider-Block size", "marks")],
               [Input("radio-algo", "value")])
@@ -227,59 +385,20 @@ def save_parameters(n_clicks, algo, wls_filtering, use_xsobel, use_dp, block_siz
                     pre_filter_size,
                     speckle_windows_size,
                     speckle_range, texture_threshold, lmbda, sigma, data):
-    if n_clicks:
+    if n_clicks and _has_image(data, 'left'):
         left_name = data['left']['filename']
 
-        try:
-            wls_filtering = wls_filtering[0]
-        except TypeError:
-            wls_filtering = False
-        except IndexError:
-            wls_filtering = False
-
         if not os.path.exists('./bm_parameters'):
             os.makedirs('./bm_parameters')
 
-        if algo == "bm":
-            param_json = dict(min_disp=min_disparities,
-                              num_disp=n_disparities,
-                              block_size=block_size,
-                              prefilter_cap=pre_filter_cap,
-                              prefilter_size=pre_filter_size,
-                              disp12maxdiff=disp_12_max_diff,
-                              uniqueness_ratio=uniqueness_ratio,
-                              speckle_windows_size=speckle_windows_size,
-                              speckle_range=speckle_range,
-                              texture_threshold=texture_threshold,
-                              use_xsobel=use_xsobel,
-                              wls_filtering=wls_filtering,
-                              lmbda=lmbda,
-                              sigma=sigma)
-            output_fn = f'./bm_parameters/parameters_{left_name.split("_")[0]}_stereo-bm.json'
-            with open(output_fn, 'w') as outfile:
-                json.dump(param_json, outfile)
-                print(f"Saved {output_fn}")
-
-        else:
-            param_json = dict(min_disp=min_disparities,
-                              num_disp=n_disparities,
-                              block_size=block_size,
-                              p1=p1,
-                              p2=p2,
-                              prefilter_cap=pre_filter_cap,
-                              disp12maxdiff=disp_12_max_diff,
-                              uniqueness_ratio=uniqueness_ratio,
-                              speckle_windows_size=speckle_windows_size,
-                              speckle_range=speckle_range,
-                              use_dynamic_programming=use_dp,
-                              wls_filtering=wls_filtering,
-                              lmbda=lmbda,
-                              sigma=sigma)
-
-            output_fn = f'./bm_parameters/parameters_{left_name.split("_")[0]}_stereo-sgbm.json'
-            with open(output_fn, 'w') as outfile:
-                json.dump(param_json, outfile)
-                print(f"Saved {output_fn}")
+        param_json = build_parameters(algo, wls_filtering, use_xsobel, use_dp, block_size, n_disparities,
+                                      min_disparities, p1, p2, disp_12_max_diff, uniqueness_ratio, pre_filter_cap,
+                                      pre_filter_size, speckle_windows_size, speckle_range, texture_threshold,
+                                      lmbda, sigma)
+        output_fn = f'./bm_parameters/parameters_{left_name.split("_")[0]}_stereo-{algo}.json'
+        with open(output_fn, 'w') as outfile:
+            json.dump(param_json, outfile)
+            print(f"Saved {output_fn}")
 
     else:
         raise PreventUpdate
@@ -287,51 +406,17 @@ def save_parameters(n_clicks, algo, wls_filtering, use_xsobel, use_dp, block_siz
 
 
 @app.callback(
-    [
-        Output("val-Block size", "children"),
-        Output("val-Number of disparities", "children"),
-        Output("val-Min disparity", "children"),
-        Output("val-P1 (only SGBM)", "children"),
-        Output("val-P2 (only SGBM)", "children"),
-        Output("val-Disp 12 Max Diff", "children"),
-        Output("val-Uniqueness Ratio", "children"),
-        Output("val-Pre Filter Cap", "children"),
-        Output("val-Pre Filter Size (only BM)", "children"),
-        Output("val-Speckle Windows Size", "children"),
-        Output("val-Speckle Range", "children"),
-        Output("val-Texture Threshold (only BM)", "children"),
-        Output("val-Lambda (WLS Filter)", "children"),
-        Output("val-Sigma (WLS Filter)", "children")
-    ]
-    ,
-    [
-        Input("slider-Block size", "value"),
-        Input("slider-Number of disparities", "value"),
-        Input("slider-Min disparity", "value"),
-        Input("slider-P1 (only SGBM)", "value"),
-        Input("slider-P2 (only SGBM)", "value"),
-        Input("slider-Disp 12 Max Diff", "value"),
-        Input("slider-Uniqueness Ratio", "value"),
-        Input("slider-Pre Filter Cap", "value"),
-        Input("slider-Pre Filter Size (only BM)", "value"),
-        Input("slider-Speckle Windows Size", "value"),
-        Input("slider-Speckle Range", "value"),
-        Input("slider-Texture Threshold (only BM)", "value"),
-        Input("slider-Lambda (WLS Filter)", "value"),
-        Input("slider-Sigma (WLS Filter)", "value")
-    ]
+    [Output(f"val-{title}", "children") for title in SLIDER_TITLES],
+    [Input(f"slider-{title}", "drag_value") for title in SLIDER_TITLES],
+    [State(f"slider-{title}", "value") for title in SLIDER_TITLES]
 )
-def update_param_display(block_size,
-                         n_disparities,
-                         min_disparities,
-                         p1,
-                         p2,
-                         disp_12_max_diff,
-                         uniqueness_ratio,
-                         pre_filter_cap,
-                         pre_filter_size,
-                         speckle_windows_size,
-                         speckle_range, texture_threshold, lmbda, sigma):
+def update_param_display(*values):
+    # Labels follow the handle while dragging, the value itself is only updated on release
+    drag_values, slider_values = values[:len(SLIDER_TITLES)], values[len(SLIDER_TITLES):]
+    block_size, n_disparities, min_disparities, p1, p2, disp_12_max_diff, uniqueness_ratio, pre_filter_cap, \
+        pre_filter_size, speckle_windows_size, speckle_range, texture_threshold, lmbda, sigma = \
+        [value if drag_value is None else drag_value for drag_value, value in zip(drag_values, slider_values)]
+
     return f"Block size: {block_size}", \
            f"Number of disparities: {n_disparities}", \
            f"Min number of disparities: {min_disparities}", f"P1 (only SGBM): {p1}", f"P2 (only SGBM): {p2}", \
@@ -343,157 +428,476 @@ def update_param_display(block_size,
 
 
 @app.callback(
-    [
-        Output("div-interactive-image", "children"),
-        Output("local", "data")
-    ]
-    ,
+    Output("local", "data"),
     [
         Input("upload-image-left", "contents"),
         Input("upload-image-right", "contents"),
-        Input("radio-algo", "value"),
-        Input("wls_filtering", "value"),
-        Input("radio-xsobel", "value"),
-        Input("radio-sgbm_mode", "value"),
-        Input("slider-Block size", "value"),
-        Input("slider-Number of disparities", "value"),
-        Input("slider-Min disparity", "value"),
-        Input("slider-P1 (only SGBM)", "value"),
-        Input("slider-P2 (only SGBM)", "value"),
-        Input("slider-Disp 12 Max Diff", "value"),
-        Input("slider-Uniqueness Ratio", "value"),
-        Input("slider-Pre Filter Cap", "value"),
-        Input("slider-Pre Filter Size (only BM)", "value"),
-        Input("slider-Speckle Windows Size", "value"),
-        Input("slider-Speckle Range", "value"),
-        Input("slider-Texture Threshold (only BM)", "value"),
-        Input("slider-Lambda (WLS Filter)", "value"),
-        Input("slider-Sigma (WLS Filter)", "value")
+        Input("direct-upload-done", "n_clicks")
     ],
     [
         State("upload-image-left", "filename"),
         State("upload-image-right", "filename"),
+        State("session-id", "children"),
         State("local", "data")
     ],
 )
-def update_graph_interactive_image(
-        left_content,
-        right_content,
-        # sliders
-        algo,
-        wls_filtering,
-        use_xsobel,
-        use_dynamic_programming,
-        block_size,
-        n_disparities,
-        min_disparities,
-        p1,
-        p2,
-        disp_12_max_diff,
-        uniqueness_ratio,
-        pre_filter_cap,
-        pre_filter_size,
-        speckle_windows_size,
-        speckle_range,
-        texture_threshold,
-        lmbda,
-        sigma,
-        # states
-        new_left_name,
-        new_right_name,
-        data
-):
-    data = data or {'left': {'filename': None, 'image': None}, 'right': {'filename': None, 'image': None}}
-
-    left_name = data['left']['filename']
-    right_name = data['right']['filename']
-
-    # If a new file was uploaded (new file name changed) update the local storage
-    if new_left_name and new_left_name != left_name:
-        data['left']['filename'] = new_left_name
-        data['left']['image'] = left_content.split(";base64,")[-1]
-    if new_right_name and new_right_name != right_name:
-        data['right']['filename'] = new_right_name
-        data['right']['image'] = right_content.split(";base64,")[-1]
-
-    if data['left']['image'] is not None and data['right']['image'] is not None:
-        # convert to images
-        left = drc.b64_to_numpy(data['left']['image'], to_scalar=False)
-        right = drc.b64_to_numpy(data['right']['image'], to_scalar=False)
-
-        stereo = None
-        disparity_map = None
-        if algo == "bm":
-            if wls_filtering:
-                stereo = get_stereo_bm_object(min_disp=min_disparities,
-                                              num_disp=n_disparities,
-                                              block_size=block_size,
-                                              prefilter_cap=pre_filter_cap,
-                                              prefilter_size=pre_filter_size,
-                                              disp12maxdiff=disp_12_max_diff,
-                                              uniqueness_ratio=uniqueness_ratio,
-                                              speckle_windows_size=speckle_windows_size,
-                                              speckle_range=speckle_range,
-                                              texture_threshold=texture_threshold,
-                                              use_xsobel=use_xsobel)
-            else:
-                disparity_map = generate_stereo_bm_disparity_map(left, right,
-                                                                 min_disp=min_disparities,
-                                                                 num_disp=n_disparities,
-                                                                 block_size=block_size,
-                                                                 prefilter_cap=pre_filter_cap,
-                                                                 prefilter_size=pre_filter_size,
-                                                                 disp12maxdiff=disp_12_max_diff,
-                                                                 uniqueness_ratio=uniqueness_ratio,
-                                                                 speckle_windows_size=speckle_windows_size,
-                                                                 speckle_range=speckle_range,
-                                                                 texture_threshold=texture_threshold,
-                                                                 use_xsobel=use_xsobel)
+def store_uploaded_images(left_content, right_content, _, new_left_name, new_right_name, session_id, data):
+    """
+    Decodes new uploads once and keeps them server-side. The local storage only receives a small handle
+    (file name, session and content hash), so slider callbacks never carry the images back and forth.
+
+    Browsers running assets/upload.js send the files to the upload route instead, which stores them before this
+    callback runs: only their handles are picked up here.
+    """
+    if not is_session_id(session_id):
+        raise PreventUpdate
+    data = data or {}
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    handles = {}
+    if "direct-upload-done.n_clicks" in triggered:
+        pending_key = content_hash(session_id.encode("utf-8"))
+        pending = image_store.get(UPLOADS_NAMESPACE, pending_key)
+        handles = json.loads(pending.decode("utf-8")) if pending is not None else {}
+        # The handles move to the local storage, the next uploads start a new record
+        image_store.delete(UPLOADS_NAMESPACE, pending_key)
+    for side, content, name in (('left', left_content, new_left_name), ('right', right_content, new_right_name)):
+        if content is None or name is None or f"upload-image-{side}.contents" not in triggered:
+            continue
+        with stage("decode"):
+            image_bytes = base64.b64decode(content.split(";base64,")[-1])
+        key = content_hash(image_bytes)
+        try:
+            decode_upload(key, image_bytes, MAX_PREVIEW_LEVEL)
+        except (ValueError, OSError) as e:
+            server.logger.warning("Ignored %s image %s: %s", side, name, e)
+            continue
+        image_store.put(session_id, image_bytes)
+        handles[side] = dict(filename=name, session=session_id, hash=key)
+
+    updated = False
+    for side, handle in handles.items():
+        if data.get(side) != handle:
+            data[side] = handle
+            updated = True
+
+    if not updated:
+        raise PreventUpdate
+    return data
+
+
+def _result_key(data, algo, params, level=0, selection=None):
+    """
+    :return: result cache key of a disparity map, the parameters being the ones of the level
+    """
+    key_parts = (data['left']['hash'], data['right']['hash'], algo, effective_parameters(params))
+    if selection:
+        return result_key(*key_parts, level, selection)
+    return result_key(*key_parts, level) if level else result_key(*key_parts)
+
+
+def _matched_shape(shape, algo, params, selection):
+    """
+    :return: full resolution shape of the images the matchers process: the whole image, or the window of the
+        selection
+    """
+    if not selection:
+        return shape
+    _, _, w, h = roi_window(shape, clamp_box(selection['box'], shape), algo, params)
+    return h, w
+
+
+@app.callback(
+    [
+        Output("selection-image", "figure"),
+        Output("selection-image", "style")
+    ],
+    [Input("local", "data")],
+)
+def show_selection_image(data):
+    """
+    Shows the left image in the selection graph once both images are uploaded
+    """
+    if not (_has_image(data, 'left') and _has_image(data, 'right')):
+        raise PreventUpdate
+    left_result = _left_image(data, None)
+    return drc.interactive_image_figure(left_result['url'], left_result['size']), dict(display="block")
+
+
+@app.callback(
+    Output("selection", "data"),
+    [Input("selection-image", "selectedData")],
+    [State("local", "data")],
+)
+def select_region(selected_data, data):
+    """
+    Converts a box or lasso selection of the selection graph to the region of the disparity computation: the
+    left image hash, the box (x, y, w, h) in image coordinates (y going down) and the lasso polygon, if any
+    :return: None when the selection was cleared
+    """
+    if not _has_image(data, 'left'):
+        raise PreventUpdate
+    if not selected_data or not (selected_data.get('range') or selected_data.get('lassoPoints')):
+        return None
+    width, height = _left_image(data, None)['size']
+    points = None
+    if selected_data.get('lassoPoints'):
+        lasso = selected_data['lassoPoints']
+        points = [(x, height - y) for x, y in zip(lasso['x'], lasso['y'])]
+        xs, ys = [x for x, _ in points], [y for _, y in points]
+        x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+    else:
+        x0, x1 = sorted(selected_data['range']['x'])
+        y0, y1 = sorted(height - y for y in selected_data['range']['y'])
+    x0, y0 = int(x0), int(y0)
+    box = clamp_box((x0, y0, int(x1) + 1 - x0, int(y1) + 1 - y0), (height, width))
+    return dict(left=data['left']['hash'], box=box, points=points)
+
+
+def _render_disparity(data, session_id, generation, algo, params, level, check=None, matcher_key=None,
+                      selection=None):
+    """
+    Computes (or fetches from the result cache) the disparity map at the given pyramid level. Raises Superseded
+    as soon as a newer request of the session has started.
+    :param generation: generation of the request, None for speculative computations (their check function
+        cancels them)
+    :param check: optional function called with the generation checks, e.g. the timeout check of a job
+    :param matcher_key: matcher set to use, by default the one of the session at this level
+    :param selection: region selected on the left image (see select_region), only its disparities are computed
+    :return: result dictionary with the encoded image, its size, the ROI in full resolution coordinates and the
+        statistics of the disparities
+    """
+    left_hash, right_hash = data['left']['hash'], data['right']['hash']
+    level_params = scale_parameters(algo, params, level)
+    key = _result_key(data, algo, level_params, level, selection)
+
+    with stage("cache"):
+        result = result_cache.get(key)
+        if result is not None and not is_rendered(result['url']):
+            result = None
+    if result is None:
+        # decoded grayscale images are cached, so unchanged pairs go straight to the matchers
+        left = load_pyramid_level(data['left']['session'], left_hash, level)
+        right = load_pyramid_level(data['right']['session'], right_hash, level)
+        if left is None or right is None:
+            raise PreventUpdate
+
+        generation_check = generations.checker(session_id, generation) if generation is not None else None
+
+        def check_all():
+            if generation_check is not None:
+                generation_check()
+            if check is not None:
+                check()
+
+        if generation is not None:
+            generations.checkpoint(session_id, generation, "before_compute")
+        check_all()
+        t_start = time.time()
+        matchers = get_matcher_set(matcher_key or f"{session_id}:{level}")
+        mask = None
+        if selection:
+            scale = 0.5 ** level
+            disparity_map, roi, window = compute_roi_disparity(
+                left, right, algo, level_params, [v * scale for v in selection['box']], matchers=matchers,
+                check=check_all, pair_key=(left_hash, right_hash, level))
+            matched_shape = (window[3], window[2])
+            if selection.get('points'):
+                mask = polygon_mask(selection['points'], roi, scale)
+            roi = tuple(v * 2 ** level for v in roi)
         else:
-            if wls_filtering:
-                stereo = get_stereo_sgbm_object(min_disp=min_disparities,
-                                                num_disp=n_disparities,
-                                                block_size=block_size,
-                                                p1=p1,
-                                                p2=p2,
-                                                prefilter_cap=pre_filter_cap,
-                                                disp12maxdiff=disp_12_max_diff,
-                                                uniqueness_ratio=uniqueness_ratio,
-                                                speckle_windows_size=speckle_windows_size,
-                                                speckle_range=speckle_range,
-                                                use_dynamic_programming=use_dynamic_programming)
-            else:
-                disparity_map = generate_stereo_sgbm_disparity_map(left, right,
-                                                                   min_disp=min_disparities,
-                                                                   num_disp=n_disparities,
-                                                                   block_size=block_size,
-                                                                   p1=p1,
-                                                                   p2=p2,
-                                                                   prefilter_cap=pre_filter_cap,
-                                                                   disp12maxdiff=disp_12_max_diff,
-                                                                   uniqueness_ratio=uniqueness_ratio,
-                                                                   speckle_windows_size=speckle_windows_size,
-                                                                   speckle_range=speckle_range,
-                                                                   use_dynamic_programming=use_dynamic_programming)
-        if wls_filtering:
-            disparity_map, (x, y, w, h) = filtering(stereo, left, right, lmbda=lmbda, sigma=sigma)
+            disparity_map, roi = compute_disparity(left, right, algo, level_params, matchers=matchers,
+                                                   check=check_all, pair_key=(left_hash, right_hash, level))
+            matched_shape = left.shape
+        get_preview_controller(session_id).record(algo, matched_shape, level_params['num_disp'],
+                                                  time.time() - t_start)
+        if roi is not None and not selection:
+            x, y, w, h = roi
             disparity_map = disparity_map[y:y + h, x:x + w]
-            left = left[y:y + h, x:x + w]
+            roi = tuple(v * 2 ** level for v in roi)
+
+        if generation is not None:
+            generations.checkpoint(session_id, generation, "before_encode")
+        if check is not None:
+            check()
+        # Computed on the matcher output, the rendered image only has 256 levels scaled to its own range
+        stats = disparity_statistics(disparity_map, level_params['min_disp'], level_params['num_disp'], mask,
+                                     2 ** level)
+        disparity_map = normalize_disparity(disparity_map)
+        if mask is not None:
+            disparity_map[mask == 0] = 0
+        url = render_image(disparity_map, PREVIEW_ENCODER if level else DISPARITY_ENCODER)
+        result = dict(url=url, size=(disparity_map.shape[1], disparity_map.shape[0]), roi=roi, stats=stats)
+        result_cache.put(key, result)
+    return result
+
+
+def _disparity_job(data, session_id, generation, algo, params, selection=None):
+    """
+    :return: job function computing the full resolution disparity map in a background thread. Its stage timings
+        are recorded in the metrics like the ones of the callbacks.
+    """
+    def run(check):
+        timer = start_timer()
+        label_request(algo=algo)
+        prefetcher.begin_request()
+        try:
+            result = _render_disparity(data, session_id, generation, algo, params, 0, check=check,
+                                       selection=selection)
+            label_request(resolution=resolution_bucket(result['size']))
+        finally:
+            prefetcher.end_request()
+            stop_timer()
+        if timer.durations:
+            stage_metrics.record(timer)
+        generations.done()
+        return result
+    return run
+
+
+def _prefetch_task(data, session_id, algo, params, selection, check):
+    """
+    Speculative computation of a full resolution result, skipped unless the preview controller predicts it to
+    be fast enough. The prediction is made when the task runs, so it includes the request it was derived from.
+    :return: False when skipped
+    """
+    left_image = decoded_images.get(data['left']['hash'])
+    if left_image is None:
+        return False
+    shape = _matched_shape(left_image.gray.shape, algo, params, selection)
+    estimate = get_preview_controller(session_id).estimate(algo, shape, params['num_disp'])
+    if estimate is None or estimate > prefetcher.max_seconds:
+        return False
+    # A matcher set of its own, so a real request of the session never waits for the lock of a speculative one
+    _render_disparity(data, session_id, None, algo, params, 0, check=check, matcher_key=f"{session_id}:prefetch",
+                      selection=selection)
+    return True
+
+
+def _schedule_prefetch(data, session_id, generation, algo, controls, slider_values, triggered, selection):
+    """
+    When a slider was released, schedules the results of its neighboring values (slider step, within its
+    min/max) for speculative computation into the result cache
+    :param controls: values of the WLS, xsobel and SGBM mode controls
+    """
+    titles = [title for title in SLIDER_TITLES if f"slider-{title}.value" in triggered]
+    if len(titles) != 1 or prefetcher.steps <= 0:
+        return
+    index = SLIDER_TITLES.index(titles[0])
+    if slider_values[index] is None:
+        return
+    # Neighbors that do not change the output (e.g. P1 with StereoBM) are skipped
+    seen = {json.dumps(effective_parameters(build_parameters(algo, *controls, *slider_values)), sort_keys=True)}
+    tasks = []
+    for value in neighbor_values(SLIDER_PARAMETERS[titles[0]], slider_values[index], prefetcher.steps):
+        values = list(slider_values)
+        values[index] = value
+        params = build_parameters(algo, *controls, *values)
+        effective = json.dumps(effective_parameters(params), sort_keys=True)
+        if effective not in seen:
+            seen.add(effective)
+            tasks.append(functools.partial(_prefetch_task, data, session_id, algo, params, selection))
+    prefetcher.schedule(session_id, generation, tasks)
+
+
+def _submit_job(job):
+    """
+    Submits the computation described by the job store, dropping it silently when the queue is full: the poll
+    callback submits it again
+    """
+    request = job['request']
+    try:
+        job_queue.submit(job['id'], job['session'],
+                         _disparity_job(job['data'], job['session'], request['generation'], request['algo'],
+                                        request['params'], request.get('selection')))
+    except QueueFull as e:
+        server.logger.warning("Job queue full, job %s retried on the next poll: %s", job['id'], e)
 
-        disparity_map = cv2.normalize(disparity_map, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX,
-                                      dtype=cv2.CV_8U)
-        result = Image.fromarray(disparity_map)
-        left_pil = Image.fromarray(left)
-    else:
+
+@app.callback(
+    Output("job", "data"),
+    [
+        Input("local", "data"),
+        Input("radio-algo", "value"),
+        Input("wls_filtering", "value"),
+        Input("radio-xsobel", "value"),
+        Input("radio-sgbm_mode", "value")
+    ]
+    + [Input(f"slider-{title}", "value") for title in SLIDER_TITLES]
+    + [Input(f"slider-{title}", "drag_value") for title in SLIDER_TITLES]
+    + [Input("selection", "data")],
+    [
+        State("session-id", "children")
+    ],
+)
+def update_graph_interactive_image(data, algo, wls_filtering, use_xsobel, use_dynamic_programming, *values):
+    """
+    While a slider is being dragged only its drag_value changes: a preview is computed on a pyramid level
+    chosen to keep up with the mouse. Releasing the slider updates its value and triggers the full
+    resolution computation.
+
+    With a region selected on the left image, only the disparities of the region are computed.
+
+    Previews and cached results are returned right away. Other full resolution results are computed by the
+    job queue, the job store then only receives the job id and show_disparity polls it.
+    """
+    slider_values = list(values[:len(SLIDER_TITLES)])
+    drag_values = values[len(SLIDER_TITLES):2 * len(SLIDER_TITLES)]
+    selection, session_id = values[-2:]
+
+    if not (_has_image(data, 'left') and _has_image(data, 'right')):
         raise PreventUpdate
+    if selection and selection['left'] != data['left']['hash']:
+        # Selected on a previous left image
+        selection = None
+    generation = generations.begin(session_id)
+    label_request(algo=algo)
+
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    preview = bool(triggered) and all(prop_id.endswith(".drag_value") for prop_id in triggered)
+    if preview:
+        for i, title in enumerate(SLIDER_TITLES):
+            if f"slider-{title}.drag_value" in triggered and drag_values[i] is not None:
+                slider_values[i] = drag_values[i]
+
+    block_size, n_disparities, min_disparities, p1, p2, disp_12_max_diff, uniqueness_ratio, pre_filter_cap, \
+        pre_filter_size, speckle_windows_size, speckle_range, texture_threshold, lmbda, sigma = slider_values
+    params = build_parameters(algo, wls_filtering, use_xsobel, use_dynamic_programming, block_size, n_disparities,
+                              min_disparities, p1, p2, disp_12_max_diff, uniqueness_ratio, pre_filter_cap,
+                              pre_filter_size, speckle_windows_size, speckle_range, texture_threshold, lmbda, sigma)
+
+    level = 0
+    if not preview:
+        _schedule_prefetch(data, session_id, generation, algo, (wls_filtering, use_xsobel, use_dynamic_programming),
+                           slider_values, triggered, selection)
+    if preview:
+        left_image = load_decoded(data['left']['session'], data['left']['hash'])
+        if left_image is None:
+            raise PreventUpdate
+        level = get_preview_controller(session_id).choose_level(
+            algo, _matched_shape(left_image.gray.shape, algo, params, selection), params['num_disp'])
+    elif JOB_WORKERS > 0:
+        with stage("cache"):
+            result = result_cache.get(_result_key(data, algo, params, selection=selection))
+            if result is not None and not is_rendered(result['url']):
+                result = None
+        if result is None:
+            # Without Redis every gunicorn worker numbers the generations on its own: the random part keeps the
+            # ids of jobs submitted to different workers apart
+            job = dict(id=result_key("job", session_id, generation, uuid.uuid4().hex), session=session_id, data=data,
+                       submitted=time.time(),
+                       request=dict(generation=generation, algo=algo, params=params, selection=selection))
+            _submit_job(job)
+            return job
+        label_request(resolution=resolution_bucket(result['size']))
+        generations.done()
+        return dict(data=data, result=result, algo=algo)
+
+    try:
+        result = _render_disparity(data, session_id, generation, algo, params, level, selection=selection)
+    except Superseded:
+        # A newer request of this session is already running, its result will replace this one
+        raise PreventUpdate
+    label_request(resolution=resolution_bucket(result['size']))
+    generations.done()
+    return dict(data=data, result=result, algo=algo)
+
+
+def _left_image(data, roi):
+    """
+    :param roi: (x, y, w, h) crop in full resolution coordinates, or None
+    :return: rendered left image dictionary (url and size), cached
+    """
+    left_hash = data['left']['hash']
+    left_key = result_key("left", left_hash, roi)
+    left_result = result_cache.get(left_key)
+    if left_result is None or not is_rendered(left_result['url']):
+        left_image = load_decoded(data['left']['session'], left_hash, with_color=True)
+        if left_image is None:
+            raise PreventUpdate
+        left_color = left_image.color
+        if roi is not None:
+            x, y, w, h = roi
+            left_color = left_color[y:y + h, x:x + w]
+        left_result = dict(url=render_image(left_color, LEFT_IMAGE_ENCODER),
+                           size=(left_color.shape[1], left_color.shape[0]))
+        result_cache.put(left_key, left_result)
+    return left_result
+
+
+def _job_message(text):
+    return html.Div(text, id="job-message")
 
-    return [
-               drc.DisplayImagePIL(id="left-image", image=left_pil, position="right"),
-               drc.DisplayImagePIL(id="depth-map", image=result, position="left")
-           ], data
+
+@app.callback(
+    [
+        Output("div-interactive-image", "children"),
+        Output("disparity-stats", "figure"),
+        Output("disparity-stats", "style"),
+        Output("job-poll", "disabled")
+    ],
+    [
+        Input("job", "data"),
+        Input("job-poll", "n_intervals")
+    ],
+)
+def show_disparity(job, _):
+    """
+    Displays the result of the job store, polling the job queue (through the job-poll interval) until the
+    background computation is finished, with the statistics of the disparities under the images
+    """
+    if not job:
+        raise PreventUpdate
+    result = job.get('result')
+    if result is None:
+        status = job_queue.status(job['id'])
+        state = status['state'] if status else None
+        if state in ("done", "superseded", "failed", "timeout"):
+            # Final state: the job-poll interval stops, nobody reads the marker again
+            job_queue.forget(job['id'])
+        if state == "done":
+            result = status['result']
+        elif state == "superseded":
+            # A newer job of the session replaces this one in the job store
+            return dash.no_update, dash.no_update, dash.no_update, True
+        elif state in ("failed", "timeout"):
+            return _job_message(f"Computation {state}: {status.get('error')}"), dash.no_update, dash.no_update, True
+        elif time.time() - job['submitted'] > JOB_TIMEOUT:
+            # The worker running the job may have been restarted
+            return _job_message("Computation timeout: no result in time"), dash.no_update, dash.no_update, True
+        else:
+            if state is None:
+                # Rejected by a full queue, or lost with the worker that had it
+                _submit_job(job)
+            return dash.no_update, dash.no_update, dash.no_update, False
+
+    label_request(algo=job.get('algo', job.get('request', {}).get('algo')),
+                  resolution=resolution_bucket(result['size']))
+    left_result = _left_image(job['data'], result['roi'])
+    images = [
+        drc.DisplayImage(id="left-image", src=left_result['url'], size=left_result['size'], position="right"),
+        drc.DisplayImage(id="depth-map", src=result['url'], size=result['size'], position="left")
+    ]
+    # Results cached before the statistics existed have none
+    stats = result.get('stats')
+    if not stats:
+        return images, dash.no_update, dict(display="none"), True
+    return images, show_disparity_histogram(stats), dict(display="block"), True
 
 
 # Running the server
+def preload():
+    """
+    Called in the gunicorn master (preload_app) once the app is imported, before the workers are forked. Encodes
+    the default image and serves the page once, so the default assets and the first request setup of Dash and
+    Flask are built a single time and shared by the workers, then freezes the objects tracked by the garbage collector: collections in the workers no longer write to
+    the memory pages inherited from the master, which stay shared copy-on-write. Nothing done here depends on
+    the process (no OpenCV call, cache entry or Redis connection).
+    """
+    default_image_string()
+    server.test_client().get("/")
+    gc.freeze()
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Model eval')
@@ -501,6 +905,8 @@ if __name__ == "__main__":
     parser.add_argument('-m', '--mode', default="local", type=str,
                         help='Mode [local or production].')
     args = parser.parse_args()
+    apply_layout(choose_layout())
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(name)s: %(message)s")
 
     if args.mode == 'local':
         app.run_server(debug=False)
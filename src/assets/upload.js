@@ -0,0 +1,57 @@
+// Sends the images picked or dropped in the dcc.Upload areas to the /upload route as multipart files, instead of
+// the base64 data URLs that dcc.Upload puts in the JSON of the callback. The upload callback is then triggered by
+// clicking the hidden direct-upload-done button. Browsers without fetch/FormData keep the dcc.Upload path.
+(function () {
+    var SIDES = {"upload-image-left": "left", "upload-image-right": "right"};
+
+    function uploadSide(element) {
+        while (element && element !== document) {
+            if (element.id && SIDES[element.id]) {
+                return SIDES[element.id];
+            }
+            element = element.parentNode;
+        }
+        return null;
+    }
+
+    function send(side, file) {
+        var session = document.getElementById("session-id");
+        var form = new FormData();
+        form.append("session", session ? session.textContent : "");
+        form.append(side, file, file.name);
+        return fetch("upload", {method: "POST", body: form, credentials: "same-origin"}).then(function (response) {
+            if (!response.ok) {
+                throw new Error("Upload of the " + side + " image failed (" + response.status + ")");
+            }
+            document.getElementById("direct-upload-done").click();
+        });
+    }
+
+    function intercept(event, files) {
+        var side = uploadSide(event.target);
+        if (!side || !files || !files.length || !window.FormData || !window.fetch) {
+            return;
+        }
+        // Capture phase: dcc.Upload never sees the event, so it does not read the file as a data URL
+        event.preventDefault();
+        event.stopPropagation();
+        var file = files[0];
+        if (event.type === "change") {
+            // Picking the same file again must fire a new change event
+            event.target.value = "";
+        }
+        send(side, file).catch(function (error) {
+            console.error(error);
+            alert(error.message);
+        });
+    }
+
+    window.addEventListener("change", function (event) {
+        if (event.target.type === "file") {
+            intercept(event, event.target.files);
+        }
+    }, true);
+    window.addEventListener("drop", function (event) {
+        intercept(event, event.dataTransfer && event.dataTransfer.files);
+    }, true);
+})();
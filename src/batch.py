@@ -0,0 +1,216 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import cv2
+import numpy as np
+
+from disparity_map import read_grayscale, rectify_pair
+from matcher_pool import MatcherSet
+from pipeline import compute_disparity
+from rectification import RECTIFY_ALPHA, Rectifier, load_calibration
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".ppm", ".pgm")
+
+# Per worker process state, set by _init_worker
+_worker = {}
+
+
+def find_pairs(left_dir, right_dir=None, left_token="left", right_token="right"):
+    """
+    Pairs left and right images by name: the right image of ``<name>`` is the file whose name is ``<name>`` with
+    the last occurrence of left_token replaced by right_token, e.g. ``scene1_left.png`` and ``scene1_right.png``.
+    :param left_dir: directory with the left images
+    :param right_dir: directory with the right images, defaults to left_dir
+    :return: sorted list of (left path, right path)
+    """
+    right_dir = right_dir or left_dir
+    right_files = set(os.listdir(right_dir))
+    pairs = []
+    for name in sorted(os.listdir(left_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS) or left_token not in name:
+            continue
+        head, _, tail = name.rpartition(left_token)
+        right_name = head + right_token + tail
+        if right_name in right_files and (right_dir != left_dir or right_name != name):
+            pairs.append((os.path.join(left_dir, name), os.path.join(right_dir, right_name)))
+    return pairs
+
+
+def parameters_path(params_dir, left_path, algo):
+    """
+    Parameter file written by save_parameters for this image: the prefix is the part of the left file name
+    before the first underscore
+    """
+    prefix = os.path.basename(left_path).split("_")[0]
+    return os.path.join(params_dir, f"parameters_{prefix}_stereo-{algo}.json")
+
+
+def load_parameters(path):
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def output_path(output_dir, left_path, fmt):
+    name = os.path.splitext(os.path.basename(left_path))[0]
+    return os.path.join(output_dir, f"{name}_disparity.{'npy' if fmt == 'npy' else 'png'}")
+
+
+def write_disparity(path, disparity_map, fmt):
+    """
+    Writes the disparity atomically, so interrupted runs never leave partial files behind.
+    Formats: "png16" stores 16 x disparity in a 16 bit PNG (0 for invalid pixels), "png8" a normalized 8 bit
+    image for viewing and "npy" the raw array.
+    """
+    if fmt == "png16":
+        if disparity_map.dtype == np.uint8:
+            # The WLS output is already divided by 16
+            disparity_map = disparity_map.astype(np.int32) * 16
+        data = np.clip(disparity_map, 0, 65535).astype(np.uint16)
+    elif fmt == "png8":
+        data = cv2.normalize(disparity_map, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    else:
+        data = disparity_map
+
+    tmp_path = path + ".tmp"
+    if fmt == "npy":
+        with open(tmp_path, "wb") as outfile:
+            np.save(outfile, data)
+    else:
+        ok, buffer = cv2.imencode(".png", data)
+        if not ok:
+            raise IOError(f"Could not encode {path}")
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(buffer.tobytes())
+    os.replace(tmp_path, path)
+
+
+def _init_worker(threads, calibration=None, alpha=RECTIFY_ALPHA):
+    cv2.setNumThreads(threads)
+    _worker["matchers"] = MatcherSet()
+    _worker["rectifier"] = Rectifier(calibration, alpha) if calibration is not None else None
+
+
+def process_pair(task):
+    """
+    Computes and writes the disparity of one pair. Runs in the worker processes.
+    :param task: (left path, right path, algo, parameters, output path, output format)
+    :return: (left path, output path, error message or None, seconds)
+    """
+    left_path, right_path, algo, params, out_path, fmt = task
+    t_start = time.time()
+    try:
+        left = read_grayscale(left_path)
+        right = read_grayscale(right_path)
+        if _worker.get("rectifier") is not None:
+            left, right = rectify_pair(left, right, _worker["rectifier"])
+        disparity_map, _ = compute_disparity(left, right, algo, params, matchers=_worker.get("matchers"))
+        write_disparity(out_path, disparity_map, fmt)
+    except Exception as e:
+        return left_path, out_path, f"{type(e).__name__}: {e}", time.time() - t_start
+    return left_path, out_path, None, time.time() - t_start
+
+
+def build_tasks(pairs, algo, output_dir, fmt, params=None, params_dir=None, overwrite=False):
+    """
+    :return: tasks to run, number of pairs skipped because their output exists, and pairs without parameters
+    """
+    tasks, skipped, missing = [], 0, []
+    for left_path, right_path in pairs:
+        out_path = output_path(output_dir, left_path, fmt)
+        if not overwrite and os.path.exists(out_path):
+            skipped += 1
+            continue
+        pair_params = params
+        if pair_params is None:
+            path = parameters_path(params_dir, left_path, algo)
+            if not os.path.exists(path):
+                missing.append(left_path)
+                continue
+            pair_params = load_parameters(path)
+        tasks.append((left_path, right_path, algo, pair_params, out_path, fmt))
+    return tasks, skipped, missing
+
+
+def prepare_rectification(tasks, calibration, alpha=RECTIFY_ALPHA):
+    """
+    Computes the remap tables of the image size of the first pair before the workers start, so that they all
+    memory-map the tables from the rectification cache instead of each computing them
+    """
+    if calibration is None or not tasks:
+        return
+    left = cv2.imread(tasks[0][0], cv2.IMREAD_GRAYSCALE)
+    if left is not None:
+        Rectifier(calibration, alpha).maps(left.shape)
+
+
+def run(tasks, workers, threads, calibration=None, alpha=RECTIFY_ALPHA):
+    """
+    Runs the tasks in a process pool, reporting progress and throughput as results come in
+    :param calibration: optional stereo calibration (see rectification.load_calibration), the pairs are
+        rectified before matching
+    :return: number of failed pairs
+    """
+    failed = 0
+    total = len(tasks)
+    t_start = time.time()
+    prepare_rectification(tasks, calibration, alpha)
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(threads, calibration, alpha)) as pool:
+        for done, (left_path, out_path, error, seconds) in enumerate(pool.imap_unordered(process_pair, tasks), 1):
+            elapsed = time.time() - t_start
+            if error:
+                failed += 1
+                print(f"[{done}/{total}] FAILED {left_path}: {error}")
+            else:
+                print(f"[{done}/{total}] {out_path} ({seconds:.2f} s) - {done / elapsed:.2f} pairs/sec")
+    elapsed = time.time() - t_start
+    if total:
+        print(f"Processed {total} pairs in {elapsed:.1f} s ({total / elapsed:.2f} pairs/sec), {failed} failed")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Applies saved parameters to directories of stereo pairs')
+    parser.add_argument('left_dir', help='Directory with the left images')
+    parser.add_argument('-r', '--right-dir', default=None, help='Directory with the right images (default: left_dir)')
+    parser.add_argument('-o', '--output-dir', required=True, help='Directory where disparity maps are written')
+    parser.add_argument('-a', '--algo', default='bm', choices=['bm', 'sgbm'])
+    parser.add_argument('-p', '--params', default=None,
+                        help='Parameter JSON applied to every pair (default: per prefix in --params-dir)')
+    parser.add_argument('--params-dir', default='./bm_parameters', help='Directory with the saved parameters')
+    parser.add_argument('--left-token', default='left', help='Part of the left file names replaced to find the '
+                                                           'right image')
+    parser.add_argument('--right-token', default='right')
+    parser.add_argument('-f', '--format', default='png16', choices=['png16', 'png8', 'npy'])
+    parser.add_argument('-w', '--workers', default=os.cpu_count() or 1, type=int, help='Worker processes')
+    parser.add_argument('-t', '--threads', default=None, type=int,
+                        help='OpenCV threads per worker (default: CPUs / workers)')
+    parser.add_argument('--overwrite', action='store_true', help='Recompute pairs whose output already exists')
+    parser.add_argument('--calibration', default=None,
+                        help='Stereo calibration (JSON or OpenCV YAML/XML with K1 D1 K2 D2 R T) to rectify the '
+                             'pairs with before matching')
+    parser.add_argument('--alpha', default=RECTIFY_ALPHA, type=float,
+                        help='Free scaling of the rectification, 0 (valid pixels only) to 1 (all pixels)')
+    args = parser.parse_args()
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    params = load_parameters(args.params) if args.params else None
+    calibration = load_calibration(args.calibration) if args.calibration else None
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    pairs = find_pairs(args.left_dir, args.right_dir, args.left_token, args.right_token)
+    tasks, skipped, missing = build_tasks(pairs, args.algo, args.output_dir, args.format, params=params,
+                                          params_dir=args.params_dir, overwrite=args.overwrite)
+    print(f"Found {len(pairs)} pairs: {len(tasks)} to process, {skipped} already done, "
+          f"{len(missing)} without parameters. {args.workers} workers x {threads} OpenCV threads")
+    for left_path in missing:
+        print(f"No parameters for {left_path} in {args.params_dir}")
+
+    failed = run(tasks, args.workers, threads, calibration, args.alpha)
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
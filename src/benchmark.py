@@ -0,0 +1,876 @@
+import argparse
+import base64
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import dash_reusable_components as drc
+from disparity_map import (generate_stereo_bm_disparity_map, generate_stereo_sgbm_disparity_map,
+                           get_stereo_bm_object, get_stereo_sgbm_object)
+from disparity_stats import disparity_statistics
+from evaluation import THRESHOLDS, evaluate_batch, read_pfm, write_pfm
+from filtering import apply_wls_filter, filtering
+from governor import available_cores, LAYOUT_FILE
+from image_pack import PackedImageStore, import_csv, read_csv_images
+from numpy_bm import (chunk_rows, compute_matching_costs, compute_numpy_bm_disparity_map, mask_invalid_region,
+                      NUMPY_BM_MAX_MB, postprocess, valid_region)
+from parameter_space import default_parameters
+from pipeline import compute_disparity, compute_roi_disparity, disparity_to_float, normalize_disparity
+from rectification import calibration_key, compute_rectification, read_cached_maps, Rectifier
+from tiling import compute_tiled_bm_disparity_map
+
+RESOLUTIONS = dict(vga=(640, 480), hd=(1280, 720), fhd=(1920, 1080), mp5=(2592, 1944), mp12=(4000, 3000))
+# Resolutions of the suite by default, the larger ones take minutes (and SGBM HH several GB at 12 MP)
+DEFAULT_RESOLUTIONS = ("vga", "hd", "fhd")
+# A median slower than the baseline by more than this fraction is reported as a regression
+REGRESSION_THRESHOLD = 0.2
+
+BM_PARAMETERS = dict(num_disp=128, block_size=15, prefilter_cap=31, prefilter_size=9, uniqueness_ratio=10,
+                     speckle_windows_size=100, speckle_range=32, texture_threshold=10)
+SGBM_PARAMETERS = dict(num_disp=128, block_size=5, p1=8 * 5 * 5, p2=32 * 5 * 5, prefilter_cap=63,
+                       uniqueness_ratio=10, speckle_windows_size=100, speckle_range=32, disp12maxdiff=1)
+
+
+def synthetic_pair(width, height, max_disparity=64, seed=0):
+    """
+    Generates a rectified stereo pair with known disparity: a multi-scale random texture is used as the left
+    image and the right image is obtained by shifting it along the rows with a smooth, slanted disparity field.
+    :return: left image, right image (uint8 grayscale) and the disparity of every left pixel (float32)
+    """
+    rng = np.random.default_rng(seed)
+    texture = np.zeros((height, width), np.float32)
+    for scale in (1, 4, 16):
+        noise = rng.random((height // scale + 1, width // scale + 1)).astype(np.float32)
+        texture += cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC) / scale
+    left = cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+    # Background plane slanted along the rows plus a nearer rectangle in the middle
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    disparity = max_disparity * (0.25 + 0.35 * ys / height)
+    inner = (slice(height // 3, 2 * height // 3), slice(width // 3, 2 * width // 3))
+    disparity[inner] = 0.9 * max_disparity
+
+    # A left pixel at x is seen at x - d in the right image
+    right = cv2.remap(left, xs + disparity, ys, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+    return left, right, disparity
+
+
+def time_function(function, repeat=5, warmup=1):
+    """
+    :return: timing statistics (seconds) of repeated calls of function
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t_start)
+    times = np.array(times)
+    return dict(mean=float(times.mean()), median=float(np.median(times)), min=float(times.min()),
+                std=float(times.std()), repeat=repeat)
+
+
+def benchmark_tiling(resolution, threads, repeat, num_disp=128, block_size=15):
+    """
+    Compares StereoBM against the strip-tiled engine for the given thread counts
+    """
+    width, height = RESOLUTIONS[resolution]
+    left, right, _ = synthetic_pair(width, height, max_disparity=num_disp // 2)
+    params = dict(num_disp=num_disp, block_size=block_size, prefilter_cap=31, prefilter_size=9,
+                  uniqueness_ratio=10, speckle_windows_size=100, speckle_range=32, texture_threshold=10)
+
+    # Both prefilters, and an odd number of rows: the XSobel prefilter treats the last row of odd height images apart
+    for use_xsobel in (False, True):
+        for rows in (height, height - 1):
+            case = dict(params, use_xsobel=use_xsobel)
+            reference = generate_stereo_bm_disparity_map(left[:rows], right[:rows], **case)
+            for n in threads + [2, 3, 5]:
+                tiled = compute_tiled_bm_disparity_map(left[:rows], right[:rows], threads=n, **case)
+                assert np.array_equal(tiled, reference), \
+                    f"tiled result differs from StereoBM ({n} threads, {rows} rows, use_xsobel={use_xsobel})"
+
+    results = dict(untiled=time_function(lambda: generate_stereo_bm_disparity_map(left, right, **params), repeat))
+    for n in threads:
+        results[f"tiled_{n}"] = time_function(lambda: compute_tiled_bm_disparity_map(left, right, threads=n,
+                                                                                     **params), repeat)
+
+    base = results["untiled"]["median"]
+    print(f"\nStereoBM {width}x{height}, {num_disp} disparities, block {block_size}")
+    for name, stats in results.items():
+        stats["speedup"] = base / stats["median"]
+        print(f"{name:>12}: {1000 * stats['median']:9.1f} ms  x{stats['speedup']:.2f}")
+    return results
+
+
+def benchmark_numpy_bm(resolution, repeat, num_disp=64, block_size=15):
+    """
+    Compares StereoBM against the NumPy engine: the full computation, and the post-processing alone which is
+    all the app runs when only the uniqueness, texture or speckle parameters change
+    """
+    width, height = RESOLUTIONS[resolution]
+    left, right, _ = synthetic_pair(width, height, max_disparity=num_disp // 2)
+    params = dict(BM_PARAMETERS, num_disp=num_disp, block_size=block_size)
+
+    reference = generate_stereo_bm_disparity_map(left, right, **params)
+    result = compute_numpy_bm_disparity_map(left, right, **params)
+    x0, y0, x1, y1 = valid_region(left.shape, 0, num_disp, block_size)
+    assert np.array_equal(result[y0:y1, x0:x1], reference[y0:y1, x0:x1]), "NumPy result differs from StereoBM"
+    # Whole maps, once StereoBM's stale values outside the valid region are masked as the app does
+    for min_disp in (0, 5, 20):
+        case = dict(params, min_disp=min_disp, speckle_windows_size=0)
+        masked = mask_invalid_region(generate_stereo_bm_disparity_map(left, right, **case), **case)
+        assert np.array_equal(compute_numpy_bm_disparity_map(left, right, **case), masked), \
+            f"NumPy map differs from the masked StereoBM map with min_disp={min_disp}"
+
+    # The peak memory stays under the cap, also when a small one splits the cost volume in many chunks
+    peaks = {}
+    for max_mb in (NUMPY_BM_MAX_MB, 32, 8):
+        max_bytes = max_mb * 1024 * 1024
+        if not chunk_rows(left.shape, max_bytes=max_bytes, **params):
+            continue
+        tracemalloc.start()
+        try:
+            chunked = compute_matching_costs(left, right, max_bytes=max_bytes, **params)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak <= max_bytes, f"peak memory {peak / 2 ** 20:.1f} MB over the {max_mb} MB cap"
+        assert np.array_equal(postprocess(chunked, **params)[y0:y1, x0:x1], reference[y0:y1, x0:x1]), \
+            f"NumPy result with a {max_mb} MB cap differs from StereoBM"
+        peaks[max_mb] = peak
+
+    costs = compute_matching_costs(left, right, **params)
+    results = dict(opencv=time_function(lambda: generate_stereo_bm_disparity_map(left, right, **params), repeat),
+                   numpy=time_function(lambda: compute_numpy_bm_disparity_map(left, right, **params), repeat),
+                   numpy_postprocess=time_function(lambda: postprocess(costs, **params), repeat))
+
+    base = results["opencv"]["median"]
+    print(f"\nStereoBM {width}x{height}, {num_disp} disparities, block {block_size}")
+    for name, stats in results.items():
+        stats["speedup"] = base / stats["median"]
+        print(f"{name:>18}: {1000 * stats['median']:9.1f} ms  x{stats['speedup']:.2f}")
+    for max_mb, peak in peaks.items():
+        print(f"{'cap ' + str(max_mb) + ' MB':>18}: peak {peak / 2 ** 20:.1f} MB")
+    results["peak_mb"] = {str(max_mb): peak / 2 ** 20 for max_mb, peak in peaks.items()}
+    return results
+
+
+def benchmark_roi(resolutions, sizes, repeat, algos=("bm", "sgbm")):
+    """
+    Full frame computation against regions of interest of growing size, centered in the image: the time of a
+    region depends on its area (plus the search range and halo), not on the image size. The regions are checked
+    against the full frame result.
+    :param sizes: side lengths of the square regions
+    """
+    results = {}
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        left, right, _ = synthetic_pair(width, height)
+        for algo in algos:
+            params = dict(default_parameters(algo), **(BM_PARAMETERS if algo == "bm" else SGBM_PARAMETERS))
+            full, _ = compute_disparity(left, right, algo, params)
+            cases = dict(full=time_function(lambda: compute_disparity(left, right, algo, params), repeat))
+            for size in sizes:
+                box = ((width - size) // 2, (height - size) // 2, size, size)
+                roi, (x, y, w, h), window = compute_roi_disparity(left, right, algo, params, box)
+                equal = float(np.mean(roi == full[y:y + h, x:x + w]))
+                stats = time_function(lambda: compute_roi_disparity(left, right, algo, params, box), repeat)
+                cases[f"roi_{size}"] = dict(stats, window=window, equal=equal)
+
+            base = cases["full"]["median"]
+            print(f"\n{algo} {width}x{height}, {params['num_disp']} disparities")
+            for name, stats in cases.items():
+                stats["speedup"] = base / stats["median"]
+                detail = f"  window {stats['window'][2]}x{stats['window'][3]}, {100 * stats['equal']:.1f}% equal" \
+                    if "window" in stats else ""
+                print(f"{name:>10}: {1000 * stats['median']:9.1f} ms  x{stats['speedup']:.1f}{detail}")
+            results[f"{resolution}/{algo}"] = cases
+    return results
+
+
+def suite_cases(left, right):
+    """
+    Hot path functions of the app on one pair, as name -> function without arguments
+    """
+    # filtering receives the color images of the app
+    left_rgb, right_rgb = cv2.cvtColor(left, cv2.COLOR_GRAY2RGB), cv2.cvtColor(right, cv2.COLOR_GRAY2RGB)
+    bm_disparity = generate_stereo_bm_disparity_map(left, right, **BM_PARAMETERS)
+    disparity_image = Image.fromarray(normalize_disparity(bm_disparity))
+    encoded = drc.pil_to_b64(disparity_image)
+
+    def sgbm(mode):
+        return lambda: generate_stereo_sgbm_disparity_map(left, right, use_dynamic_programming=mode,
+                                                          **SGBM_PARAMETERS)
+
+    return dict(
+        bm=lambda: generate_stereo_bm_disparity_map(left, right, **BM_PARAMETERS),
+        sgbm_default=sgbm("default"),
+        sgbm_hh=sgbm("dp"),
+        sgbm_3way=sgbm("3way"),
+        # The matchers are created in the timed function, as in the app without the matcher pool
+        filtering_bm=lambda: filtering(get_stereo_bm_object(**BM_PARAMETERS), left_rgb, right_rgb),
+        filtering_sgbm=lambda: filtering(get_stereo_sgbm_object(**SGBM_PARAMETERS), left_rgb, right_rgb),
+        normalize=lambda: normalize_disparity(bm_disparity),
+        stats=lambda: disparity_statistics(bm_disparity, 0, BM_PARAMETERS["num_disp"]),
+        pil_to_b64=lambda: drc.pil_to_b64(disparity_image),
+        b64_to_numpy=lambda: drc.b64_to_numpy(encoded, to_scalar=False),
+    )
+
+
+# Cases of the layout sweep, run in turn like a mix of app requests
+LAYOUT_CASES = ("bm", "sgbm_default", "filtering_sgbm")
+
+# Per worker process state of the layout sweep, set by _init_layout_worker
+_layout_worker = {}
+
+
+def layout_candidates(cores):
+    """
+    (processes, OpenCV threads) layouts of the sweep: a few process counts, each with thread counts from one up
+    to an even share of the cores, plus all the cores per process (what OpenCV does by default)
+    """
+    layouts = []
+    for workers in sorted({1, 2, 3, 4, cores // 2, cores} & set(range(1, cores + 1))):
+        share = max(1, cores // workers)
+        threads = {1, share, cores} | {2 ** i for i in range(1, 8) if 2 ** i <= share}
+        layouts.extend((workers, t) for t in sorted(threads))
+    return layouts
+
+
+def _init_layout_worker(threads, resolution):
+    cv2.setNumThreads(threads)
+    width, height = RESOLUTIONS[resolution]
+    left, right, _ = synthetic_pair(width, height)
+    _layout_worker["cases"] = suite_cases(left, right)
+
+
+def _run_layout_case(name):
+    t_start = time.perf_counter()
+    _layout_worker["cases"][name]()
+    return time.perf_counter() - t_start
+
+
+def benchmark_layouts(resolution, layouts, requests, cases=LAYOUT_CASES):
+    """
+    Runs the same mix of requests with every layout: one process per gunicorn worker (or job thread), all of
+    them kept busy, each with the given OpenCV thread count. Latencies are the service times under that load,
+    so oversubscribed layouts show up in the tail.
+    :return: list of result dictionaries, in the order of layouts
+    """
+    tasks = [cases[i % len(cases)] for i in range(requests)]
+    results = []
+    print(f"\n{requests} requests ({', '.join(cases)}) at {resolution}")
+    print(f"{'workers':>8}{'threads':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for workers, threads in layouts:
+        with multiprocessing.Pool(workers, initializer=_init_layout_worker, initargs=(threads, resolution)) as pool:
+            # Warm up every process
+            pool.map(_run_layout_case, [cases[0]] * workers, chunksize=1)
+            t_start = time.perf_counter()
+            latencies = np.array(list(pool.imap_unordered(_run_layout_case, tasks))) * 1000
+            elapsed = time.perf_counter() - t_start
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        result = dict(workers=workers, threads=threads, throughput=requests / elapsed, p50=float(p50),
+                      p95=float(p95), p99=float(p99))
+        results.append(result)
+        print(f"{workers:8d}{threads:8d}{result['throughput']:9.2f}{p50:9.1f}{p95:9.1f}{p99:9.1f}")
+    return results
+
+
+def best_layout(results):
+    """
+    :return: the layout with the highest throughput, the lowest p95 latency among layouts within 5% of it
+    """
+    top = max(result["throughput"] for result in results)
+    return min((result for result in results if result["throughput"] >= 0.95 * top), key=lambda r: r["p95"])
+
+
+def csv_lookup(path, key):
+    """
+    Looks a key up in a key,image base64 CSV the only way the format allows: parsing it up to the key
+    :return: encoded image bytes, or None
+    """
+    for row_key, image_bytes in read_csv_images(path):
+        if row_key == key:
+            return image_bytes
+    return None
+
+
+def benchmark_image_store(resolution, count, repeat, csv_path=None):
+    """
+    Lookup latency of the base64 CSV against the memory-mapped pack, storing the encoded images or decoded
+    grayscale arrays. Without a CSV, one is written with count synthetic JPEG images.
+    :return: result dictionary, median microseconds per lookup
+    """
+    import uuid
+    results = dict(resolution=resolution if csv_path is None else None, environment=environment())
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.basename(csv_path) if csv_path else f"synthetic images at {resolution}"
+        if csv_path is None:
+            width, height = RESOLUTIONS[resolution]
+            csv_path = os.path.join(directory, "image_string.csv")
+            with open(csv_path, "w", newline="") as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(["key", "image"])
+                for seed in range(count):
+                    left, _, _ = synthetic_pair(width, height, seed=seed)
+                    jpeg = cv2.imencode(".jpg", left)[1].tobytes()
+                    writer.writerow([str(uuid.uuid4()), base64.b64encode(jpeg).decode()])
+        encoded_pack = PackedImageStore(os.path.join(directory, "encoded.pack"))
+        gray_pack = PackedImageStore(os.path.join(directory, "gray.pack"))
+        import_csv(csv_path, encoded_pack)
+        import_csv(csv_path, gray_pack, decode="gray")
+        keys = [key for key, _ in read_csv_images(csv_path)]
+        results.update(images=len(keys), csv_bytes=os.path.getsize(csv_path), encoded_pack=encoded_pack.stats(),
+                       gray_pack=gray_pack.stats())
+
+        def decode(image_bytes):
+            return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+        # Keys are taken in turn from a shuffled list, so the CSV scans stop on average in the middle of the file
+        order = np.random.default_rng(0).permutation(keys)
+        cases = dict(
+            csv=lambda k: csv_lookup(csv_path, k),
+            csv_gray=lambda k: decode(csv_lookup(csv_path, k)),
+            pack=lambda k: encoded_pack.get(k),
+            pack_gray=lambda k: encoded_pack.get_gray(k),
+            pack_decoded=lambda k: gray_pack.get(k),
+            pack_open=lambda k: PackedImageStore(encoded_pack.path).get(k),
+        )
+        print(f"\n{len(keys)} images ({source}), CSV {results['csv_bytes'] / 1e6:.1f} MB, "
+              f"pack {results['encoded_pack']['data_bytes'] / 1e6:.1f} MB encoded / "
+              f"{results['gray_pack']['data_bytes'] / 1e6:.1f} MB decoded")
+        print(f"{'case':>14}{'median us':>12}{'min us':>10}")
+        results["cases"] = {}
+        for name, lookup in cases.items():
+            key_cycle = itertools.cycle(order)
+            timing = time_function(lambda: lookup(next(key_cycle)), repeat=repeat)
+            results["cases"][name] = timing
+            print(f"{name:>14}{1e6 * timing['median']:12.1f}{1e6 * timing['min']:10.1f}")
+    return results
+
+
+# Requests of a new session, in the order the page sends them: each is a milestone of the cold start benchmark
+def read_pfm_copy(path):
+    """
+    PFM loading as commonly written: the whole file read into memory, then flipped into a new array
+    """
+    with open(path, "rb") as infile:
+        kind = infile.readline().strip()
+        width, height = (int(v) for v in infile.readline().split())
+        scale = float(infile.readline())
+        data = np.fromfile(infile, "<f4" if scale < 0 else ">f4")
+    shape = (height, width, 3) if kind == b"PF" else (height, width)
+    return np.flipud(data.reshape(shape)).astype(np.float32)
+
+
+def reference_metrics(disparity_map, ground_truth, min_disp=0, thresholds=THRESHOLDS):
+    """
+    The metrics of evaluation.evaluate_batch with boolean indexing, one pair at a time
+    """
+    disparity = disparity_to_float(disparity_map, min_disp)
+    known = np.isfinite(ground_truth)
+    valid = known & np.isfinite(disparity)
+    error = np.abs(disparity[valid] - ground_truth[valid])
+    result = dict(pixels=int(known.sum()), density=valid.sum() / known.sum(), epe=float(error.mean()),
+                  rmse=float(np.sqrt(np.mean(error ** 2))))
+    for threshold in thresholds:
+        result[f"bad_{threshold:g}"] = ((error > threshold).sum() + known.sum() - valid.sum()) / known.sum()
+    return result
+
+
+def filtered_consistency(disparity, right_disparity, max_difference=1.0):
+    """
+    Fraction of the pixels of a WLS filtered disparity map (uint8, in pixels) that agree within max_difference
+    with the right matcher disparity (int16, negative and scaled by 16) of the pixel they match
+    """
+    height, width = disparity.shape
+    disparity = disparity.astype(np.float32)
+    right_disparity = -right_disparity.astype(np.float32) / cv2.StereoMatcher_DISP_SCALE
+    xs = np.arange(width)[None, :] - np.round(disparity).astype(int)
+    valid = (disparity > 0) & (xs >= 0)
+    rows = np.broadcast_to(np.arange(height)[:, None], disparity.shape)
+    matched = right_disparity[rows[valid], xs[valid]]
+    return float(np.sum(np.abs(disparity[valid] - matched) <= max_difference)) / disparity.size
+
+
+def benchmark_evaluation(resolution, count, repeat):
+    """
+    Ground truth loading (full read against memory map) and error metrics (boolean indexing per pair against the
+    batched evaluation) on count synthetic pairs with StereoBM disparities
+    """
+    width, height = RESOLUTIONS[resolution]
+    disparity_maps, ground_truths = [], []
+    for seed in range(count):
+        left, right, ground_truth = synthetic_pair(width, height, seed=seed)
+        disparity_maps.append(generate_stereo_bm_disparity_map(left, right, **BM_PARAMETERS))
+        ground_truths.append(ground_truth)
+
+    for reference, result in zip((reference_metrics(d, g) for d, g in zip(disparity_maps, ground_truths)),
+                                 evaluate_batch(disparity_maps, ground_truths)):
+        for name, value in reference.items():
+            assert abs(value - result[name]) <= 1e-4 * max(1.0, abs(value)), f"{name} differs: {value} {result[name]}"
+
+    # The WLS filter needs the right view matched against the left one: with the views swapped, fewer than 20% of
+    # the filtered pixels of the first pair are within 2 pixels of the ground truth, and about 2% agree with the
+    # right view
+    left, right, ground_truth = synthetic_pair(width, height, seed=0)
+    filtered, _ = filtering(get_stereo_bm_object(**BM_PARAMETERS), left, right)
+    known = np.isfinite(ground_truth)
+    accuracy = np.mean(np.abs(filtered[known] - ground_truth[known]) <= 2)
+    assert accuracy >= 0.5, f"WLS filtered disparities are within 2 pixels on {accuracy:.0%} of the pixels"
+    left_matcher = get_stereo_bm_object(**BM_PARAMETERS)
+    right_matcher = cv2.ximgproc.createRightMatcher(left_matcher)
+    right_disparity = right_matcher.compute(right, left)
+    swapped, _ = apply_wls_filter(left_matcher, left, np.int16(left_matcher.compute(left, right)),
+                                  np.int16(right_matcher.compute(left, right)))
+    consistency = [filtered_consistency(disparity, right_disparity) for disparity in (filtered, swapped)]
+    assert consistency[0] > 2 * consistency[1], \
+        f"WLS left-right consistency {consistency[0]:.0%}, {consistency[1]:.0%} with the views swapped"
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, f"gt_{i}.pfm") for i in range(count)]
+        for path, ground_truth in zip(paths, ground_truths):
+            write_pfm(path, ground_truth)
+        cases = dict(
+            pfm_read=lambda: [read_pfm_copy(path) for path in paths],
+            pfm_mmap=lambda: [read_pfm(path) for path in paths],
+            metrics_per_pair=lambda: [reference_metrics(d, g) for d, g in zip(disparity_maps, ground_truths)],
+            metrics_batch=lambda: evaluate_batch(disparity_maps, ground_truths),
+            load_and_evaluate=lambda: evaluate_batch(disparity_maps, [read_pfm(path) for path in paths]),
+        )
+        results = {name: time_function(function, repeat) for name, function in cases.items()}
+
+    print(f"\n{count} pairs at {width}x{height}")
+    for name, stats in results.items():
+        print(f"{name:>18}: {1000 * stats['median']:9.2f} ms  ({1000 * stats['median'] / count:.2f} ms per pair)")
+    return results
+
+
+def synthetic_calibration(width, height):
+    """
+    Stereo calibration of two slightly rotated cameras with barrel distortion, 12 cm apart
+    """
+    focal = 0.9 * width
+    camera = [[focal, 0.0, width / 2.0], [0.0, focal, height / 2.0], [0.0, 0.0, 1.0]]
+    rotation = cv2.Rodrigues(np.array([0.01, -0.02, 0.005]))[0]
+    return dict(K1=np.array(camera), D1=np.array([[-0.1, 0.01, 0.0, 0.0, 0.0]]), K2=np.array(camera),
+                D2=np.array([[-0.08, 0.01, 0.0, 0.0, 0.0]]), R=rotation, T=np.array([[-0.12], [0.001], [0.0]]),
+                image_size=(width, height))
+
+
+def benchmark_rectify(resolutions, repeat):
+    """
+    Rectification of a pair when the CV_16SC2 remap tables are computed for every frame, loaded from the disk
+    cache or already in memory (a single cv2.remap per image), and the remap with CV_32FC1 tables
+    """
+    results = {}
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        left, right, _ = synthetic_pair(width, height)
+        calibration = synthetic_calibration(width, height)
+
+        def remap(maps):
+            return (cv2.remap(left, maps["left_map1"], maps["left_map2"], cv2.INTER_LINEAR),
+                    cv2.remap(right, maps["right_map1"], maps["right_map2"], cv2.INTER_LINEAR))
+
+        with tempfile.TemporaryDirectory() as directory:
+            rectifier = Rectifier(calibration, cache_dir=directory, map_type="16sc2")
+            rectifier.maps(left.shape)
+            float_maps = compute_rectification(calibration, (width, height), map_type="32fc1")
+            cache_entry = os.path.join(directory, calibration_key(calibration, (width, height), rectifier.alpha,
+                                                                  rectifier.map_type))
+            cases = dict(
+                compute_every_frame=lambda: remap(compute_rectification(calibration, (width, height),
+                                                                        map_type="16sc2")),
+                disk_cache=lambda: remap(read_cached_maps(cache_entry)),
+                memory_cache=lambda: rectifier(left, right),
+                float_tables=lambda: remap(float_maps),
+            )
+            results[resolution] = {name: time_function(function, repeat) for name, function in cases.items()}
+
+        base = results[resolution]["compute_every_frame"]["median"]
+        print(f"\n{width}x{height}")
+        for name, stats in results[resolution].items():
+            stats["speedup"] = base / stats["median"]
+            print(f"{name:>20}: {1000 * stats['median']:9.2f} ms  x{stats['speedup']:.1f}")
+    return results
+
+
+COLD_START_MILESTONES = ("import", "page", "upload", "upload_callback", "disparity_callback", "render_callback")
+
+
+def _layout_values(component, values=None):
+    """
+    :return: (component id, property) -> initial value of every component of a Dash layout
+    """
+    values = {} if values is None else values
+    component_id = getattr(component, "id", None)
+    if component_id is not None:
+        for name, value in component.to_plotly_json()["props"].items():
+            values[(component_id, name)] = value
+    children = getattr(component, "children", None)
+    for child in children if isinstance(children, (list, tuple)) else [children]:
+        if hasattr(child, "to_plotly_json"):
+            _layout_values(child, values)
+    return values
+
+
+def _callback_key(dash_app, output):
+    """
+    :param output: "component-id.property" of one of the outputs of a callback
+    :return: callback_map key of the callback, which lists all its outputs
+    """
+    for key in dash_app.callback_map:
+        if output in key.strip(".").split("..."):
+            return key
+    raise KeyError(f"No callback has the output {output}")
+
+
+def _post_callback(client, dash_app, output, values, changed):
+    """
+    Sends a callback request like the page does, with the inputs and states taken from values
+    :param output: "component-id.property" of one of the outputs of the callback
+    :param changed: (component id, property) of the inputs that triggered it
+    :return: response of the callback, component id -> property -> value
+    """
+    output = _callback_key(dash_app, output)
+    callback = dash_app.callback_map[output]
+
+    def props(dependencies):
+        return [dict(id=d["id"], property=d["property"], value=values.get((d["id"], d["property"])))
+                for d in dependencies]
+
+    outputs = [dict(zip(("id", "property"), name.rsplit(".", 1))) for name in output.strip(".").split("...")]
+    payload = dict(output=output, outputs=outputs if output.startswith("..") else outputs[0],
+                   inputs=props(callback["inputs"]), state=props(callback["state"]),
+                   changedPropIds=[f"{component_id}.{name}" for component_id, name in changed])
+    response = client.post("/_dash-update-component", json=payload)
+    if response.status_code != 200:
+        raise RuntimeError(f"Callback {output} failed with status {response.status_code}")
+    return response.get_json()["response"]
+
+
+def serve_first_requests(dash_app, left_path, right_path):
+    """
+    Serves the requests of a new session through the Flask test client: the page, the upload of a pair and the
+    callbacks up to the rendered disparity map
+    :return: list of (milestone, time.time() when it was reached)
+    """
+    import io
+    milestones = []
+    client = dash_app.server.test_client()
+    client.get("/")
+    layout = dash_app.layout() if callable(dash_app.layout) else dash_app.layout
+    values = _layout_values(layout)
+    milestones.append(("page", time.time()))
+
+    with open(left_path, "rb") as left, open(right_path, "rb") as right:
+        files = dict(session=values[("session-id", "children")], left=(io.BytesIO(left.read()), "bench_left.png"),
+                     right=(io.BytesIO(right.read()), "bench_right.png"))
+    response = client.post("/upload", data=files, content_type="multipart/form-data")
+    if response.status_code != 200:
+        raise RuntimeError(f"Upload failed with status {response.status_code}")
+    milestones.append(("upload", time.time()))
+
+    values[("direct-upload-done", "n_clicks")] = 1
+    response = _post_callback(client, dash_app, "local.data", values, [("direct-upload-done", "n_clicks")])
+    values[("local", "data")] = response["local"]["data"]
+    milestones.append(("upload_callback", time.time()))
+
+    response = _post_callback(client, dash_app, "job.data", values, [("local", "data")])
+    values[("job", "data")] = response["job"]["data"]
+    milestones.append(("disparity_callback", time.time()))
+
+    _post_callback(client, dash_app, "div-interactive-image.children", values, [("job", "data")])
+    milestones.append(("render_callback", time.time()))
+    return milestones
+
+
+def cold_start_probe(left_path, right_path, forks=0):
+    """
+    Runs in the process started by benchmark_cold_start. Without forks, imports the app and serves the first
+    requests (a new instance). With forks, imports the app once and serves them in forked children, like
+    gunicorn workers of a preloaded master.
+    :return: list of milestone lists, with the time the process (or each child) started as ("start", time)
+    """
+    import app as app_module
+    imported = time.time()
+    if not forks:
+        return [[("import", imported)] + serve_first_requests(app_module.app, left_path, right_path)]
+
+    from governor import apply_layout, choose_layout
+    layout = choose_layout()
+    # What the when_ready hook of gunicorn.conf.py does
+    app_module.preload()
+    runs = []
+    for _ in range(forks):
+        read_fd, write_fd = os.pipe()
+        started = time.time()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = 0
+            try:
+                # What the post_fork hook of gunicorn.conf.py does
+                apply_layout(layout)
+                milestones = serve_first_requests(app_module.app, left_path, right_path)
+                with os.fdopen(write_fd, "w") as outfile:
+                    json.dump(milestones, outfile)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as infile:
+            data = infile.read()
+        os.waitpid(pid, 0)
+        if not data:
+            raise RuntimeError("A forked probe failed")
+        runs.append([("start", started)] + json.loads(data))
+    return runs
+
+
+def benchmark_cold_start(resolution, repeat, forks):
+    """
+    Time to the first served disparity map of a new session, from the start of a fresh interpreter (a new
+    autoscaled instance without preloading: every worker imports the app) and from the fork of a process that
+    already imported it (gunicorn workers with preload_app). The probes run with STEREO_JOB_WORKERS=0, so the
+    disparity is computed inside the callback, and with an empty image store.
+    :return: result dictionary, milliseconds from the process start to every milestone
+    """
+    width, height = RESOLUTIONS[resolution]
+    left, right, _ = synthetic_pair(width, height)
+    results = dict(resolution=resolution, environment=environment())
+    with tempfile.TemporaryDirectory() as directory:
+        left_path, right_path = os.path.join(directory, "left.png"), os.path.join(directory, "right.png")
+        cv2.imwrite(left_path, left)
+        cv2.imwrite(right_path, right)
+        env = dict(os.environ, STEREO_JOB_WORKERS="0", PYTHONWARNINGS="ignore")
+
+        def probe(forks_per_run):
+            env["STEREO_STORE_DIR"] = tempfile.mkdtemp(dir=directory)
+            started = time.time()
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "cold-start", "--probe", left_path,
+                                     right_path, "--forks", str(forks_per_run)], env=env, check=True,
+                                    stdout=subprocess.PIPE, universal_newlines=True).stdout
+            runs = json.loads(output.strip().splitlines()[-1])
+            for run in runs:
+                if run[0][0] != "start":
+                    run.insert(0, ["start", started])
+            return [{name: 1000 * (moment - run[0][1]) for name, moment in run[1:]} for run in runs]
+
+        results["cold"] = [run for _ in range(repeat) for run in probe(0)]
+        results["preloaded"] = probe(forks) if forks else []
+
+    for mode, title in (("cold", "fresh interpreter"), ("preloaded", "forked from a preloaded process")):
+        if not results[mode]:
+            continue
+        print(f"\n{title} at {resolution}, {len(results[mode])} runs (ms since start)")
+        print(f"{'milestone':>20}{'median':>10}{'min':>10}{'max':>10}")
+        for name in COLD_START_MILESTONES:
+            times = [run[name] for run in results[mode] if name in run]
+            if times:
+                print(f"{name:>20}{np.median(times):10.1f}{min(times):10.1f}{max(times):10.1f}")
+    return results
+
+
+def environment():
+    return dict(python=platform.python_version(), opencv=cv2.__version__, numpy=np.__version__,
+                machine=platform.machine(), processor=platform.processor(), cpus=os.cpu_count(),
+                opencv_threads=cv2.getNumThreads(), time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def benchmark_suite(resolutions=DEFAULT_RESOLUTIONS, cases=None, repeat=5, warmup=1):
+    """
+    Times the hot path functions on synthetic pairs of every resolution. Cases that fail (e.g. out of memory)
+    are recorded with their error instead of aborting the run.
+    :param cases: names of the cases to run, all by default
+    :return: dict with the environment and the statistics of every "<resolution>/<case>"
+    """
+    results = {}
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        left, right, _ = synthetic_pair(width, height, max_disparity=BM_PARAMETERS["num_disp"] // 2)
+        all_cases = suite_cases(left, right)
+        print(f"\n{resolution} ({width}x{height})")
+        for name, function in all_cases.items():
+            if cases and name not in cases:
+                continue
+            key = f"{resolution}/{name}"
+            try:
+                results[key] = time_function(function, repeat, warmup)
+            except (cv2.error, MemoryError) as e:
+                results[key] = dict(error=f"{type(e).__name__}: {e}")
+                print(f"{name:>16}: failed ({type(e).__name__})")
+                continue
+            print(f"{name:>16}: {1000 * results[key]['median']:9.1f} ms")
+    return dict(environment=environment(), results=results)
+
+
+def compare_results(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the medians of two suite runs
+    :return: names of the cases slower than the baseline by more than threshold
+    """
+    regressions = []
+    print(f"\n{'case':>24} {'baseline':>10} {'current':>10}  change")
+    for key, stats in results["results"].items():
+        reference = baseline["results"].get(key)
+        if reference is None or "median" not in stats or "median" not in reference:
+            continue
+        change = stats["median"] / reference["median"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:>24} {1000 * reference['median']:8.1f}ms {1000 * stats['median']:8.1f}ms "
+              f"{100 * change:+6.1f}%{flag}")
+    if baseline.get("environment", {}).get("cpus") != results.get("environment", {}).get("cpus"):
+        print("Warning: the baseline was recorded on a machine with a different number of CPUs")
+    print(f"{len(regressions)} regressions above {100 * threshold:.0f}%")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stereo tuner benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    suite = subparsers.add_parser('suite', help='Hot path functions on synthetic pairs')
+    suite.add_argument('-r', '--resolutions', default=list(DEFAULT_RESOLUTIONS), nargs='+',
+                       choices=list(RESOLUTIONS))
+    suite.add_argument('-c', '--cases', default=None, nargs='+', help='Cases to run (default: all)')
+    suite.add_argument('-n', '--repeat', default=5, type=int)
+    suite.add_argument('-b', '--baseline', default=None, help='Suite results to compare against')
+    suite.add_argument('--threshold', default=REGRESSION_THRESHOLD, type=float,
+                       help='Relative slowdown reported as a regression')
+    suite.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    compare = subparsers.add_parser('compare', help='Compares two saved suite results')
+    compare.add_argument('baseline')
+    compare.add_argument('results')
+    compare.add_argument('--threshold', default=REGRESSION_THRESHOLD, type=float)
+
+    tiling = subparsers.add_parser('tiling', help='Strip-tiled StereoBM against the single call')
+    tiling.add_argument('-r', '--resolution', default='fhd', choices=list(RESOLUTIONS))
+    tiling.add_argument('-t', '--threads', default=None, type=int, nargs='+',
+                        help='Thread counts to test (default 1 2 4 and the number of CPUs)')
+    tiling.add_argument('-n', '--repeat', default=5, type=int)
+    tiling.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    numpy_bm = subparsers.add_parser('numpy-bm', help='NumPy StereoBM engine against OpenCV')
+    numpy_bm.add_argument('-r', '--resolution', default='vga', choices=list(RESOLUTIONS))
+    numpy_bm.add_argument('-n', '--repeat', default=5, type=int)
+    numpy_bm.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    layouts = subparsers.add_parser('layouts', help='Sweeps gunicorn worker and OpenCV thread counts')
+    layouts.add_argument('-r', '--resolution', default='hd', choices=list(RESOLUTIONS))
+    layouts.add_argument('-n', '--requests', default=24, type=int, help='Requests per layout')
+    layouts.add_argument('-c', '--cases', default=list(LAYOUT_CASES), nargs='+')
+    layouts.add_argument('-l', '--layouts', default=None, nargs='+', metavar='WORKERSxTHREADS',
+                         help='Layouts to test, e.g. 2x2 4x1 (default: candidates for the available cores)')
+    layouts.add_argument('--save', nargs='?', const=LAYOUT_FILE, default=None,
+                         help=f'Save the best layout for the governor (default path {LAYOUT_FILE})')
+    layouts.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    cold_start = subparsers.add_parser('cold-start', help='Time to the first served disparity map of a new instance')
+    cold_start.add_argument('-r', '--resolution', default='hd', choices=list(RESOLUTIONS))
+    cold_start.add_argument('-n', '--repeat', default=3, type=int, help='Fresh interpreters started')
+    cold_start.add_argument('--forks', default=3, type=int,
+                            help='Workers forked from a preloaded process, 0 to skip (default 3)')
+    cold_start.add_argument('--probe', nargs=2, default=None, metavar=('LEFT', 'RIGHT'), help=argparse.SUPPRESS)
+    cold_start.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    store = subparsers.add_parser('image-store', help='Base64 CSV lookups against the memory-mapped image pack')
+    store.add_argument('-r', '--resolution', default='hd', choices=list(RESOLUTIONS))
+    store.add_argument('-c', '--count', default=20, type=int, help='Synthetic images in the CSV')
+    store.add_argument('--csv', default=None, help='Existing key,image CSV (default: synthetic images)')
+    store.add_argument('-n', '--repeat', default=20, type=int)
+    store.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    roi = subparsers.add_parser('roi', help='Region of interest computation against the full frame')
+    roi.add_argument('-r', '--resolutions', default=["vga", "hd", "fhd", "mp5"], nargs='+',
+                     choices=list(RESOLUTIONS))
+    roi.add_argument('-s', '--sizes', default=[64, 128, 256], type=int, nargs='+', help='Sides of the regions')
+    roi.add_argument('-a', '--algos', default=["bm", "sgbm"], nargs='+', choices=["bm", "sgbm"])
+    roi.add_argument('-n', '--repeat', default=5, type=int)
+    roi.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    evaluation = subparsers.add_parser('evaluation', help='Ground truth loading and error metrics')
+    evaluation.add_argument('-r', '--resolution', default='fhd', choices=list(RESOLUTIONS))
+    evaluation.add_argument('-c', '--count', default=10, type=int, help='Synthetic pairs')
+    evaluation.add_argument('-n', '--repeat', default=5, type=int)
+    evaluation.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    rectify = subparsers.add_parser('rectify', help='Rectification with and without cached remap tables')
+    rectify.add_argument('-r', '--resolutions', default=["vga", "hd", "fhd"], nargs='+', choices=list(RESOLUTIONS))
+    rectify.add_argument('-n', '--repeat', default=10, type=int)
+    rectify.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+
+    args = parser.parse_args()
+    regressions = []
+    if args.command == 'cold-start' and args.probe:
+        print(json.dumps(cold_start_probe(*args.probe, forks=args.forks)))
+        return
+    if args.command == 'cold-start':
+        results = benchmark_cold_start(args.resolution, args.repeat, args.forks)
+    elif args.command == 'rectify':
+        results = benchmark_rectify(args.resolutions, args.repeat)
+    elif args.command == 'evaluation':
+        results = benchmark_evaluation(args.resolution, args.count, args.repeat)
+    elif args.command == 'roi':
+        results = benchmark_roi(args.resolutions, args.sizes, args.repeat, tuple(args.algos))
+    elif args.command == 'image-store':
+        results = benchmark_image_store(args.resolution, args.count, args.repeat, args.csv)
+    elif args.command == 'tiling':
+        threads = args.threads or sorted({1, 2, 4, os.cpu_count() or 1})
+        results = benchmark_tiling(args.resolution, threads, args.repeat)
+    elif args.command == 'layouts':
+        cores, quota = available_cores()
+        print(f"{cores} cores available (cgroup quota: {quota})")
+        candidates = ([tuple(int(v) for v in text.split('x')) for text in args.layouts] if args.layouts
+                      else layout_candidates(cores))
+        results = dict(cores=cores, cgroup_quota=quota, resolution=args.resolution,
+                       layouts=benchmark_layouts(args.resolution, candidates, args.requests, tuple(args.cases)))
+        best = best_layout(results['layouts'])
+        print(f"Best layout: {best['workers']} workers x {best['threads']} threads")
+        if args.save:
+            with open(args.save, 'w') as outfile:
+                json.dump(dict(best, cores=cores), outfile, indent=2)
+                print(f"Saved {args.save}")
+    elif args.command == 'numpy-bm':
+        results = benchmark_numpy_bm(args.resolution, args.repeat)
+    elif args.command == 'suite':
+        results = benchmark_suite(args.resolutions, args.cases, args.repeat)
+        if args.baseline:
+            with open(args.baseline) as infile:
+                regressions = compare_results(results, json.load(infile), args.threshold)
+    else:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        with open(args.results) as infile:
+            regressions = compare_results(json.load(infile), baseline, args.threshold)
+        args.output = None
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+            print(f"Saved {args.output}")
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
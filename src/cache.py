@@ -0,0 +1,134 @@
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# e.g. redis://localhost:6379/0. When unset everything is kept in-process.
+REDIS_URL = os.environ.get("STEREO_REDIS_URL")
+
+_redis_clients = {}
+
+
+def nbytes_of(value):
+    """
+    Best-effort size in bytes of a cached value. Numpy arrays and bytes report their exact size, tuples and
+    lists are summed and anything else counts as zero.
+    """
+    if value is None:
+        return 0
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes_of(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes_of(v) for v in value.values())
+    return 0
+
+
+def get_redis_client(url=REDIS_URL):
+    """
+    Returns a Redis client for the url, or None if Redis is not configured or the package is missing.
+    Clients are created per process, so forked gunicorn workers never share a connection with the master.
+    """
+    if not url or redis is None:
+        return None
+    key = (os.getpid(), url)
+    client = _redis_clients.get(key)
+    if client is None:
+        client = _redis_clients[key] = redis.Redis.from_url(url, socket_timeout=0.5)
+    return client
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded both by number of entries and by total bytes.
+    Keeps hit/miss/eviction counters that can be reported with ``stats()``.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=nbytes_of):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= self._data.pop(key)[1]
+            # Values bigger than the whole budget are not cached at all
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, size)
+            self.current_bytes += size
+            self._evict()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, calling ``compute()`` and caching its result on a miss
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            self.current_bytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+
+    def _evict(self):
+        while self._data and ((self.max_entries is not None and len(self._data) > self.max_entries) or
+                              (self.max_bytes is not None and self.current_bytes > self.max_bytes)):
+            _, (_, size) = self._data.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(entries=len(self._data),
+                    bytes=self.current_bytes,
+                    max_entries=self.max_entries,
+                    max_bytes=self.max_bytes,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    hit_rate=self.hits / lookups if lookups else 0.0)
@@ -61,14 +61,19 @@ def numpy_to_b64(np_array, enc_format="png", scalar=True, **kwargs):
     return pil_to_b64(im_pil, enc_format, **kwargs)
 
 
-def b64_to_pil(string):
-    decoded = base64.b64decode(string)
-    buffer = _BytesIO(decoded)
+def bytes_to_pil(data):
+    buffer = _BytesIO(data)
     im = Image.open(buffer)
 
     return im
 
 
+def b64_to_pil(string):
+    decoded = base64.b64decode(string)
+
+    return bytes_to_pil(decoded)
+
+
 def b64_to_numpy(string, to_scalar=True):
     im = b64_to_pil(string)
     np_array = np.asarray(im)
@@ -79,6 +84,16 @@ def b64_to_numpy(string, to_scalar=True):
     return np_array
 
 
+def bytes_to_numpy(data, to_scalar=True):
+    im = bytes_to_pil(data)
+    np_array = np.asarray(im)
+
+    if to_scalar:
+        np_array = np_array / 255.0
+
+    return np_array
+
+
 def pil_to_bytes_string(im):
     """
     Converts a PIL Image object into the ASCII string representation of its bytes. This is only recommended for
@@ -210,6 +225,67 @@ def NamedInlineRadioItems(name, short, options, val, **kwargs):
 
 
 # Custom Image Components
+def interactive_image_figure(src, size, dragmode="select", grid=64):
+    """
+    Figure showing an image in its pixel coordinates, with y going up from the bottom of the image
+    :param src: URL or data URL of the image
+    :param size: (width, height) of the image
+    :param grid: the image is covered by grid x grid invisible points, box and lasso selections need points to
+        select
+    """
+    width, height = size
+    xs = [(i + 0.5) * width / grid for i in range(grid)]
+    ys = [(i + 0.5) * height / grid for i in range(grid)]
+
+    return {
+        "data": [
+            {
+                "type": "scatter",
+                "x": [x for _ in ys for x in xs],
+                "y": [y for y in ys for _ in xs],
+                "mode": "markers",
+                "marker": {"opacity": 0},
+                "hoverinfo": "none",
+                "showlegend": False,
+            }
+        ],
+        "layout": {
+            "autosize": True,
+            "paper_bgcolor": "#272a31",
+            "plot_bgcolor": "#272a31",
+            "xaxis": {
+                "range": (0, width),
+                "scaleanchor": "y",
+                "scaleratio": 1,
+                "color": "white",
+                # "gridcolor": "#43454a",
+                "tickwidth": 1,
+            },
+            "yaxis": {
+                "range": (0, height),
+                "color": "white",
+                # "gridcolor": "#43454a",
+                "tickwidth": 1,
+            },
+            "images": [
+                {
+                    "xref": "x",
+                    "yref": "y",
+                    "x": 0,
+                    "y": 0,
+                    "yanchor": "bottom",
+                    "sizing": "stretch",
+                    "sizex": width,
+                    "sizey": height,
+                    "layer": "below",
+                    "source": src,
+                }
+            ],
+            "dragmode": dragmode,
+        },
+    }
+
+
 def InteractiveImagePIL(
         image_id, image, enc_format="png", dragmode="select", verbose=False, **kwargs
 ):
@@ -222,47 +298,9 @@ def InteractiveImagePIL(
     else:
         encoded_image = pil_to_b64(image, enc_format=enc_format, verbose=verbose)
 
-    width, height = image.size
-
     return dcc.Graph(
         id=image_id,
-        figure={
-            "data": [],
-            "layout": {
-                "autosize": True,
-                "paper_bgcolor": "#272a31",
-                "plot_bgcolor": "#272a31",
-                "xaxis": {
-                    "range": (0, width),
-                    "scaleanchor": "y",
-                    "scaleratio": 1,
-                    "color": "white",
-                    # "gridcolor": "#43454a",
-                    "tickwidth": 1,
-                },
-                "yaxis": {
-                    "range": (0, height),
-                    "color": "white",
-                    # "gridcolor": "#43454a",
-                    "tickwidth": 1,
-                },
-                "images": [
-                    {
-                        "xref": "x",
-                        "yref": "y",
-                        "x": 0,
-                        "y": 0,
-                        "yanchor": "bottom",
-                        "sizing": "stretch",
-                        "sizex": width,
-                        "sizey": height,
-                        "layer": "below",
-                        "source": HTML_IMG_SRC_PARAMETERS + encoded_image,
-                    }
-                ],
-                "dragmode": dragmode,
-            },
-        },
+        figure=interactive_image_figure(HTML_IMG_SRC_PARAMETERS + encoded_image, image.size, dragmode),
         config={
             "modeBarButtonsToRemove": [
                 "sendDataToCloud",
@@ -277,14 +315,13 @@ def InteractiveImagePIL(
     )
 
 
-def DisplayImagePIL(id, image, position, **kwargs):
-    width, height = image.size
-    encoded_image = pil_to_b64(image, enc_format="png")
+def DisplayImage(id, src, size, position, **kwargs):
+    width, height = size
 
     if width > height:
         return html.Img(
             id=f"img-{id}",
-            src=HTML_IMG_SRC_PARAMETERS + encoded_image,
+            src=src,
             height="45%",
             width="100%",
             style=dict(objectFit="contain"),
@@ -293,7 +330,7 @@ def DisplayImagePIL(id, image, position, **kwargs):
     else:
         return html.Img(
             id=f"img-{id}",
-            src=HTML_IMG_SRC_PARAMETERS + encoded_image,
+            src=src,
             style=dict(float=position, objectFit="contain"),
             width="50%",
             height="100%",
@@ -301,6 +338,12 @@ def DisplayImagePIL(id, image, position, **kwargs):
         )
 
 
+def DisplayImagePIL(id, image, position, **kwargs):
+    encoded_image = pil_to_b64(image, enc_format="png")
+
+    return DisplayImage(id, HTML_IMG_SRC_PARAMETERS + encoded_image, image.size, position, **kwargs)
+
+
 def CustomDropdown(**kwargs):
     return html.Div(
         dcc.Dropdown(**kwargs), style={"margin-top": "5px", "margin-bottom": "5px"}
@@ -311,6 +354,7 @@ def CustomSlider(title, min, max, step, value):
     labels = {str(min): min, str(max): max}
     return html.Div([
         html.P(id=f"val-{title}", children=title),
+        # value is only updated on release, drag_value follows the handle and drives the low resolution previews
         dcc.Slider(id=f'slider-{title}', min=min, max=max, step=step, value=value, marks=labels,
-                   updatemode='drag')
+                   updatemode='mouseup')
     ])
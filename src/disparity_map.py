@@ -1,5 +1,58 @@
 import cv2
 
+from timing import stage
+
+
+def to_grayscale(img):
+    """
+    Converts the image to the single channel format expected by the matchers. Already single channel
+    images are returned as they are.
+    :param img: numpy image
+    :return:
+    """
+    if len(img.shape) > 2:
+        if img.shape[2] == 4:
+            return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
+
+
+def read_grayscale(path):
+    """
+    Reads an image file into the grayscale format used by the app, which decodes uploads straight to grayscale
+    with OpenCV as well
+    :param path: image file
+    :return: uint8 grayscale array
+    """
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError(f"Could not read image {path}")
+    return img
+
+
+def rectify_pair(left_img, right_img, rectifier):
+    """
+    Undistorts and rectifies a pair in front of the matchers, see rectification.Rectifier. Uncalibrated pairs must
+    already be rectified.
+    """
+    with stage("rectify"):
+        return rectifier(left_img, right_img)
+
+
+def sgbm_mode(use_dynamic_programming):
+    """
+    Maps the value of the "SGBM mode" radio items to the OpenCV constant
+    """
+    if use_dynamic_programming == "dp":
+        return cv2.StereoSGBM_MODE_HH
+    elif use_dynamic_programming == "3way":
+        return cv2.StereoSGBM_MODE_SGBM_3WAY
+    return cv2.StereoSGBM_MODE_SGBM
+
+
+def bm_prefilter_type(use_xsobel):
+    return cv2.STEREO_BM_PREFILTER_XSOBEL if use_xsobel else cv2.STEREO_BM_PREFILTER_NORMALIZED_RESPONSE
+
 
 def get_stereo_sgbm_object(min_disp=0, num_disp=64, block_size=5, p1=0, p2=0,
                            prefilter_cap=1, disp12maxdiff=-1, uniqueness_ratio=0, speckle_windows_size=0,
@@ -21,12 +74,7 @@ def get_stereo_sgbm_object(min_disp=0, num_disp=64, block_size=5, p1=0, p2=0,
     :param speckle_range:
     :return:
     """
-    if use_dynamic_programming == "dp":
-        mode = cv2.StereoSGBM_MODE_HH
-    elif use_dynamic_programming == "3way":
-        mode = cv2.StereoSGBM_MODE_SGBM_3WAY
-    else:
-        mode = cv2.StereoSGBM_MODE_SGBM
+    mode = sgbm_mode(use_dynamic_programming)
 
     stereo = cv2.StereoSGBM_create(minDisparity=min_disp,
                                    numDisparities=num_disp,
@@ -40,15 +88,15 @@ def get_stereo_sgbm_object(min_disp=0, num_disp=64, block_size=5, p1=0, p2=0,
                                    speckleRange=speckle_range,
                                    mode=mode)
 
-    print("\nComputing the disparity  map...")
     return stereo
 
 
 def generate_stereo_sgbm_disparity_map(left_img, right_img, min_disp=0, num_disp=64, block_size=5, p1=0, p2=0,
                                        prefilter_cap=1, disp12maxdiff=-1, uniqueness_ratio=0, speckle_windows_size=0,
-                                       speckle_range=0, use_dynamic_programming="default"):
+                                       speckle_range=0, use_dynamic_programming="default", rectifier=None):
     """
 
+    :param rectifier: optional rectification.Rectifier applied to the pair before matching
     :param use_dynamic_programming:
     :param prefilter_cap:
     :param left_img:
@@ -64,12 +112,7 @@ def generate_stereo_sgbm_disparity_map(left_img, right_img, min_disp=0, num_disp
     :param speckle_range:
     :return:
     """
-    if use_dynamic_programming == "dp":
-        mode = cv2.StereoSGBM_MODE_HH
-    elif use_dynamic_programming == "3way":
-        mode = cv2.StereoSGBM_MODE_SGBM_3WAY
-    else:
-        mode = cv2.StereoSGBM_MODE_SGBM
+    mode = sgbm_mode(use_dynamic_programming)
 
     stereo = cv2.StereoSGBM_create(minDisparity=min_disp,
                                    numDisparities=num_disp,
@@ -83,11 +126,10 @@ def generate_stereo_sgbm_disparity_map(left_img, right_img, min_disp=0, num_disp
                                    speckleRange=speckle_range,
                                    mode=mode)
 
-    print("\nComputing the disparity  map...")
-    if len(left_img.shape) > 2:
-        left_img = cv2.cvtColor(left_img, cv2.COLOR_BGR2GRAY)
-    if len(right_img.shape) > 2:
-        right_img = cv2.cvtColor(right_img, cv2.COLOR_BGR2GRAY)
+    left_img = to_grayscale(left_img)
+    right_img = to_grayscale(right_img)
+    if rectifier is not None:
+        left_img, right_img = rectify_pair(left_img, right_img, rectifier)
     disparity_map = stereo.compute(left_img, right_img)
 
     return disparity_map
@@ -114,7 +156,7 @@ def get_stereo_bm_object(min_disp=0, num_disp=64, block_size=5, prefilter_cap=1,
     :param use_xsobel:
     :return:
     """
-    prefilter_type = cv2.STEREO_BM_PREFILTER_XSOBEL if use_xsobel else cv2.STEREO_BM_PREFILTER_NORMALIZED_RESPONSE
+    prefilter_type = bm_prefilter_type(use_xsobel)
 
     stereo = cv2.StereoBM_create(numDisparities=num_disp, blockSize=block_size)
     stereo.setPreFilterCap(prefilter_cap)
@@ -133,9 +175,10 @@ def get_stereo_bm_object(min_disp=0, num_disp=64, block_size=5, prefilter_cap=1,
 def generate_stereo_bm_disparity_map(left_img, right_img, min_disp=0, num_disp=64, block_size=5, prefilter_cap=1,
                                      disp12maxdiff=-1, uniqueness_ratio=0, speckle_windows_size=0,
                                      speckle_range=0, prefilter_size=5, texture_threshold=0,
-                                     use_xsobel=False):
+                                     use_xsobel=False, rectifier=None):
     """
 
+    :param rectifier: optional rectification.Rectifier applied to the pair before matching
     :param left_img:
     :param right_img:
     :param min_disp:
@@ -151,7 +194,7 @@ def generate_stereo_bm_disparity_map(left_img, right_img, min_disp=0, num_disp=6
     :param use_xsobel:
     :return:
     """
-    prefilter_type = cv2.STEREO_BM_PREFILTER_XSOBEL if use_xsobel else cv2.STEREO_BM_PREFILTER_NORMALIZED_RESPONSE
+    prefilter_type = bm_prefilter_type(use_xsobel)
 
     stereo = cv2.StereoBM_create(numDisparities=num_disp, blockSize=block_size)
     stereo.setPreFilterCap(prefilter_cap)
@@ -163,12 +206,10 @@ def generate_stereo_bm_disparity_map(left_img, right_img, min_disp=0, num_disp=6
     stereo.setPreFilterSize(prefilter_size)
     stereo.setTextureThreshold(texture_threshold)
     stereo.setPreFilterType(prefilter_type)
-    if len(left_img.shape) > 2:
-        left_img = cv2.cvtColor(left_img, cv2.COLOR_BGR2GRAY)
-    if len(right_img.shape) > 2:
-        right_img = cv2.cvtColor(right_img, cv2.COLOR_BGR2GRAY)
-
-    print("\nComputing the disparity  map...")
+    left_img = to_grayscale(left_img)
+    right_img = to_grayscale(right_img)
+    if rectifier is not None:
+        left_img, right_img = rectify_pair(left_img, right_img, rectifier)
     disparity_map = stereo.compute(left_img, right_img)
 
     return disparity_map
@@ -0,0 +1,77 @@
+import math
+import os
+
+import cv2
+import numpy as np
+
+from timing import stage
+
+# Disparity maps larger than this are sampled on a regular grid (every n-th row and column) for the statistics
+STATS_MAX_PIXELS = int(os.environ.get("STEREO_STATS_MAX_PIXELS", 1 << 19))
+# Histograms with more bins are decimated by summing neighboring bins
+STATS_MAX_BINS = int(os.environ.get("STEREO_STATS_MAX_BINS", 256))
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# int16 maps are counted over their whole range, the offset moves the negative values first
+_INT16_OFFSET = 1 << 15
+
+
+def _counts(values):
+    """
+    :return: number of pixels of each value, indexed by value + offset, and the offset
+    """
+    values = np.ascontiguousarray(values).reshape(-1)
+    if values.dtype == np.int16:
+        # bincount of the unsigned view is the fastest way to count int16 values: negative values land in the
+        # upper half, swapped back below
+        counts = np.bincount(values.view(np.uint16), minlength=1 << 16)
+        return np.concatenate((counts[_INT16_OFFSET:], counts[:_INT16_OFFSET])), _INT16_OFFSET
+    return np.bincount(values.astype(np.intp, copy=False), minlength=256), 0
+
+
+def disparity_statistics(disparity_map, min_disp, num_disp, mask=None, scale=1.0, max_pixels=STATS_MAX_PIXELS,
+                         max_bins=STATS_MAX_BINS):
+    """
+    Statistics of a disparity map as output by the matchers, at subpixel resolution for the int16 fixed-point maps
+    of StereoBM/SGBM (1/16 pixel) and pixel resolution for the 8 bit WLS output. Pixels outside
+    [min_disp, min_disp + num_disp) are invalid. Everything is derived from one bincount of the map, so the cost
+    is a pass over at most max_pixels pixels.
+    :param min_disp: minimum disparity the map was computed with
+    :param num_disp: number of disparities the map was computed with
+    :param mask: optional uint8 mask of the pixels to count (e.g. a lasso selection), non-zero inside
+    :param scale: factor converting the disparities to full resolution pixels (2 ** level for previews)
+    :return: dictionary with the number of counted pixels, the valid count and ratio, the percentiles of the
+        valid disparities as [percentile, disparity] pairs (None when none is valid) and the histogram as its first
+        bin, bin width and counts
+    """
+    with stage("stats"):
+        subpixel = cv2.StereoMatcher_DISP_SCALE if disparity_map.dtype == np.int16 else 1
+        stride = 1
+        if mask is not None:
+            values = disparity_map[mask > 0]
+        else:
+            stride = max(1, math.ceil(math.sqrt(disparity_map.size / max_pixels)))
+            values = disparity_map[::stride, ::stride]
+        counts, offset = _counts(values)
+
+        low = min(max(0, min_disp * subpixel + offset), len(counts))
+        high = min(max(low, (min_disp + num_disp) * subpixel + offset), len(counts))
+        histogram = counts[low:high]
+        # Disparity of the first bin, min_disp unless the map cannot represent it (negative in 8 bit maps)
+        first = (low - offset) / subpixel
+        pixels = int(values.size)
+        valid = int(histogram.sum())
+
+        percentiles = None
+        if valid:
+            cumulative = np.cumsum(histogram)
+            ranks = np.searchsorted(cumulative, [valid * q / 100.0 for q in PERCENTILES])
+            percentiles = [[q, float((first + rank / subpixel) * scale)] for q, rank in zip(PERCENTILES, ranks)]
+
+        factor = max(1, math.ceil(len(histogram) / max_bins))
+        if factor > 1:
+            histogram = np.pad(histogram, (0, -len(histogram) % factor)).reshape(-1, factor).sum(axis=1)
+
+    return dict(pixels=pixels, valid=valid, valid_ratio=valid / pixels if pixels else 0.0, percentiles=percentiles,
+                start=float(first * scale), step=float(factor * scale / subpixel), counts=histogram.tolist(),
+                stride=stride)
@@ -0,0 +1,241 @@
+import argparse
+import json
+import mmap
+import re
+
+import cv2
+import numpy as np
+
+THRESHOLDS = (1.0, 2.0, 4.0)
+# KITTI 16 bit PNGs store 256 x disparity, the ones written by batch.py 16 x disparity
+GROUND_TRUTH_PNG_SCALE = 256.0
+BATCH_PNG_SCALE = 16.0
+
+_PFM_HEADER = re.compile(rb"(P[Ff])\s+(\d+)\s+(\d+)\s+([-+0-9.eE]+)\s")
+
+
+def read_pfm(path):
+    """
+    Maps a PFM file (Middlebury ground truth) without reading it: the returned array is a read-only view of the
+    file pages, flipped to the top-down row order of images.
+    :return: float32 array, (height, width) or (height, width, 3). Middlebury marks unknown pixels with inf.
+    """
+    with open(path, "rb") as infile:
+        header = infile.read(256)
+        match = _PFM_HEADER.match(header)
+        if match is None:
+            raise IOError(f"{path} is not a PFM file")
+        kind, width, height, scale = match.group(1), int(match.group(2)), int(match.group(3)), float(match.group(4))
+        shape = (height, width, 3) if kind == b"PF" else (height, width)
+        # A negative scale means little-endian data
+        dtype = np.dtype("<f4" if scale < 0 else ">f4")
+        data = np.memmap(infile, dtype=dtype, mode="r", offset=match.end(), shape=shape)
+    if dtype != np.float32:
+        data = data.astype(np.float32)
+    return data[::-1]
+
+
+def write_pfm(path, disparity):
+    """
+    Writes a single channel float32 PFM (little-endian, bottom-up rows)
+    """
+    disparity = np.asarray(disparity, np.float32)
+    height, width = disparity.shape
+    with open(path, "wb") as outfile:
+        outfile.write(f"Pf\n{width} {height}\n-1.0\n".encode("ascii"))
+        outfile.write(np.ascontiguousarray(disparity[::-1]).astype("<f4").tobytes())
+
+
+def read_png_disparity(path, scale=GROUND_TRUTH_PNG_SCALE):
+    """
+    Reads a 16 bit PNG disparity storing scale x disparity, 0 for unknown pixels. The file is memory-mapped and
+    decoded from the mapped pages, without an intermediate copy of its bytes.
+    :return: float32 disparities with NaN for unknown pixels
+    """
+    with open(path, "rb") as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        raw = cv2.imdecode(np.frombuffer(mapped, np.uint8), cv2.IMREAD_UNCHANGED)
+    if raw is None or raw.dtype != np.uint16 or raw.ndim != 2:
+        raise IOError(f"{path} is not a 16 bit single channel PNG")
+    disparity = raw.astype(np.float32)
+    disparity /= scale
+    disparity[raw == 0] = np.nan
+    return disparity
+
+
+def load_ground_truth(path, scale=GROUND_TRUTH_PNG_SCALE):
+    """
+    Reads a ground truth disparity: PFM (Middlebury), 16 bit PNG storing scale x disparity with 0 for unknown
+    pixels (KITTI) or .npy arrays in pixels, the last two memory-mapped
+    :return: float32 array in pixels, unknown pixels are not finite (NaN, or inf in Middlebury PFMs)
+    """
+    if path.endswith(".pfm"):
+        disparity = read_pfm(path)
+        return disparity[..., 0] if disparity.ndim == 3 else disparity
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r").astype(np.float32, copy=False)
+    return read_png_disparity(path, scale)
+
+
+def load_disparity(path):
+    """
+    Reads a disparity map written by batch.py: png16 (16 x disparity, 0 for invalid pixels) or npy (matcher
+    output, see evaluate_batch)
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return read_png_disparity(path, BATCH_PNG_SCALE)
+
+
+def _fill_disparity(out, disparity_map, min_disp, roi=None):
+    """
+    Writes the disparities of a map in pixels to out, NaN for invalid pixels
+    :param roi: (x, y, w, h) of the valid pixels, e.g. the ROI returned with the WLS output
+    """
+    out = out.reshape(disparity_map.shape)
+    if disparity_map.dtype == np.int16:
+        # Fixed-point output of StereoBM/SGBM, invalid pixels are below min_disp
+        np.multiply(disparity_map, 1.0 / cv2.StereoMatcher_DISP_SCALE, out=out)
+        out[disparity_map < min_disp * cv2.StereoMatcher_DISP_SCALE] = np.nan
+    else:
+        # 8 bit WLS output (already in pixels, dense) or float disparities with NaN for invalid pixels
+        out[...] = disparity_map
+    if roi is not None:
+        x, y, w, h = roi
+        outside = np.ones(disparity_map.shape, bool)
+        outside[y:y + h, x:x + w] = False
+        out[outside] = np.nan
+
+
+def evaluate_batch(disparity_maps, ground_truths, min_disps=0, thresholds=THRESHOLDS, masks=None, rois=None):
+    """
+    Error metrics of many disparity maps against their ground truth in one call. Every metric of a pair is a
+    vectorized pass over its pixels, computed in place in scratch buffers shared by all the pairs.
+
+    Only pixels with a known ground truth are evaluated. Pixels without a computed disparity count as bad in the
+    bad-N rates, EPE and RMSE are measured on the pixels with both, and the density is their share of the known
+    pixels.
+    :param disparity_maps: matcher outputs (int16 fixed-point of generate_*_disparity_map, whose pixels below
+        min_disp are invalid, or the uint8 WLS output of filtering) or float arrays in pixels with NaN for invalid
+        pixels
+    :param ground_truths: float arrays in pixels of the same shapes, unknown pixels not finite
+    :param min_disps: minimum disparity of every map, or one value for all
+    :param thresholds: errors (pixels) of the bad-N rates
+    :param masks: optional boolean arrays restricting the evaluated pixels (e.g. non-occluded)
+    :param rois: optional (x, y, w, h) per map, pixels outside have no computed disparity. The WLS filter leaves
+        garbage outside the ROI it returns.
+    :return: one dictionary per pair with the known pixel count, density, epe, rmse and bad_<N> rates
+    """
+    count = len(disparity_maps)
+    if len(ground_truths) != count:
+        raise ValueError(f"{count} disparity maps but {len(ground_truths)} ground truths")
+    if np.isscalar(min_disps):
+        min_disps = [min_disps] * count
+    sizes = []
+    for disparity_map, ground_truth in zip(disparity_maps, ground_truths):
+        if disparity_map.shape != ground_truth.shape:
+            raise ValueError(f"Disparity map {disparity_map.shape} and ground truth {ground_truth.shape} differ")
+        if disparity_map.size == 0:
+            raise ValueError("Empty disparity map")
+        sizes.append(disparity_map.size)
+    if not count:
+        return []
+
+    # Scratch buffers of the largest pair, reused by every pair: the passes over a pair stay in the CPU caches
+    largest = max(sizes)
+    disparity = np.empty(largest, np.float32)
+    truth = np.empty(largest, np.float32)
+    known = np.empty(largest, bool)
+    valid = np.empty(largest, bool)
+    scratch = np.empty(largest, bool)
+
+    results = []
+    for i, (disparity_map, ground_truth) in enumerate(zip(disparity_maps, ground_truths)):
+        size = sizes[i]
+        error, pair_truth, pair_known, pair_valid, pair_scratch = \
+            disparity[:size], truth[:size], known[:size], valid[:size], scratch[:size]
+        _fill_disparity(error, disparity_map, min_disps[i], rois[i] if rois is not None else None)
+        pair_truth.reshape(ground_truth.shape)[...] = ground_truth
+
+        np.isfinite(pair_truth, out=pair_known)
+        if masks is not None and masks[i] is not None:
+            pair_known &= np.asarray(masks[i], bool).reshape(-1)
+        np.isfinite(error, out=pair_valid)
+        pair_valid &= pair_known
+        # Errors of the pixels with both disparities, 0 elsewhere
+        np.subtract(error, pair_truth, out=error)
+        np.abs(error, out=error)
+        np.logical_not(pair_valid, out=pair_scratch)
+        error[pair_scratch] = 0
+
+        known_count, valid_count = int(np.count_nonzero(pair_known)), int(np.count_nonzero(pair_valid))
+        error_sum = float(error.sum(dtype=np.float64))
+        squared_sum = float(np.dot(error, error))
+        result = dict(pixels=known_count, density=valid_count / known_count if known_count else 0.0,
+                      epe=error_sum / valid_count if valid_count else None,
+                      rmse=float(np.sqrt(squared_sum / valid_count)) if valid_count else None)
+        for threshold in thresholds:
+            # Known pixels without a computed disparity are bad as well
+            np.greater(error, threshold, out=pair_scratch)
+            bad_count = int(np.count_nonzero(pair_scratch)) + known_count - valid_count
+            result[f"bad_{threshold:g}"] = bad_count / known_count if known_count else None
+        results.append(result)
+    return results
+
+
+def evaluate_disparity(disparity_map, ground_truth, min_disp=0, thresholds=THRESHOLDS, mask=None, roi=None):
+    """
+    Error metrics of one disparity map, see evaluate_batch
+    """
+    return evaluate_batch([disparity_map], [ground_truth], min_disp, thresholds, None if mask is None else [mask],
+                          None if roi is None else [roi])[0]
+
+
+def summarize(results):
+    """
+    :return: the mean of every metric over the pairs where it is defined
+    """
+    summary = {}
+    for name in results[0] if results else []:
+        values = [result[name] for result in results if result[name] is not None]
+        summary[name] = float(np.mean(values)) if values else None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluates disparity maps against ground truth')
+    parser.add_argument('-d', '--disparities', nargs='+', required=True,
+                        help='Disparity maps written by batch.py (png16 or npy)')
+    parser.add_argument('-g', '--ground-truth', nargs='+', required=True,
+                        help='Ground truth disparities in the same order (.pfm, 16 bit PNG or .npy)')
+    parser.add_argument('--gt-scale', default=GROUND_TRUTH_PNG_SCALE, type=float,
+                        help='Scale of the ground truth PNGs (default 256, KITTI)')
+    parser.add_argument('--min-disp', default=0, type=int, help='Minimum disparity of int16 npy maps')
+    parser.add_argument('-t', '--thresholds', default=list(THRESHOLDS), type=float, nargs='+')
+    parser.add_argument('-o', '--output', default=None, help='Write the metrics to this JSON file')
+    args = parser.parse_args()
+    if len(args.disparities) != len(args.ground_truth):
+        parser.error("--disparities and --ground-truth must have the same length")
+
+    disparity_maps = [load_disparity(path) for path in args.disparities]
+    ground_truths = [load_ground_truth(path, args.gt_scale) for path in args.ground_truth]
+    results = evaluate_batch(disparity_maps, ground_truths, args.min_disp, tuple(args.thresholds))
+
+    names = [name for name in results[0] if name != "pixels"]
+    print(f"{'':<40}" + "".join(f"{name:>10}" for name in names))
+    for path, result in zip(args.disparities, results):
+        print(f"{path[-40:]:<40}" + "".join(f"{result[name]:>10.4f}" if result[name] is not None else f"{'-':>10}"
+                                            for name in names))
+    summary = summarize(results)
+    print(f"{'mean':<40}" + "".join(f"{summary[name]:>10.4f}" if summary[name] is not None else f"{'-':>10}"
+                                    for name in names))
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            pairs = [dict(result, disparity=path, ground_truth=ground_truth_path)
+                     for path, ground_truth_path, result in zip(args.disparities, args.ground_truth, results)]
+            json.dump(dict(pairs=pairs, mean=summary), outfile, indent=2)
+            print(f"Saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
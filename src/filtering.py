@@ -1,22 +1,71 @@
 import cv2
 import numpy as np
 
+from disparity_map import to_grayscale
+from timing import stage
 
-def filtering(left_matcher, left, right, lmbda=8000, sigma=1.0):
-    right_matcher = cv2.ximgproc.createRightMatcher(left_matcher)
 
-    left = cv2.cvtColor(left, cv2.COLOR_BGR2GRAY)
-    right = cv2.cvtColor(right, cv2.COLOR_BGR2GRAY)
+def compute_raw_disparities(left_matcher, left, right, right_matcher=None, check=None):
+    """
+    Computes the left and right disparities the WLS filter is applied on. They do not depend on lambda and
+    sigma, so they can be cached and filtered again when only those change.
+    :param left_matcher: configured StereoBM/StereoSGBM object
+    :param right_matcher: matcher for the right view. Created from left_matcher if not given
+    :param check: optional function called after each matcher, it can raise to abort the computation
+    :return: left and right int16 disparity maps. The right map matches the right view against the left one, as
+        the WLS filter expects: with the views in the left matcher's order it is meaningless
+    """
+    with stage("setup"):
+        if right_matcher is None:
+            right_matcher = cv2.ximgproc.createRightMatcher(left_matcher)
 
-    left_disp = left_matcher.compute(left, right)
-    right_disp = right_matcher.compute(left, right)
+    left = to_grayscale(left)
+    right = to_grayscale(right)
 
-    displ = np.int16(left_disp)
-    dispr = np.int16(right_disp)
+    with stage("compute"):
+        left_disp = left_matcher.compute(left, right)
+    if check is not None:
+        check()
+    with stage("compute"):
+        right_disp = right_matcher.compute(right, left)
+    if check is not None:
+        check()
 
-    wls_filter = cv2.ximgproc.createDisparityWLSFilter(left_matcher)
-    wls_filter.setLambda(lmbda)
-    wls_filter.setSigmaColor(sigma)
-    filtered_disp = wls_filter.filter(displ, left, disparity_map_right=dispr)
+    return np.int16(left_disp), np.int16(right_disp)
+
+
+def apply_wls_filter(left_matcher, left, left_disp, right_disp, lmbda=8000, sigma=1.0, wls_filter=None):
+    """
+    Applies the WLS filter on disparities computed by compute_raw_disparities
+    :param left_matcher: matcher the disparities were computed with
+    :param left: left image, guides the filter
+    :param wls_filter: DisparityWLSFilter, already configured with lambda and sigma. Created if not given
+    :return: the filtered disparity map and the ROI of valid pixels
+    """
+    with stage("setup"):
+        if wls_filter is None:
+            wls_filter = cv2.ximgproc.createDisparityWLSFilter(left_matcher)
+            wls_filter.setLambda(lmbda)
+            wls_filter.setSigmaColor(sigma)
+    with stage("wls"):
+        filtered_disp = wls_filter.filter(left_disp, to_grayscale(left), disparity_map_right=right_disp)
 
     return (filtered_disp * 1 / 16.0).astype(np.uint8), wls_filter.getROI()
+
+
+def filtering(left_matcher, left, right, lmbda=8000, sigma=1.0, right_matcher=None, wls_filter=None,
+              check=None):
+    """
+    Computes the left and right disparities and applies the WLS filter on them
+    :param left_matcher: configured StereoBM/StereoSGBM object
+    :param right_matcher: matcher for the right view. Created from left_matcher if not given
+    :param wls_filter: DisparityWLSFilter, already configured with lambda and sigma. Created if not given
+    :param check: optional function called between the stages, it can raise to abort the computation
+    :return: the filtered disparity map and the ROI of valid pixels
+    """
+    # The disparities are computed before creating the WLS filter: createDisparityWLSFilter changes some
+    # settings of the left matcher
+    left_disp, right_disp = compute_raw_disparities(left_matcher, left, right, right_matcher=right_matcher,
+                                                    check=check)
+    return apply_wls_filter(left_matcher, left, left_disp, right_disp, lmbda=lmbda, sigma=sigma,
+                            wls_filter=wls_filter)
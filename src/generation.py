@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+
+from cache import LRUCache, get_redis_client, redis
+from image_store import content_hash, image_store
+
+GENERATIONS_NAMESPACE = "generations"
+
+logger = logging.getLogger(__name__)
+
+
+class Superseded(Exception):
+    """
+    Raised at a checkpoint of a computation when a newer request of the same session has started
+    """
+
+
+class GenerationTracker:
+    """
+    Latest-wins bookkeeping of the disparity requests of each session. Every request takes a new generation
+    number when it starts; older requests of the same session check their number at cheap checkpoints and
+    stop as soon as they are no longer the latest, instead of computing, encoding and returning a result that
+    the browser would replace right away.
+
+    When Redis is configured the counters live there, so requests of one session handled by different
+    gunicorn workers see each other. Otherwise the generations are nanosecond timestamps, increasing across the
+    processes of the machine, and the latest one of each session is written to a small file of the image store
+    that every worker reads at the checkpoints.
+
+    A gunicorn sync worker handles one request at a time: a newer request can only supersede a running one when
+    another worker (or the job and prefetch threads) serves it. With a single worker, the checkpoints of the
+    request path never fire and only those of the job queue and prefetch threads do.
+    """
+
+    STAGES = ("before_compute", "during_compute", "before_encode")
+
+    def __init__(self, prefix="stereo-generation:", ttl=3600, store=image_store, namespace=GENERATIONS_NAMESPACE):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.store = store
+        self.namespace = namespace
+        self._local = LRUCache(max_entries=4096)
+        self._last = 0
+        self._lock = threading.Lock()
+        self.started = 0
+        self.completed = 0
+        self.coalesced = {stage: 0 for stage in self.STAGES}
+
+    def begin(self, session_id):
+        """
+        Registers a new request of the session
+        :return: generation number of the request
+        """
+        self.started += 1
+        client = get_redis_client()
+        if client is not None:
+            try:
+                key = self.prefix + session_id
+                pipe = client.pipeline()
+                pipe.incr(key)
+                pipe.expire(key, self.ttl)
+                return pipe.execute()[0]
+            except redis.RedisError as e:
+                logger.warning("Redis generation tracking unavailable: %s", e)
+
+        with self._lock:
+            generation = self._last = max(time.time_ns(), self._last + 1)
+            self._local.put(session_id, generation)
+        # Concurrent writers may leave an older generation in the file: the newer request then merely runs to
+        # the end, a request is never stopped by an older one
+        shared = self._shared(session_id)
+        if shared is None or generation > shared:
+            try:
+                self.store.write(self.namespace, self._key(session_id), str(generation).encode("ascii"))
+            except OSError as e:
+                logger.warning("Shared generation tracking unavailable: %s", e)
+        return generation
+
+    def _key(self, session_id):
+        return content_hash(session_id.encode("utf-8"))
+
+    def _shared(self, session_id):
+        data = self.store.get(self.namespace, self._key(session_id))
+        return int(data) if data else None
+
+    def latest(self, session_id):
+        client = get_redis_client()
+        if client is not None:
+            try:
+                value = client.get(self.prefix + session_id)
+                if value is not None:
+                    return int(value)
+            except redis.RedisError:
+                pass
+        local, shared = self._local.get(session_id), self._shared(session_id)
+        if local is None or shared is None:
+            return shared if local is None else local
+        return max(local, shared)
+
+    def is_current(self, session_id, generation):
+        latest = self.latest(session_id)
+        return latest is None or generation >= latest
+
+    def checkpoint(self, session_id, generation, stage):
+        """
+        Raises Superseded (and counts it for the stage) if a newer request of the session has started
+        """
+        if not self.is_current(session_id, generation):
+            self.coalesced[stage] += 1
+            raise Superseded(f"request {generation} of session {session_id} superseded {stage.replace('_', ' ')}")
+
+    def checker(self, session_id, generation, stage="during_compute"):
+        """
+        :return: a function without arguments that runs the checkpoint, to be passed to the compute functions
+        """
+        return lambda: self.checkpoint(session_id, generation, stage)
+
+    def done(self):
+        self.completed += 1
+
+    def stats(self):
+        return dict(started=self.started,
+                    completed=self.completed,
+                    coalesced=dict(self.coalesced, total=sum(self.coalesced.values())))
+
+
+generations = GenerationTracker()
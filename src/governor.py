@@ -0,0 +1,129 @@
+import json
+import math
+import os
+
+import cv2
+
+from jobs import JOB_WORKERS
+
+# Overrides of the detected layout
+WORKERS = os.environ.get("STEREO_WORKERS")
+CV_THREADS = os.environ.get("STEREO_CV_THREADS")
+# Every worker keeps its own caches, the heuristic does not start more than this many
+MAX_WORKERS = int(os.environ.get("STEREO_MAX_WORKERS", 8))
+# Layout saved by `benchmark.py layouts --save`, used when it was measured with the same number of cores
+LAYOUT_FILE = os.environ.get("STEREO_LAYOUT_FILE", "./stereo_layout.json")
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Layout applied to this process by apply_layout
+_applied = {}
+
+
+def cgroup_cpu_quota(root=CGROUP_ROOT):
+    """
+    CPU limit of the container from the cgroup v2 cpu.max file, or the cgroup v1 CFS quota and period
+    :return: number of CPUs the quota allows (e.g. 1.5), None when there is no quota
+    """
+    try:
+        with open(os.path.join(root, "cpu.max")) as infile:
+            quota, period = infile.read().split()[:2]
+        if quota != "max":
+            return int(quota) / float(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(root, "cpu", "cpu.cfs_quota_us")) as infile:
+            quota = int(infile.read())
+        with open(os.path.join(root, "cpu", "cpu.cfs_period_us")) as infile:
+            period = int(infile.read())
+        if quota > 0 and period > 0:
+            return quota / float(period)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cores():
+    """
+    Cores this process can actually use: the CPUs of its affinity mask, capped by the cgroup quota (rounded up,
+    a quota of 1.5 CPUs still runs two threads in parallel part of the time)
+    :return: (number of cores, cgroup quota or None)
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cores = max(1, min(cores, int(math.ceil(quota))))
+    return cores, quota
+
+
+def default_layout(cores, job_workers=JOB_WORKERS):
+    """
+    Heuristic layout: about two cores per gunicorn worker, with at most MAX_WORKERS workers and at least two
+    unless there is a single core, so a page load never waits for a busy worker. The cores are split between all
+    the computations that can run at the same time, so the OpenCV thread pools never oversubscribe the machine.
+    :param job_workers: computations per worker (the job queue threads, or the request itself without them)
+    :return: (gunicorn workers, OpenCV threads per computation)
+    """
+    workers = min(cores, MAX_WORKERS, max(2, cores // 2))
+    concurrent = workers * max(1, job_workers)
+    return workers, max(1, cores // concurrent)
+
+
+def load_layout_file(path, cores):
+    """
+    :return: (workers, threads) saved by the layout sweep when it ran on the same number of cores, else None
+    """
+    try:
+        with open(path) as infile:
+            saved = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if saved.get("cores") != cores:
+        print(f"Ignoring {path}: measured on {saved.get('cores')} cores, {cores} available")
+        return None
+    return int(saved["workers"]), int(saved["threads"])
+
+
+def choose_layout(layout_file=LAYOUT_FILE, job_workers=JOB_WORKERS):
+    """
+    Picks the number of gunicorn workers and OpenCV threads: explicit STEREO_WORKERS / STEREO_CV_THREADS first,
+    then the layout measured by the sweep, then the heuristic
+    :return: layout dictionary
+    """
+    cores, quota = available_cores()
+    source = "heuristic"
+    workers, threads = default_layout(cores, job_workers)
+    saved = load_layout_file(layout_file, cores) if layout_file else None
+    if saved is not None:
+        workers, threads = saved
+        source = layout_file
+    if WORKERS:
+        workers, source = int(WORKERS), "environment"
+        threads = max(1, cores // (workers * max(1, job_workers)))
+    if CV_THREADS:
+        threads, source = int(CV_THREADS), "environment"
+    return dict(cores=cores, cgroup_quota=quota, workers=workers, job_workers=job_workers, threads=threads,
+                source=source)
+
+
+def apply_layout(layout):
+    """
+    Sets the OpenCV thread pool size of the current process. Called in every gunicorn worker after the fork,
+    since the pool of the master is not inherited.
+    """
+    cv2.setNumThreads(layout["threads"])
+    _applied.clear()
+    _applied.update(layout, pid=os.getpid())
+
+
+def current_layout():
+    """
+    :return: layout applied to this process (empty when apply_layout was not called, e.g. with the Flask
+        development server) and the actual OpenCV thread count
+    """
+    return dict(_applied, opencv_threads=cv2.getNumThreads(), pid=os.getpid())
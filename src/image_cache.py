@@ -0,0 +1,145 @@
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from PIL import ImageOps
+
+import dash_reusable_components as drc
+from cache import LRUCache
+from image_store import image_store
+from timing import stage
+
+DECODED_CACHE_MB = int(os.environ.get("STEREO_DECODED_CACHE_MB", 256))
+
+# JPEG decoders can scale the DCT blocks down, which decodes a preview level in a fraction of the full decode
+# time. Other formats are decoded in full before resizing, for them the levels are computed with cv2.pyrDown.
+REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_REDUCED_GRAYSCALE_2, 2: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                        3: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# gray: uint8 single channel array ready to be passed to the matchers
+# color: decoded array used for display (only kept when requested, e.g. for the left image)
+DecodedImage = namedtuple("DecodedImage", ["gray", "color"])
+
+decoded_images = LRUCache(max_bytes=DECODED_CACHE_MB * 1024 * 1024)
+
+
+def is_jpeg(image_bytes):
+    return image_bytes[:3] == b"\xff\xd8\xff"
+
+
+def decode_pil(image_bytes):
+    """
+    Decodes with PIL, upright: cv2.imdecode applies the EXIF orientation of JPEGs, PIL does not by itself
+    :return: PIL image
+    """
+    return ImageOps.exif_transpose(drc.bytes_to_pil(image_bytes))
+
+
+def decode_gray(image_bytes, flags=cv2.IMREAD_GRAYSCALE):
+    """
+    Decodes encoded image bytes straight to a single channel array with OpenCV, without the RGB intermediate.
+    Formats OpenCV cannot read (e.g. GIF) go through PIL.
+    :param flags: cv2.IMREAD_GRAYSCALE, or one of the IMREAD_REDUCED_GRAYSCALE flags
+    :return: uint8 grayscale array
+    """
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flags)
+    if gray is None:
+        if flags != cv2.IMREAD_GRAYSCALE:
+            raise ValueError("Reduced decoding is only supported for formats OpenCV reads")
+        # PIL decodes to RGB(A) and not BGR: its own luma conversion keeps the channel weights right
+        gray = np.asarray(decode_pil(image_bytes).convert("L"))
+    return np.ascontiguousarray(gray, dtype=np.uint8)
+
+
+def load_decoded(namespace, key, with_color=False):
+    """
+    Returns the decoded image stored under (namespace, key) in the image store. Decoding and color conversion
+    happen only on the first request for a given content hash, later calls are served from memory.
+    :param namespace: session id the image was uploaded with
+    :param key: content hash of the image
+    :param with_color: also keep the color image for display
+    :return: DecodedImage, or None if the image is not in the store
+    """
+    decoded = decoded_images.get(key)
+    if decoded is not None and (decoded.color is not None or not with_color):
+        # Keeps the upload of a session in use from being evicted from the store
+        image_store.touch(namespace, key)
+        return decoded
+
+    image_bytes = image_store.get(namespace, key)
+    if image_bytes is None:
+        return None
+    if decoded is None:
+        with stage("decode"):
+            gray = decode_gray(image_bytes)
+    else:
+        gray = decoded.gray
+    color = None
+    if with_color:
+        with stage("decode"):
+            color = np.asarray(decode_pil(image_bytes))
+    decoded = DecodedImage(gray=gray, color=color)
+    decoded_images.put(key, decoded)
+    return decoded
+
+
+def decode_upload(key, image_bytes, levels=3):
+    """
+    Decodes a new upload and its preview levels in one pass and caches them, so the first computations of the
+    session do not decode anything
+    :param key: content hash of the image
+    :param levels: number of pyramid levels to prepare
+    :return: shape of the full resolution grayscale image
+    """
+    with stage("decode"):
+        gray = decode_gray(image_bytes)
+    decoded_images.put(key, DecodedImage(gray=gray, color=None))
+    upper = gray
+    for level in range(1, levels + 1):
+        upper = _decode_level(image_bytes, level, lambda: upper)
+        decoded_images.put((key, level), upper)
+    return gray.shape
+
+
+def _decode_level(image_bytes, level, load_upper):
+    """
+    :param image_bytes: encoded image
+    :param load_upper: function returning the grayscale image of the level above, None if it is not available
+    :return: grayscale image of the pyramid level, or None
+    """
+    if level in REDUCED_DECODE_FLAGS and is_jpeg(image_bytes):
+        with stage("decode"):
+            return decode_gray(image_bytes, REDUCED_DECODE_FLAGS[level])
+    upper = load_upper()
+    if upper is None:
+        return None
+    with stage("pyramid"):
+        return cv2.pyrDown(upper)
+
+
+def load_pyramid_level(namespace, key, level):
+    """
+    Returns the grayscale image downsampled ``level`` times: decoded at that scale for JPEG images, computed
+    with cv2.pyrDown from the level above otherwise. Every level is cached, so each one is computed once.
+    :param namespace: session id the image was uploaded with
+    :param key: content hash of the image
+    :param level: pyramid level, 0 is the full resolution image
+    :return: uint8 grayscale array, or None if the image is not in the store
+    """
+    if level == 0:
+        decoded = load_decoded(namespace, key)
+        return None if decoded is None else decoded.gray
+
+    gray = decoded_images.get((key, level))
+    if gray is None:
+        image_bytes = image_store.get(namespace, key)
+        if image_bytes is None:
+            return None
+        gray = _decode_level(image_bytes, level, lambda: load_pyramid_level(namespace, key, level - 1))
+        if gray is None:
+            return None
+        decoded_images.put((key, level), gray)
+    else:
+        image_store.touch(namespace, key)
+    return gray
@@ -0,0 +1,249 @@
+import argparse
+import base64
+import csv
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import threading
+import uuid
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+DATA_MAGIC = b"STPKDAT1"
+INDEX_MAGIC = b"STPKIDX1"
+# Index entry: key (UUID bytes), offset and length of the record in the data file, kind, array shape
+# (height, width, channels; channels is 0 for a 2D array and the shape is unused for encoded images)
+_ENTRY = struct.Struct("<16sQQB3xIII")
+
+# Kinds of records
+ENCODED = 0
+ARRAY = 1
+
+PackEntry = namedtuple("PackEntry", ["offset", "length", "kind", "shape"])
+
+DECODE_FLAGS = dict(gray=cv2.IMREAD_GRAYSCALE, color=cv2.IMREAD_COLOR)
+
+
+def pack_key(key):
+    """
+    :param key: UUID as a string or uuid.UUID
+    :return: the 16 bytes of the UUID
+    :raise ValueError: when the key is not a UUID
+    """
+    return (key if isinstance(key, uuid.UUID) else uuid.UUID(str(key))).bytes
+
+
+class PackedImageStore:
+    """
+    Append-only image pack with an offset index, keyed by UUID.
+
+    Records are appended to the data file ``<path>`` and one fixed size entry per record to the index
+    ``<path>.idx``. The index is loaded into a dictionary, so a lookup is a dictionary access, and the data file is
+    memory-mapped: get returns a view of the mapped pages, without reading or copying the record. Records are
+    either encoded images (as uploaded, decoded by the caller) or uint8 arrays stored pre-decoded.
+
+    Appending a key again supersedes its previous record, which stays in the data file. Writers take an flock on
+    the index, so several processes can append to the same pack; readers pick up the new entries of other
+    processes on a lookup miss.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._index = {}
+        # Bytes of the index file already parsed
+        self._index_size = 0
+        self._map = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Parses the index entries appended since the last call, by this process or another one. A partially
+        written entry at the end is left for the next call.
+        """
+        try:
+            with open(self.index_path, "rb") as infile:
+                if self._index_size == 0:
+                    if infile.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                        raise ValueError(f"{self.index_path} is not an image pack index")
+                    self._index_size = len(INDEX_MAGIC)
+                infile.seek(self._index_size)
+                data = infile.read()
+        except FileNotFoundError:
+            return
+        count = len(data) // _ENTRY.size
+        for key, offset, length, kind, height, width, channels in _ENTRY.iter_unpack(data[:count * _ENTRY.size]):
+            shape = (height, width, channels) if channels else (height, width)
+            self._index[key] = PackEntry(offset, length, kind, shape)
+        self._index_size += count * _ENTRY.size
+
+    def _entry(self, key):
+        key = pack_key(key)
+        entry = self._index.get(key)
+        if entry is None:
+            with self._lock:
+                self.refresh()
+            entry = self._index.get(key)
+        return entry
+
+    def _mapped(self, end):
+        """
+        :return: a read-only map of the data file covering at least end bytes, remapped when the file grew
+        """
+        mapped = self._map
+        if mapped is None or len(mapped) < end:
+            with self._lock:
+                if self._map is None or len(self._map) < end:
+                    with open(self.path, "rb") as infile:
+                        # The previous map is not closed: arrays returned by get may still point to it
+                        self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+                mapped = self._map
+        return mapped
+
+    def get(self, key):
+        """
+        :param key: UUID
+        :return: a memoryview of the encoded image, or a read-only uint8 array for pre-decoded records. Both are
+            views of the mapped data file. None when the key is not in the pack.
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        mapped = self._mapped(entry.offset + entry.length)
+        if entry.kind == ARRAY:
+            return np.frombuffer(mapped, np.uint8, entry.length, entry.offset).reshape(entry.shape)
+        return memoryview(mapped)[entry.offset:entry.offset + entry.length]
+
+    def get_gray(self, key):
+        """
+        :return: grayscale uint8 image of the key, decoded from an encoded record or converted from an array, or
+            None when the key is not in the pack
+        """
+        image = self.get(key)
+        if image is None:
+            return None
+        if isinstance(image, memoryview):
+            return cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_GRAYSCALE)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim > 2 else image
+
+    def append(self, key, data):
+        """
+        Appends a record, superseding the previous record of the key if any
+        :param key: UUID
+        :param data: encoded image bytes, or uint8 array (2D, or 3D with the channels last) stored pre-decoded
+        """
+        key = pack_key(key)
+        if isinstance(data, np.ndarray):
+            if data.dtype != np.uint8 or data.ndim not in (2, 3):
+                raise ValueError(f"Only 2D or 3D uint8 arrays can be packed, got {data.dtype} {data.shape}")
+            kind, shape = ARRAY, data.shape + (0,) * (3 - data.ndim)
+            payload = np.ascontiguousarray(data)
+        else:
+            kind, shape, payload = ENCODED, (0, 0, 0), memoryview(data)
+        length = payload.nbytes
+
+        with self._lock, open(self.index_path, "ab") as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                with open(self.path, "ab") as data_file:
+                    if data_file.tell() == 0:
+                        data_file.write(DATA_MAGIC)
+                    offset = data_file.tell()
+                    data_file.write(payload)
+                if index_file.tell() == 0:
+                    index_file.write(INDEX_MAGIC)
+                # The entry is written after the record, so readers never see an entry without its data
+                index_file.write(_ENTRY.pack(key, offset, length, kind, *shape))
+                index_file.flush()
+            finally:
+                fcntl.flock(index_file, fcntl.LOCK_UN)
+            self.refresh()
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        """
+        :return: the UUIDs in the pack, as strings
+        """
+        return [str(uuid.UUID(bytes=key)) for key in self._index]
+
+    def stats(self):
+        try:
+            data_bytes = os.path.getsize(self.path)
+        except OSError:
+            data_bytes = 0
+        return dict(path=self.path, entries=len(self._index), data_bytes=data_bytes, index_bytes=self._index_size)
+
+
+def read_csv_images(path):
+    """
+    Reads a key,image CSV of base64 encoded images, such as image_string.csv
+    :return: generator of (key, encoded image bytes)
+    """
+    # A single image is larger than the default field limit of 128 KB
+    csv.field_size_limit(sys.maxsize)
+    with open(path, newline="") as infile:
+        for row in csv.DictReader(infile):
+            if row.get("key"):
+                yield row["key"], base64.b64decode(row["image"])
+
+
+def import_csv(csv_path, pack, decode=None):
+    """
+    Copies the images of a key,image CSV to a pack. Keys already in the pack are skipped, so the import can be
+    run again on a CSV that grew.
+    :param pack: PackedImageStore
+    :param decode: None to store the encoded bytes, "gray" or "color" to store decoded arrays
+    :return: number of images added
+    """
+    added = 0
+    for key, image_bytes in read_csv_images(csv_path):
+        if key in pack:
+            continue
+        data = image_bytes
+        if decode:
+            data = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), DECODE_FLAGS[decode])
+            if data is None:
+                raise ValueError(f"Could not decode the image of {key}")
+        pack.append(key, data)
+        added += 1
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Indexed, memory-mapped image packs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='Converts a key,image base64 CSV to a pack')
+    import_parser.add_argument('csv', help='CSV file, e.g. image_string.csv')
+    import_parser.add_argument('pack', help='Pack data file, the index is written next to it (.idx)')
+    import_parser.add_argument('--decode', default=None, choices=list(DECODE_FLAGS),
+                               help='Store decoded arrays instead of the encoded images')
+
+    list_parser = subparsers.add_parser('list', help='Lists the images of a pack')
+    list_parser.add_argument('pack')
+
+    args = parser.parse_args()
+    pack = PackedImageStore(args.pack)
+    if args.command == 'import':
+        added = import_csv(args.csv, pack, args.decode)
+        print(f"Added {added} images to {args.pack} ({len(pack)} images)")
+    else:
+        for key in pack.keys():
+            image = pack.get(key)
+            description = f"{image.nbytes} bytes encoded" if isinstance(image, memoryview) else \
+                f"{'x'.join(map(str, image.shape))} array"
+            print(f"{key}  {description}")
+
+
+if __name__ == "__main__":
+    main()
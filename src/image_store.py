@@ -0,0 +1,223 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+STORE_DIR = os.environ.get("STEREO_STORE_DIR", os.path.join(tempfile.gettempdir(), "stereo-tuner-store"))
+# Limits of the store, enforced by a sweep after writes: entries unused (neither written nor read) for
+# STORE_TTL_S seconds are deleted, then the least recently used ones until the store fits in STORE_MAX_MB
+STORE_MAX_MB = int(os.environ.get("STEREO_STORE_MAX_MB", 2048))
+STORE_TTL_S = int(os.environ.get("STEREO_STORE_TTL_S", 24 * 3600))
+# Minimum seconds between two sweeps of a process, unless a sixteenth of STORE_MAX_MB was written meanwhile
+STORE_SWEEP_INTERVAL_S = float(os.environ.get("STEREO_STORE_SWEEP_INTERVAL_S", 30))
+
+_NAMESPACE_RE = re.compile(r"^[0-9A-Za-z_-]{1,64}$")
+_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+def content_hash(data):
+    """
+    Hashes raw image bytes. The hash is used as the storage key, so uploading the same file twice
+    ends up in the same entry.
+    :param data: bytes
+    :return: hex digest
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+class ImageStore:
+    """
+    Server-side, content-addressed store for encoded image bytes.
+
+    Entries live on disk under ``<root>/<namespace>/<hash>`` so that every gunicorn worker sees the
+    same uploads. The namespace is the ``session-id`` generated by ``serve_layout``, which means the
+    browser only needs to keep a small handle (namespace + hash) instead of the whole image.
+
+    The store is bounded: writes trigger a sweep (at most every sweep_interval seconds per process) deleting the
+    entries not used for ttl seconds, then the least recently used ones until it fits in max_bytes. Reads refresh
+    the modification time of the entries, which is the last use shared by all the workers.
+    """
+
+    def __init__(self, root=STORE_DIR, max_bytes=STORE_MAX_MB * 1024 * 1024, ttl=STORE_TTL_S,
+                 sweep_interval=STORE_SWEEP_INTERVAL_S):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.evicted = 0
+        self._last_sweep = 0.0
+        self._written = 0
+        self._sweep_lock = threading.Lock()
+
+    def _path(self, namespace, key):
+        if not _NAMESPACE_RE.match(namespace or ""):
+            raise ValueError(f"Invalid store namespace: {namespace!r}")
+        if not _KEY_RE.match(key or ""):
+            raise ValueError(f"Invalid store key: {key!r}")
+        return os.path.join(self.root, namespace, key)
+
+    def put(self, namespace, data):
+        """
+        Stores the bytes (if not already present) and returns their key
+        :param namespace: session id
+        :param data: encoded image bytes
+        :return: content hash of the data
+        """
+        key = content_hash(data)
+        # Already stored entries are only marked as recently used
+        if not self.touch(namespace, key):
+            self.write(namespace, key, data)
+        return key
+
+    def write(self, namespace, key, data):
+        """
+        Stores the bytes under the given key, replacing the previous entry. Used for small mutable records
+        shared by the workers, such as the job status markers.
+        """
+        path = self._path(namespace, key)
+        directory = os.path.dirname(path)
+        # Write to a temporary file first so concurrent readers never see partial entries
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        except FileNotFoundError:
+            # New namespace, or an empty one just removed by a sweep
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._written += len(data)
+        self._maybe_sweep()
+
+    def get(self, namespace, key):
+        """
+        :return: the stored bytes, or None if the entry does not exist
+        """
+        try:
+            path = self._path(namespace, key)
+            with open(path, "rb") as f:
+                data = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            # Marks the entry as recently used for the sweeps of every worker
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def delete(self, namespace, key):
+        try:
+            os.remove(self._path(namespace, key))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def expire(self, namespace, max_age):
+        """
+        Deletes the entries of a namespace not written or read for max_age seconds, e.g. records nobody polls
+        anymore
+        :return: number of deleted entries
+        """
+        if not _NAMESPACE_RE.match(namespace or ""):
+            raise ValueError(f"Invalid store namespace: {namespace!r}")
+        directory = os.path.join(self.root, namespace)
+        now = time.time()
+        deleted = 0
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if now - os.stat(path).st_mtime > max_age:
+                    os.remove(path)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+        self.evicted += deleted
+        return deleted
+
+    def stats(self):
+        return dict(max_bytes=self.max_bytes, ttl=self.ttl, evicted=self.evicted, last_sweep=self._last_sweep)
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval and self._written < self.max_bytes // 16:
+            return
+        # One sweep at a time per process, the other threads go on
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep, self._written = now, 0
+            self.sweep(now)
+        finally:
+            self._sweep_lock.release()
+
+    def sweep(self, now=None):
+        """
+        Deletes the expired entries, then the least recently used ones until the store fits in max_bytes.
+        Workers may sweep concurrently: entries already deleted by another one are skipped.
+        :return: number of deleted entries
+        """
+        now = time.time() if now is None else now
+        entries = []
+        try:
+            namespaces = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for namespace in namespaces:
+            directory = os.path.join(self.root, namespace)
+            try:
+                names = os.listdir(directory)
+            except (NotADirectoryError, FileNotFoundError):
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+            if not names:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        deleted = 0
+        for mtime, size, path in entries:
+            if now - mtime <= self.ttl and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.evicted += deleted
+        return deleted
+
+    def touch(self, namespace, key):
+        """
+        Marks the entry as recently used, so the sweeps keep it
+        :return: whether the entry exists
+        """
+        try:
+            os.utime(self._path(namespace, key))
+            return True
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def contains(self, namespace, key):
+        try:
+            return os.path.exists(self._path(namespace, key))
+        except ValueError:
+            return False
+
+
+image_store = ImageStore()
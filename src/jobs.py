@@ -0,0 +1,209 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from generation import Superseded
+from image_store import image_store
+
+# Background threads computing disparities in each gunicorn worker, 0 computes inside the request as before
+JOB_WORKERS = int(os.environ.get("STEREO_JOB_WORKERS", 1))
+# Sessions that can wait for a worker at the same time, further submissions are rejected
+JOB_QUEUE_DEPTH = int(os.environ.get("STEREO_JOB_QUEUE_DEPTH", 16))
+# Seconds from submission after which a job is abandoned
+JOB_TIMEOUT = float(os.environ.get("STEREO_JOB_TIMEOUT", 120))
+JOB_POLL_MS = int(os.environ.get("STEREO_JOB_POLL_MS", 250))
+# Seconds the status markers are kept once written: finished markers are deleted when the browser has polled them,
+# the others (sessions that went away) after this time, never before the job timeout
+JOB_MARKER_TTL = float(os.environ.get("STEREO_JOB_MARKER_TTL", 600))
+
+JOBS_NAMESPACE = "jobs"
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """
+    Raised by JobQueue.submit when JOB_QUEUE_DEPTH sessions are already waiting
+    """
+
+
+class JobTimeout(Exception):
+    """
+    Raised by the check function of a job that ran past its deadline
+    """
+
+
+class Job:
+    def __init__(self, job_id, session_id, function, timeout):
+        self.id = job_id
+        self.session_id = session_id
+        self.function = function
+        self.submitted = time.time()
+        self.deadline = self.submitted + timeout
+
+    def expired(self):
+        return time.time() > self.deadline
+
+    def check(self):
+        """
+        Passed to the job function, which calls it between stages. OpenCV calls cannot be interrupted, so a job
+        stops at the first check after its deadline.
+        """
+        if self.expired():
+            raise JobTimeout(f"job {self.id} exceeded its timeout")
+
+
+class JobQueue:
+    """
+    Runs the disparity computations in background threads, so the gunicorn request handlers only submit jobs
+    and poll their status.
+
+    Each session has at most one waiting job: a newer submission replaces it (latest wins) and keeps its place
+    in line. Sessions are served in arrival order and a session never runs two jobs at once, so one user
+    dragging sliders cannot starve the others. At most max_pending sessions wait, and jobs are abandoned once
+    their timeout has passed, waiting or running.
+
+    The status of every job is written as a small JSON marker to the image store, which is shared by the
+    workers: a poll answered by another worker than the one computing still sees the job. Markers are deleted by
+    forget once their final state has been read, and expired after marker_ttl seconds otherwise.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_QUEUE_DEPTH, timeout=JOB_TIMEOUT, store=image_store,
+                 namespace=JOBS_NAMESPACE, marker_ttl=JOB_MARKER_TTL):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.store = store
+        self.namespace = namespace
+        self.marker_ttl = max(marker_ttl, timeout)
+        self._last_expiry = 0.0
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.counts = dict(submitted=0, rejected=0, done=0, failed=0, superseded=0, timed_out=0, expired=0)
+
+    def _start(self):
+        # Threads (and locks held by them) do not survive fork: everything is created in the process that
+        # submits the first job, i.e. in the gunicorn worker and not in the master
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._cond = threading.Condition()
+            # Session id -> waiting job, in the order the sessions joined the line
+            self._pending = collections.OrderedDict()
+            # Session id -> running job
+            self._running = {}
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _write(self, job, state, **fields):
+        marker = dict(state=state, session=job.session_id, submitted=job.submitted, pid=os.getpid(), **fields)
+        self.store.write(self.namespace, job.id, json.dumps(marker).encode("utf-8"))
+
+    def submit(self, job_id, session_id, function):
+        """
+        Queues function(check) for the session, replacing its waiting job if any
+        :param job_id: 40 hexadecimal characters, e.g. a result_key
+        :param function: called with a check function to call between stages, returns a JSON serializable result
+        :raise QueueFull: when max_pending other sessions are waiting
+        """
+        if self.workers <= 0:
+            raise ValueError("The job queue has no workers")
+        job = Job(job_id, session_id, function, self.timeout)
+        self._start()
+        with self._cond:
+            previous = self._pending.get(session_id)
+            if previous is None and len(self._pending) >= self.max_pending:
+                self.counts["rejected"] += 1
+                raise QueueFull(f"{len(self._pending)} sessions are waiting")
+            self._pending[session_id] = job
+            self.counts["submitted"] += 1
+            self._write(job, "queued")
+            if previous is not None:
+                self.counts["superseded"] += 1
+                self._write(previous, "superseded")
+            self._cond.notify()
+        return job
+
+    def status(self, job_id):
+        """
+        :return: marker of the job (state, session, submitted, and result or error when finished), or None when
+            the job is unknown
+        """
+        data = self.store.get(self.namespace, job_id)
+        return json.loads(data.decode("utf-8")) if data is not None else None
+
+    def forget(self, job_id):
+        """
+        Deletes the marker of a finished job, once its final state has been read
+        """
+        self.store.delete(self.namespace, job_id)
+
+    def _expire_markers(self):
+        """
+        Deletes the markers nobody polled, at most once a minute per process. Must be called with the condition
+        held, so a single worker thread sweeps.
+        """
+        now = time.time()
+        if now - self._last_expiry >= 60:
+            self._last_expiry = now
+            self.counts["expired"] += self.store.expire(self.namespace, self.marker_ttl)
+
+    def _take(self):
+        """
+        Next job to run: the first waiting session that is not running a job. Expired jobs are dropped.
+        Must be called with the condition held.
+        """
+        for session_id, job in list(self._pending.items()):
+            if job.expired():
+                del self._pending[session_id]
+                self.counts["timed_out"] += 1
+                self._write(job, "timeout", error="timed out while waiting")
+            elif session_id not in self._running:
+                del self._pending[session_id]
+                self._running[session_id] = job
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._take()
+                while job is None:
+                    # Wake up regularly to expire waiting jobs and old markers
+                    self._cond.wait(timeout=1.0)
+                    self._expire_markers()
+                    job = self._take()
+            try:
+                self._write(job, "running", started=time.time())
+                result = job.function(job.check)
+                self.counts["done"] += 1
+                self._write(job, "done", result=result)
+            except Superseded:
+                self.counts["superseded"] += 1
+                self._write(job, "superseded")
+            except JobTimeout as e:
+                self.counts["timed_out"] += 1
+                self._write(job, "timeout", error=str(e))
+            except Exception as e:
+                logger.exception("Job %s of session %s failed", job.id, job.session_id)
+                self.counts["failed"] += 1
+                self._write(job, "failed", error=f"{type(e).__name__}: {e}")
+            finally:
+                with self._cond:
+                    del self._running[job.session_id]
+                    self._cond.notify_all()
+
+    def stats(self):
+        pending = running = 0
+        if self._pid == os.getpid():
+            with self._cond:
+                pending, running = len(self._pending), len(self._running)
+        return dict(pid=os.getpid(), workers=self.workers, max_pending=self.max_pending, timeout=self.timeout,
+                    marker_ttl=self.marker_ttl, pending=pending, running=running, **self.counts)
+
+
+job_queue = JobQueue()
@@ -0,0 +1,144 @@
+import os
+import threading
+
+import cv2
+
+from cache import LRUCache
+from disparity_map import bm_prefilter_type, get_stereo_bm_object, get_stereo_sgbm_object, sgbm_mode
+
+MATCHER_POOL_SESSIONS = int(os.environ.get("STEREO_MATCHER_POOL_SESSIONS", 64))
+
+# parameter name -> (setter, conversion from the UI value)
+BM_SETTERS = dict(min_disp=("setMinDisparity", int),
+                  num_disp=("setNumDisparities", int),
+                  block_size=("setBlockSize", int),
+                  prefilter_cap=("setPreFilterCap", int),
+                  prefilter_size=("setPreFilterSize", int),
+                  disp12maxdiff=("setDisp12MaxDiff", int),
+                  uniqueness_ratio=("setUniquenessRatio", int),
+                  speckle_windows_size=("setSpeckleWindowSize", int),
+                  speckle_range=("setSpeckleRange", int),
+                  texture_threshold=("setTextureThreshold", int),
+                  use_xsobel=("setPreFilterType", bm_prefilter_type))
+
+SGBM_SETTERS = dict(min_disp=("setMinDisparity", int),
+                    num_disp=("setNumDisparities", int),
+                    block_size=("setBlockSize", int),
+                    p1=("setP1", int),
+                    p2=("setP2", int),
+                    prefilter_cap=("setPreFilterCap", int),
+                    disp12maxdiff=("setDisp12MaxDiff", int),
+                    uniqueness_ratio=("setUniquenessRatio", int),
+                    speckle_windows_size=("setSpeckleWindowSize", int),
+                    speckle_range=("setSpeckleRange", int),
+                    use_dynamic_programming=("setMode", sgbm_mode))
+
+# createRightMatcher and createDisparityWLSFilter copy these values from the left matcher when they are
+# created, so a change in any of them means the derived objects have to be built again.
+RIGHT_MATCHER_KEYS = dict(bm=("min_disp", "num_disp", "block_size"),
+                          sgbm=("min_disp", "num_disp", "block_size", "p1", "p2", "prefilter_cap",
+                                "use_dynamic_programming"))
+WLS_FILTER_KEYS = ("min_disp", "num_disp", "block_size")
+
+
+class MatcherSet:
+    """
+    Matcher, right matcher and WLS filter reused across the callbacks of one session. Only the setters of
+    the parameters that changed since the previous call are applied; objects are built again only when a
+    value that is read at creation time changes.
+
+    The objects are stateful, so callers must hold ``lock`` while using them.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.algo = None
+        self.matcher = None
+        self.applied = {}
+        self.right_matcher = None
+        self.right_key = None
+        self.wls_filter = None
+        self.wls_key = None
+        self.wls_applied = {}
+        self.created = 0
+        self.updated = 0
+
+    def _setters(self):
+        return BM_SETTERS if self.algo == "bm" else SGBM_SETTERS
+
+    def _apply(self, params, force=False):
+        for name, (setter, convert) in self._setters().items():
+            if name not in params:
+                continue
+            value = params[name]
+            if force or self.applied.get(name, object()) != value:
+                getattr(self.matcher, setter)(convert(value))
+                self.applied[name] = value
+                self.updated += 1
+
+    def get_matcher(self, algo, params):
+        """
+        :param algo: "bm" or "sgbm"
+        :param params: matcher keyword arguments (see pipeline.matcher_parameters)
+        :return: the left matcher configured with params
+        """
+        if self.matcher is None or algo != self.algo:
+            self.algo = algo
+            if algo == "bm":
+                self.matcher = get_stereo_bm_object(**params)
+            else:
+                self.matcher = get_stereo_sgbm_object(**params)
+            self.applied = dict(params)
+            self.right_matcher = self.wls_filter = None
+            self.right_key = self.wls_key = None
+            self.created += 1
+        else:
+            self._apply(params)
+        return self.matcher
+
+    def get_right_matcher(self):
+        """
+        :return: right matcher matching the current left matcher configuration
+        """
+        key = tuple(self.applied.get(k) for k in RIGHT_MATCHER_KEYS[self.algo])
+        if self.right_matcher is None or key != self.right_key:
+            self.right_matcher = cv2.ximgproc.createRightMatcher(self.matcher)
+            self.right_key = key
+            self.created += 1
+        return self.right_matcher
+
+    def get_wls_filter(self, lmbda, sigma):
+        """
+        :return: WLS filter for the current left matcher configuration with the given lambda and sigma
+        """
+        key = (self.algo,) + tuple(self.applied.get(k) for k in WLS_FILTER_KEYS)
+        if self.wls_filter is None or key != self.wls_key:
+            self.wls_filter = cv2.ximgproc.createDisparityWLSFilter(self.matcher)
+            self.wls_key = key
+            self.wls_applied = {}
+            self.created += 1
+            # Creating the filter resets disp12MaxDiff, speckle window, texture threshold and uniqueness ratio
+            # of the left matcher, restore the values we are tracking
+            self._apply(self.applied, force=True)
+        if self.wls_applied.get("lmbda") != lmbda:
+            self.wls_filter.setLambda(lmbda)
+            self.wls_applied["lmbda"] = lmbda
+        if self.wls_applied.get("sigma") != sigma:
+            self.wls_filter.setSigmaColor(sigma)
+            self.wls_applied["sigma"] = sigma
+        return self.wls_filter
+
+    def stats(self):
+        return dict(algo=self.algo, created=self.created, updated=self.updated)
+
+
+matcher_pool = LRUCache(max_entries=MATCHER_POOL_SESSIONS)
+_pool_lock = threading.Lock()
+
+
+def get_matcher_set(session_id):
+    """
+    :return: the MatcherSet of the session, creating it on first use
+    """
+    with _pool_lock:
+        return matcher_pool.get_or_compute(session_id, MatcherSet)
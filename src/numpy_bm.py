@@ -0,0 +1,300 @@
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from disparity_map import to_grayscale
+
+# Peak memory (MB) of the NumPy engine: the cost volume is built by chunks of rows that fit, problems where
+# MIN_CHUNK_ROWS rows do not fit are left to OpenCV
+NUMPY_BM_MAX_MB = int(os.environ.get("STEREO_NUMPY_BM_MAX_MB", 512))
+MIN_CHUNK_ROWS = 8
+# Bytes per pixel of the image-sized arrays alive next to the cost volume: prefilter temporaries, prefiltered
+# images, their int16 copies, the texture sums and the MatchingCosts (measured with tracemalloc, rounded up)
+IMAGE_BYTES_PER_PIXEL = 64
+
+DISP_SHIFT = 4
+
+# Per-pixel summary of the SAD cost volume inside the valid region, everything the post-processing filters need:
+# best: index of the lowest cost (disparity num_disp - 1 - best + min_disp), cost: the lowest cost,
+# prev/next: costs of the neighbouring indices (mirrored at the ends, as OpenCV does), second: lowest cost
+# outside best-1..best+1, texture: sum of |prefiltered left - prefilter_cap| over the block
+MatchingCosts = namedtuple("MatchingCosts", ["best", "cost", "prev", "next", "second", "texture", "roi", "shape",
+                                             "min_disp", "num_disp"])
+
+
+def valid_region(shape, min_disp, num_disp, block_size):
+    """
+    Region StereoBM computes disparities for (cv2.getValidDisparityROI without rectification ROIs), every pixel
+    outside of it is invalid
+    :return: (x0, y0, x1, y1)
+    """
+    height, width = shape[:2]
+    radius = block_size // 2
+    x0 = max(0, min_disp + num_disp - 1) + radius
+    x1 = min(width - radius, width + min_disp)
+    return x0, radius, x1, height - radius
+
+
+def mask_invalid_region(disparity_map, min_disp=0, num_disp=64, block_size=5, **_):
+    """
+    Sets the pixels outside valid_region to the invalid value, in place. StereoBM leaves a few stale values
+    there (e.g. on the row below the region when min_disp > 0), which the NumPy engine cannot reproduce.
+    :return: disparity_map
+    """
+    x0, y0, x1, y1 = valid_region(disparity_map.shape, min_disp, num_disp, block_size)
+    invalid = (min_disp - 1) << DISP_SHIFT
+    disparity_map[:y0] = invalid
+    disparity_map[y1:] = invalid
+    disparity_map[:, :x0] = invalid
+    disparity_map[:, x1:] = invalid
+    return disparity_map
+
+
+def _sum_dtype(block_size, prefilter_cap):
+    # Like StereoBM, 16 bit sums when no block can exceed them
+    return np.uint16 if block_size * block_size * 2 * prefilter_cap < 2 ** 16 else np.uint32
+
+
+def _volume_columns(shape, min_disp, num_disp, block_size):
+    x0, y0, x1, y1 = valid_region(shape, min_disp, num_disp, block_size)
+    return x1 - x0 + block_size - 1
+
+
+def cost_volume_bytes(shape, min_disp=0, num_disp=64, block_size=5, prefilter_cap=1, rows=None, **_):
+    """
+    Peak memory of compute_matching_costs: the image-sized arrays (prefilters, texture sums and the MatchingCosts)
+    plus the cost volume of one chunk of rows. A chunk holds two volume-sized arrays at most, its absolute
+    differences and their integral image, then the integral image and the box sums.
+    :param rows: valid rows matched per chunk, defaults to all of them
+    :return: bytes
+    """
+    height, width = shape[:2]
+    x0, y0, x1, y1 = valid_region(shape, min_disp, num_disp, block_size)
+    rows = min(rows or (y1 - y0), y1 - y0)
+    itemsize = np.dtype(_sum_dtype(block_size, prefilter_cap)).itemsize
+    chunk = (rows + block_size) * num_disp * (_volume_columns(shape, min_disp, num_disp, block_size) + 1)
+    return IMAGE_BYTES_PER_PIXEL * height * width + 2 * itemsize * chunk
+
+
+def chunk_rows(shape, min_disp=0, num_disp=64, block_size=5, prefilter_cap=1, max_bytes=None, **_):
+    """
+    :return: number of valid rows matched per chunk so that the peak memory of compute_matching_costs stays
+        under max_bytes (NUMPY_BM_MAX_MB by default), 0 when not even a single row fits
+    """
+    max_bytes = NUMPY_BM_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+    x0, y0, x1, y1 = valid_region(shape, min_disp, num_disp, block_size)
+    one_row = cost_volume_bytes(shape, min_disp, num_disp, block_size, prefilter_cap, rows=1)
+    if y1 <= y0 or one_row > max_bytes:
+        return 0
+    per_row = cost_volume_bytes(shape, min_disp, num_disp, block_size, prefilter_cap, rows=2) - one_row
+    return int(min(y1 - y0, 1 + (max_bytes - one_row) // max(per_row, 1)))
+
+
+def supports(shape, min_disp=0, num_disp=64, block_size=5, disp12maxdiff=-1, prefilter_cap=1, **params):
+    """
+    Whether the NumPy engine handles the problem: the valid region must not be empty, not every disparity can
+    be negative, and the cost volume of at least MIN_CHUNK_ROWS rows must fit in NUMPY_BM_MAX_MB. The left-right
+    check (disp12maxdiff >= 0) is left to OpenCV: StereoBM does not apply it like cv2.validateDisparity, so it
+    cannot be reproduced from the matching costs alone.
+    """
+    x0, y0, x1, y1 = valid_region(shape, min_disp, num_disp, block_size)
+    return (x1 > x0 and y1 > y0 and min_disp + num_disp - 1 >= 0 and disp12maxdiff < 0 and
+            chunk_rows(shape, min_disp, num_disp, block_size, prefilter_cap) >= min(MIN_CHUNK_ROWS, y1 - y0))
+
+
+def prefilter_normalized(img, size, cap):
+    """
+    StereoBM's normalized response prefilter: 4-neighbour weighted pixel minus the mean of the size x size
+    window, clipped to [-cap, cap] and shifted to [0, 2 * cap]. Borders are replicated.
+    """
+    img = img.astype(np.int32)
+    radius = size // 2
+    padded = np.pad(img, radius + 1, mode="edge")
+    integral = padded.cumsum(axis=0).cumsum(axis=1)
+    integral = np.pad(integral, ((1, 0), (1, 0)))
+    offset = 1
+    height, width = img.shape
+    y0, x0 = offset, offset
+    window = (integral[y0 + size:y0 + size + height, x0 + size:x0 + size + width] -
+              integral[y0:y0 + height, x0 + size:x0 + size + width] -
+              integral[y0 + size:y0 + size + height, x0:x0 + width] +
+              integral[y0:y0 + height, x0:x0 + width])
+
+    cross = padded[radius + 1:-radius - 1, radius + 1:-radius - 1]
+    cross = (cross * 4 + padded[radius:-radius - 2, radius + 1:-radius - 1] +
+             padded[radius + 2:padded.shape[0] - radius, radius + 1:-radius - 1] +
+             padded[radius + 1:-radius - 1, radius:-radius - 2] +
+             padded[radius + 1:-radius - 1, radius + 2:padded.shape[1] - radius])
+
+    scale_g = size * size // 8
+    scale_s = (1024 + scale_g) // (scale_g * 2)
+    response = (cross * (scale_g * scale_s) - window * scale_s) >> 10
+    return (np.clip(response, -cap, cap) + cap).astype(np.uint8)
+
+
+def prefilter_xsobel(img, cap):
+    """
+    StereoBM's XSobel prefilter: horizontal Sobel response clipped to [-cap, cap] and shifted to [0, 2 * cap].
+    The first and last columns (and the last row of odd-height images) are set to cap.
+    """
+    img = img.astype(np.int32)
+    height, width = img.shape
+    dx = np.zeros_like(img)
+    dx[:, 1:-1] = img[:, 2:] - img[:, :-2]
+    padded = np.pad(dx, ((1, 1), (0, 0)), mode="reflect")
+    response = padded[:-2] + 2 * padded[1:-1] + padded[2:]
+    result = (np.clip(response, -cap, cap) + cap).astype(np.uint8)
+    result[:, 0] = result[:, -1] = cap
+    if height % 2:
+        result[-1] = cap
+    return result
+
+
+def _integral(values, dtype):
+    """
+    Integral image over the first and last axes of values, with a leading zero row and column. Unsigned integral
+    images may wrap around: window sums are still exact as long as they fit in dtype.
+    """
+    integral = np.zeros((values.shape[0] + 1,) + values.shape[1:-1] + (values.shape[-1] + 1,), dtype=dtype)
+    np.cumsum(values, axis=0, dtype=dtype, out=integral[1:, ..., 1:])
+    np.cumsum(integral[1:, ..., 1:], axis=-1, dtype=dtype, out=integral[1:, ..., 1:])
+    return integral
+
+
+def _window_sums(integral, size):
+    """
+    Sums of size x size windows from an integral image, only where the window fits. Computed in place in the
+    result, so no temporary of its size is allocated.
+    """
+    sums = np.subtract(integral[size:, ..., size:], integral[:-size, ..., size:])
+    sums -= integral[size:, ..., :-size]
+    sums += integral[:-size, ..., :-size]
+    return sums
+
+
+def _chunk_costs(left, right, right_columns, block_size, dtype, out):
+    """
+    SAD cost volume of a chunk of rows, reduced to the per-pixel summary written to out. At most two arrays of the
+    size of the volume are alive at once, see cost_volume_bytes.
+    :param left: int16 prefiltered left rows at the block columns, (rows, columns)
+    :param right: int16 prefiltered right rows
+    :param right_columns: columns of the right blocks of every disparity, (disparities, columns)
+    :param out: (best, cost, prev, next, second) arrays of the valid rows of the chunk
+    """
+    num_disp = right_columns.shape[0]
+    differences = right[:, right_columns]
+    np.subtract(left[:, None, :], differences, out=differences)
+    np.abs(differences, out=differences)
+    # The differences are at most 2 * prefilter_cap: the unsigned view is exact
+    differences = differences.view(np.uint16) if dtype == np.uint16 else differences.astype(dtype)
+    integral = _integral(differences, dtype)
+    del differences
+    volume = _window_sums(integral, block_size)
+    del integral
+
+    best = volume.argmin(axis=1)[:, None]
+    out[0][...] = best[:, 0]
+    out[1][...] = np.take_along_axis(volume, best, axis=1)[:, 0]
+    # OpenCV mirrors the costs at both ends of the range: sad[-1] = sad[1] and sad[n] = sad[n - 2]
+    out[2][...] = np.take_along_axis(volume, np.abs(best - 1), axis=1)[:, 0]
+    next_index = best + 1
+    next_index[next_index == num_disp] = num_disp - 2
+    out[3][...] = np.take_along_axis(volume, next_index, axis=1)[:, 0]
+    # The second best cost is searched outside best-1..best+1
+    for step in (-1, 0, 1):
+        np.put_along_axis(volume, np.clip(best + step, 0, num_disp - 1), np.iinfo(dtype).max, axis=1)
+    out[4][...] = volume.min(axis=1)
+
+
+def compute_matching_costs(left_img, right_img, min_disp=0, num_disp=64, block_size=5, prefilter_cap=1,
+                           prefilter_size=5, use_xsobel=False, max_bytes=None, **_):
+    """
+    Builds the SAD cost volume of the prefiltered pair with integral images and reduces it to the per-pixel
+    MatchingCosts the post-processing needs. Only the parameters up to use_xsobel affect the result, so it can
+    be cached while uniqueness, texture and speckle parameters change. The volume is built by chunks of rows
+    small enough to keep the peak memory under max_bytes (see cost_volume_bytes).
+    :param left_img: left image
+    :param right_img: right image
+    :param max_bytes: memory budget, NUMPY_BM_MAX_MB by default
+    :return: MatchingCosts
+    """
+    left_img = to_grayscale(left_img)
+    right_img = to_grayscale(right_img)
+    if use_xsobel:
+        left, right = prefilter_xsobel(left_img, prefilter_cap), prefilter_xsobel(right_img, prefilter_cap)
+    else:
+        left = prefilter_normalized(left_img, prefilter_size, prefilter_cap)
+        right = prefilter_normalized(right_img, prefilter_size, prefilter_cap)
+
+    height, width = left.shape
+    x0, y0, x1, y1 = valid_region(left.shape, min_disp, num_disp, block_size)
+    radius = block_size // 2
+    # Columns of the blocks centered in the valid region. Like StereoBM, the left columns are clamped to the
+    # image and the right ones so that every disparity stays inside it.
+    left_offset = max(min_disp + num_disp - 1, 0)
+    columns = np.arange(x0 - radius, x1 + radius)
+    left_columns = np.clip(columns, 0, width - 1)
+    right_columns = (np.clip(columns - left_offset, 0, width - num_disp)[None, :] +
+                     np.arange(num_disp)[:, None])
+
+    dtype = _sum_dtype(block_size, prefilter_cap)
+    rows = max(1, chunk_rows(left.shape, min_disp, num_disp, block_size, prefilter_cap, max_bytes))
+    valid_rows, valid_columns = y1 - y0, x1 - x0
+    best = np.empty((valid_rows, valid_columns), np.int16)
+    cost, prev, next, second = (np.empty((valid_rows, valid_columns), np.int32) for _ in range(4))
+    # int16 copies of the rows, so that gathering the disparities directly yields the type of the differences
+    left16, right16 = left[:, left_columns].astype(np.int16), right.astype(np.int16)
+    for r0 in range(0, valid_rows, rows):
+        r1 = min(valid_rows, r0 + rows)
+        # The blocks of valid rows r0..r1 span the image rows r0..r1 + block_size - 1
+        chunk = slice(r0, r1 + block_size - 1)
+        _chunk_costs(left16[chunk], right16[chunk], right_columns, block_size, dtype,
+                     (best[r0:r1], cost[r0:r1], prev[r0:r1], next[r0:r1], second[r0:r1]))
+    del left16, right16
+
+    texture_values = np.abs(left[:, left_columns].astype(np.int32) - prefilter_cap)
+    texture = _window_sums(_integral(texture_values, np.int32), block_size)
+
+    return MatchingCosts(best=best, cost=cost, prev=prev, next=next, second=second, texture=texture,
+                         roi=(x0, y0, x1, y1), shape=left.shape, min_disp=min_disp, num_disp=num_disp)
+
+
+def postprocess(costs, uniqueness_ratio=0, texture_threshold=0, speckle_windows_size=0, speckle_range=0, **_):
+    """
+    Turns MatchingCosts into the StereoBM disparity map: texture and uniqueness checks, subpixel interpolation
+    and speckle filtering
+    :return: int16 disparity map (16 x disparity), identical to StereoBM's inside the valid region
+    """
+    x0, y0, x1, y1 = costs.roi
+    min_disp, num_disp = costs.min_disp, costs.num_disp
+    invalid = (min_disp - 1) << DISP_SHIFT
+
+    best = costs.best.astype(np.int64)
+    cost, prev, next = costs.cost.astype(np.int64), costs.prev.astype(np.int64), costs.next.astype(np.int64)
+    denominator = prev + next - 2 * cost + np.abs(prev - next)
+    numerator = (next - prev) * 256
+    # C integer division truncates towards zero
+    fraction = np.sign(numerator) * (np.abs(numerator) // np.maximum(denominator, 1))
+    fraction[denominator == 0] = 0
+    roi_disparity = ((num_disp - 1 - best + min_disp) * 256 + fraction + 15) >> DISP_SHIFT
+
+    rejected = costs.texture < texture_threshold
+    if uniqueness_ratio > 0:
+        rejected |= costs.second <= cost + cost * uniqueness_ratio // 100
+    roi_disparity[rejected] = invalid
+
+    disparity_map = np.full(costs.shape, invalid, np.int16)
+    disparity_map[y0:y1, x0:x1] = roi_disparity
+    if speckle_windows_size > 0 and speckle_range >= 0:
+        cv2.filterSpeckles(disparity_map, invalid, speckle_windows_size, speckle_range)
+    return disparity_map
+
+
+def compute_numpy_bm_disparity_map(left_img, right_img, **params):
+    """
+    Same result as generate_stereo_bm_disparity_map, computed with NumPy. To only re-run the post-processing
+    when its parameters change, cache compute_matching_costs and call postprocess instead.
+    """
+    return postprocess(compute_matching_costs(left_img, right_img, **params), **params)
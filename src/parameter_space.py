@@ -0,0 +1,148 @@
+import itertools
+import random
+
+# Sliders of the UI in display order: (title, parameter name, min, max, step, default value)
+SLIDERS = [
+    ("Block size", "block_size", 1, 255, 2, 5),
+    ("Number of disparities", "num_disp", 16, 2048, 16, 64),
+    ("Min disparity", "min_disp", -1, 255, 1, 0),
+    ("P1 (only SGBM)", "p1", 0, 2048, 1, 0),
+    ("P2 (only SGBM)", "p2", 0, 2048, 1, 0),
+    ("Uniqueness Ratio", "uniqueness_ratio", 0, 255, 1, 0),
+    ("Pre Filter Cap", "prefilter_cap", 1, 63, 1, 1),
+    ("Pre Filter Size (only BM)", "prefilter_size", 5, 255, 2, 5),
+    ("Disp 12 Max Diff", "disp12maxdiff", -1, 255, 1, -1),
+    ("Speckle Windows Size", "speckle_windows_size", 0, 2048, 1, 0),
+    ("Speckle Range", "speckle_range", 0, 255, 1, 0),
+    ("Texture Threshold (only BM)", "texture_threshold", 0, 255, 1, 0),
+    ("Lambda (WLS Filter)", "lmbda", 0, 100000, 1, 8000),
+    ("Sigma (WLS Filter)", "sigma", 0, 10, 0.01, 1),
+]
+
+# Radio groups and checkboxes: parameter name -> possible values (the first one is the default)
+CHOICES = dict(use_xsobel=[False, True],
+               use_dynamic_programming=["default", "dp", "3way"],
+               wls_filtering=[False, True])
+
+BM_PARAMETERS = ("min_disp", "num_disp", "block_size", "prefilter_cap", "prefilter_size", "disp12maxdiff",
+                 "uniqueness_ratio", "speckle_windows_size", "speckle_range", "texture_threshold", "use_xsobel",
+                 "wls_filtering", "lmbda", "sigma")
+SGBM_PARAMETERS = ("min_disp", "num_disp", "block_size", "p1", "p2", "prefilter_cap", "disp12maxdiff",
+                   "uniqueness_ratio", "speckle_windows_size", "speckle_range", "use_dynamic_programming",
+                   "wls_filtering", "lmbda", "sigma")
+
+RANGES = {name: (minimum, maximum, step) for _, name, minimum, maximum, step, _ in SLIDERS}
+DEFAULTS = dict({name: value for _, name, _, _, _, value in SLIDERS},
+                **{name: values[0] for name, values in CHOICES.items()})
+
+
+def algorithm_parameters(algo):
+    return BM_PARAMETERS if algo == "bm" else SGBM_PARAMETERS
+
+
+def default_parameters(algo):
+    """
+    :return: the parameters of the algorithm with the initial values of the UI, in the save_parameters schema
+    """
+    return {name: DEFAULTS[name] for name in algorithm_parameters(algo)}
+
+
+def slider_values(name, minimum=None, maximum=None, step=None):
+    """
+    Values a slider can take, optionally restricted to a sub-range and/or a coarser step
+    """
+    low, high, slider_step = RANGES[name]
+    minimum = low if minimum is None else max(low, minimum)
+    maximum = high if maximum is None else min(high, maximum)
+    step = slider_step if step is None else step
+    count = int(round((maximum - minimum) / step)) + 1
+    values = [minimum + i * step for i in range(count) if minimum + i * step <= maximum + 1e-9]
+    if isinstance(step, float):
+        values = [round(v, 6) for v in values]
+    return values
+
+
+def neighbor_values(name, value, steps):
+    """
+    Values of a slider around value, nearest first and above before below: value + step, value - step,
+    value + 2 * step, ... up to steps slider steps away, within the range of the slider
+    """
+    low, high, step = RANGES[name]
+    values = []
+    for i in range(1, steps + 1):
+        for candidate in (value + i * step, value - i * step):
+            if isinstance(step, float):
+                candidate = round(candidate, 6)
+            if low <= candidate <= high:
+                values.append(candidate)
+    return values
+
+
+def make_valid(algo, params):
+    """
+    Adjusts parameters to the constraints of the OpenCV matchers: odd blocks (of at least 5 for StereoBM),
+    disparities multiple of 16, odd prefilter sizes for StereoBM and P2 > P1 for SGBM when P1 is set.
+    """
+    params = dict(params)
+    block_size = int(params["block_size"])
+    if block_size % 2 == 0:
+        block_size += 1
+    params["block_size"] = max(5, block_size) if algo == "bm" else block_size
+    params["num_disp"] = max(16, int(params["num_disp"]) // 16 * 16)
+    if algo == "bm":
+        prefilter_size = int(params["prefilter_size"])
+        params["prefilter_size"] = prefilter_size if prefilter_size % 2 else prefilter_size + 1
+    elif params["p1"] and params["p2"] <= params["p1"]:
+        params["p2"] = min(RANGES["p2"][1], params["p1"] + 1)
+    return params
+
+
+class SearchSpace:
+    """
+    Subset of the UI parameters explored by the search. Every dimension is a list of candidate values;
+    the other parameters keep the values of ``base``.
+    """
+
+    def __init__(self, algo, dimensions, base=None):
+        self.algo = algo
+        self.dimensions = dict(dimensions)
+        self.base = dict(base or default_parameters(algo))
+
+    @classmethod
+    def from_ranges(cls, algo, ranges=None, base=None, max_points=None):
+        """
+        :param ranges: parameter name -> (min, max, step) for sliders (None entries keep the slider's own) or
+            list of values for choices; None for the full range. Defaults to every parameter of the algorithm.
+        :param max_points: coarsen numeric dimensions to at most this many values (used by grid search)
+        """
+        if ranges is None:
+            ranges = {name: None for name in algorithm_parameters(algo)}
+        dimensions = {}
+        for name, spec in ranges.items():
+            if name in CHOICES:
+                values = list(spec) if spec else list(CHOICES[name])
+            else:
+                values = slider_values(name, *(spec or ()))
+                if max_points and len(values) > max_points:
+                    stride = (len(values) - 1) / float(max_points - 1)
+                    values = sorted({values[int(round(i * stride))] for i in range(max_points)})
+            dimensions[name] = values
+        return cls(algo, dimensions, base)
+
+    def size(self):
+        size = 1
+        for values in self.dimensions.values():
+            size *= len(values)
+        return size
+
+    def _candidate(self, values):
+        return make_valid(self.algo, dict(self.base, **values))
+
+    def grid(self):
+        names = list(self.dimensions)
+        for combination in itertools.product(*(self.dimensions[name] for name in names)):
+            yield self._candidate(dict(zip(names, combination)))
+
+    def sample(self, rng=None):
+        rng = rng or random
+        return self._candidate({name: rng.choice(values) for name, values in self.dimensions.items()})
@@ -0,0 +1,292 @@
+import os
+
+import cv2
+import numpy as np
+
+from disparity_map import get_stereo_bm_object, get_stereo_sgbm_object, to_grayscale
+from filtering import apply_wls_filter, compute_raw_disparities
+from numpy_bm import compute_matching_costs, mask_invalid_region, postprocess, supports
+from result_cache import raw_disparities, result_key
+from tiling import TILED_THREADS, compute_tiled_bm_disparity_map
+from timing import stage
+
+# StereoBM implementation used without WLS filtering: "opencv", or "numpy" to cache the matching costs so that
+# changing only the uniqueness, texture or speckle parameters skips the block matching
+BM_ENGINE = os.environ.get("STEREO_BM_ENGINE", "opencv")
+# Extra rows and columns matched around a region with SGBM: its aggregation paths carry costs across the whole
+# image, but their influence fades within a few tens of pixels
+ROI_SGBM_MARGIN = int(os.environ.get("STEREO_ROI_SGBM_MARGIN", 32))
+
+# Parameters of compute_matching_costs, the others only affect numpy_bm.postprocess
+MATCHING_COST_PARAMETERS = ("min_disp", "num_disp", "block_size", "prefilter_cap", "prefilter_size", "use_xsobel")
+
+
+def build_parameters(algo, wls_filtering, use_xsobel, use_dynamic_programming, block_size, n_disparities,
+                     min_disparities, p1, p2, disp_12_max_diff, uniqueness_ratio, pre_filter_cap, pre_filter_size,
+                     speckle_windows_size, speckle_range, texture_threshold, lmbda, sigma):
+    """
+    Builds the parameter dictionary of the given algorithm from the values of the UI controls. Only the
+    parameters that affect the selected algorithm are kept. This is the schema written by ``save_parameters``.
+    :param algo: "bm" or "sgbm"
+    :param wls_filtering: value of the WLS checklist (a list, or False)
+    :return: dict
+    """
+    try:
+        wls_filtering = wls_filtering[0]
+    except TypeError:
+        wls_filtering = False
+    except IndexError:
+        wls_filtering = False
+
+    if algo == "bm":
+        return dict(min_disp=min_disparities,
+                    num_disp=n_disparities,
+                    block_size=block_size,
+                    prefilter_cap=pre_filter_cap,
+                    prefilter_size=pre_filter_size,
+                    disp12maxdiff=disp_12_max_diff,
+                    uniqueness_ratio=uniqueness_ratio,
+                    speckle_windows_size=speckle_windows_size,
+                    speckle_range=speckle_range,
+                    texture_threshold=texture_threshold,
+                    use_xsobel=use_xsobel,
+                    wls_filtering=wls_filtering,
+                    lmbda=lmbda,
+                    sigma=sigma)
+
+    return dict(min_disp=min_disparities,
+                num_disp=n_disparities,
+                block_size=block_size,
+                p1=p1,
+                p2=p2,
+                prefilter_cap=pre_filter_cap,
+                disp12maxdiff=disp_12_max_diff,
+                uniqueness_ratio=uniqueness_ratio,
+                speckle_windows_size=speckle_windows_size,
+                speckle_range=speckle_range,
+                use_dynamic_programming=use_dynamic_programming,
+                wls_filtering=wls_filtering,
+                lmbda=lmbda,
+                sigma=sigma)
+
+
+def matcher_parameters(params):
+    """
+    Strips the filtering parameters, leaving the keyword arguments of the matcher functions
+    """
+    return {k: v for k, v in params.items() if k not in ("wls_filtering", "lmbda", "sigma")}
+
+
+def effective_parameters(params):
+    """
+    Parameters that actually change the output: lambda and sigma are dropped when WLS filtering is disabled
+    """
+    if params.get("wls_filtering"):
+        return dict(params)
+    return matcher_parameters(params)
+
+
+def raw_disparity_key(pair_key, algo, params):
+    """
+    Key of the raw left/right disparities in the raw_disparities cache. Only the matcher parameters are part
+    of it, so the entry is shared by all lambda/sigma values.
+    """
+    return result_key("raw-wls", pair_key, algo, matcher_parameters(params))
+
+
+def matching_cost_key(pair_key, params):
+    """
+    Key of the NumPy StereoBM matching costs in the raw_disparities cache
+    """
+    return result_key("bm-costs", pair_key, {name: params[name] for name in MATCHING_COST_PARAMETERS})
+
+
+def compute_disparity(left, right, algo, params, matchers=None, check=None, pair_key=None):
+    """
+    Runs the selected matcher (and the WLS filter if enabled) on a grayscale pair
+    :param left: left grayscale image
+    :param right: right grayscale image
+    :param algo: "bm" or "sgbm"
+    :param params: parameters as returned by build_parameters
+    :param matchers: optional MatcherSet whose objects are reused instead of creating new ones
+    :param check: optional function called between the WLS stages, it can raise to abort the computation
+    :param pair_key: identifies the image pair (e.g. content hashes and pyramid level). When given, the raw
+        disparities of WLS runs are cached, so changing only lambda or sigma re-runs just the filter. With the
+        NumPy StereoBM engine the matching costs are cached the same way.
+    :return: disparity map and the valid region of interest (x, y, w, h), or None when the whole image is valid
+    """
+    if (algo == "bm" and BM_ENGINE == "numpy" and not params.get("wls_filtering") and
+            supports(left.shape, **matcher_parameters(params))):
+        return _compute_numpy_bm(left, right, params, pair_key), None
+
+    if algo == "bm" and TILED_THREADS and not params.get("wls_filtering"):
+        with stage("compute"):
+            disparity_map = compute_tiled_bm_disparity_map(left, right, **matcher_parameters(params))
+        return _masked(disparity_map, algo, params), None
+
+    if matchers is not None:
+        with matchers.lock:
+            return _compute_disparity_pooled(left, right, algo, params, matchers, check, pair_key)
+
+    matcher_params = matcher_parameters(params)
+    with stage("setup"):
+        if algo == "bm":
+            stereo = get_stereo_bm_object(**matcher_params)
+        else:
+            stereo = get_stereo_sgbm_object(**matcher_params)
+    if params.get("wls_filtering"):
+        return _compute_filtered(stereo, left, right, algo, params, None, check, pair_key)
+
+    # Same as generate_stereo_bm/sgbm_disparity_map, split to time the matcher creation separately
+    left, right = to_grayscale(left), to_grayscale(right)
+    with stage("compute"):
+        disparity_map = stereo.compute(left, right)
+    return _masked(disparity_map, algo, params), None
+
+
+def clamp_box(box, shape):
+    """
+    :param box: (x, y, w, h), possibly outside the image
+    :return: the box intersected with an image of the given shape, at least one pixel wide and high
+    """
+    height, width = shape[:2]
+    x, y, w, h = (int(round(v)) for v in box)
+    x0, y0 = min(max(0, x), width - 1), min(max(0, y), height - 1)
+    x1, y1 = max(x0 + 1, min(width, x + w)), max(y0 + 1, min(height, y + h))
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def roi_window(shape, box, algo, params):
+    """
+    Part of the images the matchers need to compute the disparities of a box: its rows plus the block halo
+    (with the prefilter window of StereoBM, or the 3x3 Sobel and ROI_SGBM_MARGIN of SGBM), and its columns plus
+    the halo and the disparity search range, min_disp + num_disp columns to the left (to the right for negative
+    min_disp). The window is widened to the right when it would be narrower than the search range.
+    :param box: (x, y, w, h) inside the image
+    :return: window (x, y, w, h) clamped to the image
+    """
+    height, width = shape[:2]
+    halo = int(params["block_size"]) // 2
+    halo += int(params["prefilter_size"]) // 2 if algo == "bm" else 1 + ROI_SGBM_MARGIN
+    min_disp, num_disp = int(params["min_disp"]), int(params["num_disp"])
+    search = max(0, min_disp) + num_disp
+    x, y, w, h = box
+    x0 = max(0, x - max(0, min_disp + num_disp) - halo)
+    x1 = min(width, max(x + w + halo + max(0, -min_disp), x0 + search + 2 * halo + 1))
+    y0, y1 = max(0, y - halo), min(height, y + h + halo)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def compute_roi_disparity(left, right, algo, params, box, pair_key=None, **kwargs):
+    """
+    Computes the disparities of a box only, by running compute_disparity on the roi_window of both images: the
+    time depends on the size of the box, not of the image. The values are the ones of the full image, except
+    where speckle filtering or the WLS filter join regions across the window border, and for SGBM modes whose
+    aggregation reaches further than ROI_SGBM_MARGIN (mostly 3-way).
+    :param box: (x, y, w, h), clamped to the image
+    :param pair_key: see compute_disparity, the window is added to it
+    :param kwargs: matchers and check, see compute_disparity
+    :return: disparity map of the box, the clamped box and the window that was matched
+    """
+    box = clamp_box(box, left.shape)
+    window = roi_window(left.shape, box, algo, params)
+    wx, wy, ww, wh = window
+    rows, columns = slice(wy, wy + wh), slice(wx, wx + ww)
+    if pair_key is not None:
+        pair_key = (pair_key, "roi", window)
+    disparity_map, _ = compute_disparity(left[rows, columns], right[rows, columns], algo, params,
+                                         pair_key=pair_key, **kwargs)
+    x, y, w, h = box
+    return disparity_map[y - wy:y - wy + h, x - wx:x - wx + w], box, window
+
+
+def polygon_mask(points, box, scale=1.0):
+    """
+    Rasterizes a lasso selection inside its bounding box
+    :param points: [(x, y), ...] polygon in full resolution image coordinates
+    :param box: (x, y, w, h) of the mask, in the coordinates of the scaled image
+    :param scale: size of the matched image relative to the full resolution (0.5 ** level)
+    :return: uint8 mask of shape (h, w), 255 inside the polygon
+    """
+    x, y, w, h = box
+    polygon = np.round(np.array(points, np.float64) * scale - (x, y)).astype(np.int32)
+    mask = np.zeros((h, w), np.uint8)
+    cv2.fillPoly(mask, [polygon], 255)
+    return mask
+
+
+def _compute_disparity_pooled(left, right, algo, params, matchers, check, pair_key):
+    with stage("setup"):
+        stereo = matchers.get_matcher(algo, matcher_parameters(params))
+    left, right = to_grayscale(left), to_grayscale(right)
+    if params.get("wls_filtering"):
+        return _compute_filtered(stereo, left, right, algo, params, matchers, check, pair_key)
+
+    with stage("compute"):
+        disparity_map = stereo.compute(left, right)
+    return _masked(disparity_map, algo, params), None
+
+
+def _masked(disparity_map, algo, params):
+    """
+    Invalidates the StereoBM pixels outside the valid region, like the NumPy engine does: the maps, and their
+    normalization for display, are then the same with both engines
+    """
+    if algo != "bm":
+        return disparity_map
+    with stage("postprocess"):
+        return mask_invalid_region(disparity_map, **matcher_parameters(params))
+
+
+def _compute_numpy_bm(left, right, params, pair_key):
+    key = matching_cost_key(pair_key, params) if pair_key is not None else None
+    costs = raw_disparities.get(key) if key is not None else None
+    if costs is None:
+        with stage("compute"):
+            costs = compute_matching_costs(left, right, **matcher_parameters(params))
+        if key is not None:
+            raw_disparities.put(key, costs)
+    with stage("postprocess"):
+        return postprocess(costs, **matcher_parameters(params))
+
+
+def _compute_filtered(stereo, left, right, algo, params, matchers, check, pair_key):
+    key = raw_disparity_key(pair_key, algo, params) if pair_key is not None else None
+    raw = raw_disparities.get(key) if key is not None else None
+    if raw is None:
+        with stage("setup"):
+            right_matcher = matchers.get_right_matcher() if matchers is not None else None
+        # Computed before the WLS filter of fresh matchers is created, see filtering
+        raw = compute_raw_disparities(stereo, left, right, right_matcher=right_matcher, check=check)
+        if key is not None:
+            raw_disparities.put(key, raw)
+
+    with stage("setup"):
+        wls_filter = matchers.get_wls_filter(params["lmbda"], params["sigma"]) if matchers is not None else None
+    disparity_map, roi = apply_wls_filter(stereo, left, *raw, lmbda=params["lmbda"], sigma=params["sigma"],
+                                          wls_filter=wls_filter)
+    return disparity_map, tuple(int(v) for v in roi)
+
+
+def normalize_disparity(disparity_map):
+    """
+    Scales the disparity map to an 8 bit image for display
+    """
+    with stage("normalize"):
+        return cv2.normalize(disparity_map, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX,
+                             dtype=cv2.CV_8U)
+
+
+def disparity_to_float(disparity_map, min_disp=0):
+    """
+    Converts matcher output to disparities in pixels. The int16 fixed-point maps of StereoBM/SGBM are divided
+    by 16 and their invalid pixels (below min_disp) become NaN; the 8 bit WLS output is already in pixels.
+    :param disparity_map: output of compute_disparity
+    :param min_disp: minimum disparity the map was computed with
+    :return: float32 array
+    """
+    if disparity_map.dtype == np.int16:
+        disparity = disparity_map.astype(np.float32) / cv2.StereoMatcher_DISP_SCALE
+        disparity[disparity_map < min_disp * cv2.StereoMatcher_DISP_SCALE] = np.nan
+        return disparity
+    return disparity_map.astype(np.float32)
@@ -0,0 +1,176 @@
+import collections
+import os
+import threading
+import time
+import traceback
+
+from cache import LRUCache
+from generation import generations
+
+# Slider steps on each side of the released value that are precomputed, 0 disables prefetching
+PREFETCH_STEPS = int(os.environ.get("STEREO_PREFETCH_STEPS", 2))
+# Time the session and the worker must stay idle before prefetching starts
+PREFETCH_IDLE_MS = int(os.environ.get("STEREO_PREFETCH_IDLE_MS", 400))
+# Computations predicted to take longer are not prefetched: OpenCV calls cannot be interrupted, so a real request
+# arriving meanwhile may wait for the end of the current one
+PREFETCH_MAX_MS = int(os.environ.get("STEREO_PREFETCH_MAX_MS", 500))
+# Compute seconds a session can spend on prefetching at once, and seconds regained per second
+PREFETCH_BUDGET_S = float(os.environ.get("STEREO_PREFETCH_BUDGET_S", 3))
+PREFETCH_BUDGET_RATE = float(os.environ.get("STEREO_PREFETCH_BUDGET_RATE", 0.1))
+
+
+class PrefetchCancelled(Exception):
+    """
+    Raised at a checkpoint of a prefetch computation when a real request needs the worker
+    """
+
+
+class Schedule:
+    def __init__(self, generation, tasks, not_before):
+        self.generation = generation
+        self.tasks = collections.deque(tasks)
+        self.not_before = not_before
+
+
+class Prefetcher:
+    """
+    Speculative computations run while the worker is idle: after a slider is released, the results of the
+    neighboring values of the same slider are computed in a background thread, so the next move of the user is
+    a result cache hit.
+
+    Each session has one schedule, replaced by the next one. Prefetching waits until the session and the
+    worker have been idle for idle seconds and is cancelled at the next checkpoint as soon as a real request
+    starts in the worker, or the session makes a new request. Since a running OpenCV call cannot be interrupted,
+    tasks skip computations predicted to take more than max_seconds. The compute time of every session is
+    limited by a token bucket of budget seconds, refilled at rate seconds per second.
+    """
+
+    def __init__(self, steps=PREFETCH_STEPS, idle=PREFETCH_IDLE_MS / 1000.0, max_seconds=PREFETCH_MAX_MS / 1000.0,
+                 budget=PREFETCH_BUDGET_S, rate=PREFETCH_BUDGET_RATE):
+        self.steps = steps
+        self.idle = idle
+        self.max_seconds = max_seconds
+        self.budget = budget
+        self.rate = rate
+        self._pid = None
+        self._start_lock = threading.Lock()
+        # Real requests (callbacks and jobs) running in this process
+        self._active = 0
+        self._last_request = 0.0
+        self._active_lock = threading.Lock()
+        # Session id -> (tokens, time of the last update)
+        self._budgets = LRUCache(max_entries=4096)
+        self.counts = dict(scheduled=0, computed=0, skipped=0, cancelled=0, over_budget=0, failed=0)
+
+    def _start(self):
+        # Like the job queue, the thread is started in the process that schedules, never in the gunicorn master
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._cond = threading.Condition()
+            self._schedules = collections.OrderedDict()
+            threading.Thread(target=self._run, name="prefetch", daemon=True).start()
+            self._pid = os.getpid()
+
+    def begin_request(self):
+        with self._active_lock:
+            self._active += 1
+            self._last_request = time.time()
+
+    def end_request(self):
+        with self._active_lock:
+            self._active -= 1
+            self._last_request = time.time()
+
+    def busy(self):
+        return self._active > 0
+
+    def schedule(self, session_id, generation, tasks):
+        """
+        Replaces the schedule of the session
+        :param generation: generation of the request the tasks are derived from, they are dropped once the
+            session makes a newer request
+        :param tasks: functions called with a check function to call between stages, most likely first. They
+            return False when they skipped the computation.
+        """
+        if self.steps <= 0 or not tasks:
+            return
+        self._start()
+        with self._cond:
+            self._schedules.pop(session_id, None)
+            self._schedules[session_id] = Schedule(generation, tasks, time.time() + self.idle)
+            self.counts["scheduled"] += len(tasks)
+            self._cond.notify()
+
+    def _tokens(self, session_id, spent=0.0):
+        """
+        :return: compute seconds left to the session after spending spent
+        """
+        now = time.time()
+        tokens, updated = self._budgets.get(session_id) or (self.budget, now)
+        tokens = min(self.budget, tokens + self.rate * (now - updated)) - spent
+        self._budgets.put(session_id, (tokens, now))
+        return tokens
+
+    def _take(self):
+        """
+        Next task to run, or the time to wait before one can run. Must be called with the condition held.
+        :return: (session id, schedule, task) or None, seconds to wait
+        """
+        now = time.time()
+        ready = max(self._last_request + self.idle, now)
+        if self.busy() or ready > now:
+            return None, (self.idle if self.busy() else ready - now)
+        wait = None
+        for session_id, schedule in list(self._schedules.items()):
+            if not generations.is_current(session_id, schedule.generation) or not schedule.tasks:
+                del self._schedules[session_id]
+            elif self._tokens(session_id) <= 0:
+                del self._schedules[session_id]
+                self.counts["over_budget"] += len(schedule.tasks)
+            elif schedule.not_before > now:
+                wait = min(wait or schedule.not_before - now, schedule.not_before - now)
+            else:
+                # Sessions take turns, one task each
+                self._schedules.move_to_end(session_id)
+                return (session_id, schedule, schedule.tasks.popleft()), None
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                task, wait = self._take()
+                while task is None:
+                    self._cond.wait(timeout=wait)
+                    task, wait = self._take()
+            session_id, schedule, function = task
+
+            def check():
+                if self.busy() or not generations.is_current(session_id, schedule.generation):
+                    raise PrefetchCancelled(f"prefetch of session {session_id} cancelled")
+
+            t_start = time.time()
+            try:
+                self.counts["computed" if function(check) is not False else "skipped"] += 1
+            except PrefetchCancelled:
+                self.counts["cancelled"] += 1
+                with self._cond:
+                    # Interrupted by another session: try again once the worker is idle
+                    if session_id in self._schedules and self._schedules[session_id] is schedule:
+                        schedule.tasks.appendleft(function)
+            except Exception:
+                traceback.print_exc()
+                self.counts["failed"] += 1
+            finally:
+                self._tokens(session_id, time.time() - t_start)
+
+    def stats(self):
+        pending = 0
+        if self._pid == os.getpid():
+            with self._cond:
+                pending = sum(len(schedule.tasks) for schedule in self._schedules.values())
+        return dict(steps=self.steps, idle=self.idle, max_seconds=self.max_seconds, budget=self.budget,
+                    rate=self.rate, active=self._active, pending=pending, **self.counts)
+
+
+prefetcher = Prefetcher()
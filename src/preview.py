@@ -0,0 +1,118 @@
+import os
+import threading
+
+from cache import LRUCache
+
+# Latency that a preview computation should stay under while a slider is being dragged
+PREVIEW_TARGET_MS = float(os.environ.get("STEREO_PREVIEW_TARGET_MS", 150))
+MAX_PREVIEW_LEVEL = int(os.environ.get("STEREO_MAX_PREVIEW_LEVEL", 3))
+
+
+def _round_to_16(value):
+    return max(16, int(round(value / 16.0)) * 16)
+
+
+def _odd(value, minimum):
+    value = max(minimum, int(value))
+    return value if value % 2 else value + 1
+
+
+def scale_parameters(algo, params, level):
+    """
+    Adapts the parameters to a pyramid level, where the images are 2 ** level times smaller: disparities
+    and windows shrink by the same factor so that the preview looks like the full resolution result.
+    :param algo: "bm" or "sgbm"
+    :param params: parameters as returned by pipeline.build_parameters
+    :param level: pyramid level, 0 is the full resolution
+    :return: new parameter dictionary
+    """
+    if level == 0:
+        return dict(params)
+
+    factor = 2 ** level
+    scaled = dict(params)
+    scaled["num_disp"] = _round_to_16(params["num_disp"] / factor)
+    scaled["min_disp"] = int(round(params["min_disp"] / factor))
+    scaled["block_size"] = _odd(params["block_size"] / factor, 5 if algo == "bm" else 1)
+    # Speckle windows are areas, speckle range is a disparity difference
+    scaled["speckle_windows_size"] = int(params["speckle_windows_size"] / (factor * factor))
+    if params["speckle_range"] > 0:
+        scaled["speckle_range"] = max(1, int(round(params["speckle_range"] / factor)))
+
+    if algo == "bm":
+        scaled["prefilter_size"] = _odd(params["prefilter_size"] / factor, 5)
+    else:
+        # P1 and P2 are penalties summed over the block, so they scale with its area
+        area_ratio = (scaled["block_size"] / float(params["block_size"])) ** 2
+        scaled["p1"] = int(round(params["p1"] * area_ratio))
+        scaled["p2"] = int(round(params["p2"] * area_ratio))
+    return scaled
+
+
+class PreviewController:
+    """
+    Picks the pyramid level of the previews of a session. It keeps a moving average of the matching cost
+    per pixel and disparity, and chooses the finest level whose predicted time stays under the target.
+    """
+
+    def __init__(self, target_ms=PREVIEW_TARGET_MS, max_level=MAX_PREVIEW_LEVEL, smoothing=0.3):
+        self.target = target_ms / 1000.0
+        self.max_level = max_level
+        self.smoothing = smoothing
+        self.seconds_per_unit = {}
+
+    @staticmethod
+    def _units(shape, num_disp):
+        return float(shape[0]) * shape[1] * num_disp
+
+    def record(self, algo, shape, num_disp, seconds):
+        """
+        Updates the cost estimate with a measured computation
+        :param shape: shape of the matched images
+        :param num_disp: number of disparities that were searched
+        :param seconds: measured time
+        """
+        rate = seconds / max(self._units(shape, num_disp), 1.0)
+        previous = self.seconds_per_unit.get(algo)
+        if previous is None:
+            self.seconds_per_unit[algo] = rate
+        else:
+            self.seconds_per_unit[algo] = (1 - self.smoothing) * previous + self.smoothing * rate
+
+    def estimate(self, algo, shape, num_disp):
+        """
+        :return: predicted seconds of a computation on images of the given shape, None before any measurement
+        """
+        rate = self.seconds_per_unit.get(algo)
+        return None if rate is None else rate * self._units(shape, num_disp)
+
+    def choose_level(self, algo, shape, num_disp):
+        """
+        :return: pyramid level to use for the next preview
+        """
+        # The downsampled image must stay wider than the disparity search range
+        max_level = 0
+        while max_level < self.max_level and \
+                shape[1] / 2 ** (max_level + 1) > _round_to_16(num_disp / 2 ** (max_level + 1)) + 32:
+            max_level += 1
+
+        rate = self.seconds_per_unit.get(algo)
+        if rate is None:
+            # Nothing measured yet, start coarse
+            return max_level
+
+        for level in range(max_level + 1):
+            factor = 2 ** level
+            units = self._units((shape[0] / factor, shape[1] / factor), _round_to_16(num_disp / factor))
+            if rate * units <= self.target:
+                return level
+        return max_level
+
+
+preview_controllers = LRUCache(max_entries=256)
+_controllers_lock = threading.Lock()
+
+
+def get_preview_controller(session_id):
+    with _controllers_lock:
+        return preview_controllers.get_or_compute(session_id, PreviewController)
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+from cache import LRUCache
+
+# Remap tables are written here, one directory per calibration and image size, and memory-mapped by the next
+# runs and by every worker process. Empty to keep them in memory only.
+RECTIFY_CACHE_DIR = os.environ.get("STEREO_RECTIFY_CACHE_DIR", "./rectify_maps")
+# Free scaling of stereoRectify: 0 keeps only valid pixels (zoomed in), 1 keeps every source pixel (black borders)
+RECTIFY_ALPHA = float(os.environ.get("STEREO_RECTIFY_ALPHA", 0))
+# Format of the remap tables: "16sc2" (fixed-point, 6 bytes per pixel and camera) or "32fc1" (float, 8 bytes).
+# Run benchmark.py rectify to compare their cv2.remap speed on the deployment's OpenCV build.
+RECTIFY_MAP_TYPE = os.environ.get("STEREO_RECTIFY_MAP_TYPE", "16sc2")
+# Remap tables kept in memory per process
+RECTIFY_CACHE_ENTRIES = int(os.environ.get("STEREO_RECTIFY_CACHE_ENTRIES", 4))
+
+CALIBRATION_KEYS = ("K1", "D1", "K2", "D2", "R", "T")
+# Names used by the OpenCV stereo_calib sample and by stereoCalibrate
+_ALIASES = dict(M1="K1", M2="K2", cameraMatrix1="K1", cameraMatrix2="K2", distCoeffs1="D1", distCoeffs2="D2")
+MAP_TYPES = {"16sc2": cv2.CV_16SC2, "32fc1": cv2.CV_32FC1}
+_MAP_FILES = ("left_map1", "left_map2", "right_map1", "right_map2")
+
+_maps = LRUCache(max_entries=RECTIFY_CACHE_ENTRIES)
+_maps_lock = threading.Lock()
+
+
+def load_calibration(path):
+    """
+    Reads a stereo calibration: JSON with nested lists, or the YAML/XML files of cv2.FileStorage (as written by
+    the OpenCV stereo_calib sample, intrinsics and extrinsics can be in the same file). M1/M2 are accepted for
+    K1/K2. An optional image_size (width, height) gives the resolution the calibration was made at, the camera
+    matrices are scaled to other image sizes.
+    :return: dictionary of float64 arrays K1, D1, K2, D2, R, T and image_size, a (width, height) tuple or None
+    """
+    values = {}
+    if path.endswith(".json"):
+        with open(path) as infile:
+            values = json.load(infile)
+    else:
+        storage = cv2.FileStorage(path, cv2.FILE_STORAGE_READ)
+        if not storage.isOpened():
+            raise IOError(f"Could not read calibration {path}")
+        try:
+            for name in CALIBRATION_KEYS + tuple(_ALIASES) + ("image_size",):
+                node = storage.getNode(name)
+                if node.empty():
+                    continue
+                # Matrices are maps (!!opencv-matrix), plain sequences like image_size are read value by value
+                values[name] = [node.at(i).real() for i in range(node.size())] if node.isSeq() else node.mat()
+        finally:
+            storage.release()
+
+    calibration = {}
+    for name, value in values.items():
+        name = _ALIASES.get(name, name)
+        if name in CALIBRATION_KEYS:
+            calibration[name] = np.asarray(value, np.float64)
+    missing = [name for name in CALIBRATION_KEYS if name not in calibration]
+    if missing:
+        raise ValueError(f"Calibration {path} misses {', '.join(missing)}")
+    for name in ("K1", "K2", "R"):
+        calibration[name] = calibration[name].reshape(3, 3)
+    calibration["T"] = calibration["T"].reshape(3, 1)
+    for name in ("D1", "D2"):
+        calibration[name] = calibration[name].reshape(1, -1)
+    image_size = values.get("image_size")
+    calibration["image_size"] = tuple(int(v) for v in np.asarray(image_size).reshape(-1)) if image_size is not None \
+        else None
+    return calibration
+
+
+def calibration_key(calibration, image_size, alpha, map_type=RECTIFY_MAP_TYPE):
+    """
+    Identifies the remap tables of a calibration at an image size (width, height): a hash of the parameters
+    """
+    digest = hashlib.sha1()
+    for name in CALIBRATION_KEYS:
+        digest.update(np.ascontiguousarray(calibration[name], np.float64).tobytes())
+    digest.update(json.dumps([calibration.get("image_size"), list(image_size), float(alpha), map_type]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _camera_matrix(matrix, calibration_size, image_size):
+    """
+    Scales a camera matrix calibrated at calibration_size to image_size, e.g. frames decoded at a lower resolution
+    """
+    if calibration_size is None or tuple(calibration_size) == tuple(image_size):
+        return matrix
+    matrix = matrix.copy()
+    matrix[0] *= image_size[0] / calibration_size[0]
+    matrix[1] *= image_size[1] / calibration_size[1]
+    return matrix
+
+
+def compute_rectification(calibration, image_size, alpha=RECTIFY_ALPHA, map_type=RECTIFY_MAP_TYPE):
+    """
+    Runs stereoRectify and initUndistortRectifyMap
+    :param image_size: (width, height) of the frames
+    :param map_type: "16sc2" for fixed-point tables (integer coordinates and interpolation indices) or "32fc1"
+        for float x and y tables
+    :return: dictionary with the remap tables of both cameras (left_map1, left_map2, right_map1, right_map2), the
+        disparity-to-depth matrix Q and the valid regions (x, y, w, h) of the rectified images
+    """
+    k1 = _camera_matrix(calibration["K1"], calibration.get("image_size"), image_size)
+    k2 = _camera_matrix(calibration["K2"], calibration.get("image_size"), image_size)
+    r1, r2, p1, p2, q, roi1, roi2 = cv2.stereoRectify(k1, calibration["D1"], k2, calibration["D2"], image_size,
+                                                      calibration["R"], calibration["T"],
+                                                      flags=cv2.CALIB_ZERO_DISPARITY, alpha=alpha)
+    rectification = dict(Q=q, left_roi=tuple(int(v) for v in roi1), right_roi=tuple(int(v) for v in roi2))
+    for side, k, d, r, p in (("left", k1, calibration["D1"], r1, p1), ("right", k2, calibration["D2"], r2, p2)):
+        rectification[f"{side}_map1"], rectification[f"{side}_map2"] = \
+            cv2.initUndistortRectifyMap(k, d, r, p, image_size, MAP_TYPES[map_type])
+    return rectification
+
+
+def read_cached_maps(directory):
+    """
+    Memory-maps remap tables written by _write_cached, the pages are shared by all the processes using them
+    :return: dictionary as returned by compute_rectification, or None if the directory is missing or incomplete
+    """
+    try:
+        with open(os.path.join(directory, "meta.json")) as infile:
+            meta = json.load(infile)
+        rectification = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in _MAP_FILES}
+    except (OSError, ValueError):
+        return None
+    rectification.update(Q=np.array(meta["Q"], np.float64), left_roi=tuple(meta["left_roi"]),
+                         right_roi=tuple(meta["right_roi"]))
+    return rectification
+
+
+def _write_cached(directory, rectification):
+    """
+    Writes the tables to a temporary directory renamed into place, so that concurrent processes never read a
+    partial entry. When another process wins the race, its entry is kept.
+    :return: True if this call wrote the entry
+    """
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    tmp_directory = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        for name in _MAP_FILES:
+            np.save(os.path.join(tmp_directory, name + ".npy"), rectification[name])
+        with open(os.path.join(tmp_directory, "meta.json"), "w") as outfile:
+            json.dump(dict(Q=rectification["Q"].tolist(), left_roi=rectification["left_roi"],
+                           right_roi=rectification["right_roi"]), outfile)
+        os.rename(tmp_directory, directory)
+    except OSError:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        if not os.path.isdir(directory):
+            raise
+        return False
+    return True
+
+
+def rectification_maps(calibration, image_size, alpha=RECTIFY_ALPHA, cache_dir=RECTIFY_CACHE_DIR,
+                       map_type=RECTIFY_MAP_TYPE):
+    """
+    Remap tables of a calibration at an image size, computed once: they are looked up in memory, then in
+    cache_dir, and only computed (and written to cache_dir) when both miss
+    :param image_size: (width, height) of the frames
+    :return: see compute_rectification
+    """
+    image_size = tuple(int(v) for v in image_size)
+    key = calibration_key(calibration, image_size, alpha, map_type)
+    rectification = _maps.get(key)
+    if rectification is not None:
+        return rectification
+    # Concurrent threads of a process wait for the first one instead of computing the same tables
+    with _maps_lock:
+        rectification = _maps.get(key)
+        if rectification is not None:
+            return rectification
+        directory = os.path.join(cache_dir, key) if cache_dir else None
+        rectification = read_cached_maps(directory) if directory else None
+        if rectification is None:
+            rectification = compute_rectification(calibration, image_size, alpha, map_type)
+            if directory and _write_cached(directory, rectification):
+                print(f"Saved rectification maps {image_size[0]}x{image_size[1]} to {directory}")
+        _maps.put(key, rectification)
+    return rectification
+
+
+class Rectifier:
+    """
+    Undistorts and rectifies stereo pairs with a fixed calibration: each image costs a single cv2.remap with
+    tables computed once per image size (see rectification_maps)
+    """
+
+    def __init__(self, calibration, alpha=RECTIFY_ALPHA, cache_dir=RECTIFY_CACHE_DIR, map_type=RECTIFY_MAP_TYPE,
+                 interpolation=cv2.INTER_LINEAR):
+        if map_type not in MAP_TYPES:
+            raise ValueError(f"Unknown remap table type {map_type}, expected one of {', '.join(MAP_TYPES)}")
+        self.calibration = calibration
+        self.alpha = alpha
+        self.cache_dir = cache_dir
+        self.map_type = map_type
+        self.interpolation = interpolation
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(load_calibration(path), **kwargs)
+
+    def maps(self, shape):
+        """
+        :param shape: image shape, (height, width[, channels])
+        :return: see compute_rectification
+        """
+        return rectification_maps(self.calibration, (shape[1], shape[0]), self.alpha, self.cache_dir, self.map_type)
+
+    def __call__(self, left, right):
+        """
+        :return: rectified left and right images, same shape and type as the inputs
+        """
+        if left.shape[:2] != right.shape[:2]:
+            raise ValueError(f"Left {left.shape} and right {right.shape} images differ in size")
+        maps = self.maps(left.shape)
+        return (cv2.remap(left, maps["left_map1"], maps["left_map2"], self.interpolation),
+                cv2.remap(right, maps["right_map1"], maps["right_map2"], self.interpolation))
@@ -0,0 +1,76 @@
+import os
+
+import cv2
+
+from image_store import image_store
+from timing import stage
+
+# Encoder specs are "<format>[:<level>]": png:<compression 0-9>, jpeg:<quality 0-100>, webp:<quality 1-100>.
+# PNG at compression 1 is several times faster than the default level and still lossless.
+DISPARITY_ENCODER = os.environ.get("STEREO_DISPARITY_ENCODER", "png:1")
+PREVIEW_ENCODER = os.environ.get("STEREO_PREVIEW_ENCODER", "jpeg:85")
+LEFT_IMAGE_ENCODER = os.environ.get("STEREO_LEFT_IMAGE_ENCODER", "jpeg:90")
+
+RENDERED_NAMESPACE = "rendered"
+RENDERED_ROUTE = "/rendered"
+
+MIMETYPES = dict(png="image/png", jpeg="image/jpeg", webp="image/webp")
+
+_ENCODER_PARAMS = dict(png=(cv2.IMWRITE_PNG_COMPRESSION, 3),
+                       jpeg=(cv2.IMWRITE_JPEG_QUALITY, 90),
+                       webp=(cv2.IMWRITE_WEBP_QUALITY, 90))
+
+
+def parse_encoder(spec):
+    """
+    :param spec: encoder spec, e.g. "png:1" or "jpeg:85"
+    :return: image format and the parameters for cv2.imencode
+    """
+    fmt, _, level = spec.lower().partition(":")
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in _ENCODER_PARAMS:
+        raise ValueError(f"Unsupported image encoder: {spec!r}")
+    flag, default = _ENCODER_PARAMS[fmt]
+    return fmt, [flag, int(level) if level else default]
+
+
+def encode_image(image, spec):
+    """
+    Encodes an RGB(A) or single channel uint8 image
+    :param image: numpy array
+    :param spec: encoder spec
+    :return: encoded bytes and their format
+    """
+    fmt, params = parse_encoder(spec)
+    if len(image.shape) > 2:
+        if image.shape[2] == 4:
+            # JPEG has no alpha channel
+            code = cv2.COLOR_RGBA2BGR if fmt == "jpeg" else cv2.COLOR_RGBA2BGRA
+        else:
+            code = cv2.COLOR_RGB2BGR
+        image = cv2.cvtColor(image, code)
+    ok, buffer = cv2.imencode("." + fmt, image, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {fmt}")
+    return buffer.tobytes(), fmt
+
+
+def render_image(image, spec):
+    """
+    Encodes the image and stores it by content hash, so it can be served by the rendered images route
+    :return: URL of the image
+    """
+    with stage("encode"):
+        data, fmt = encode_image(image, spec)
+    key = image_store.put(RENDERED_NAMESPACE, data)
+    return f"{RENDERED_ROUTE}/{key}.{fmt}"
+
+
+def is_rendered(url):
+    """
+    Whether the image of a URL returned by render_image is still in the store, marking it as recently used.
+    Cached results whose image was evicted must be rendered again.
+    """
+    key = url.rsplit("/", 1)[-1].partition(".")[0]
+    return image_store.touch(RENDERED_NAMESPACE, key)
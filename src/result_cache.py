@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from cache import REDIS_URL, LRUCache, get_redis_client, redis
+
+RESULT_CACHE_ENTRIES = int(os.environ.get("STEREO_RESULT_CACHE_ENTRIES", 512))
+RESULT_CACHE_MB = int(os.environ.get("STEREO_RESULT_CACHE_MB", 128))
+REDIS_TTL = int(os.environ.get("STEREO_REDIS_TTL", 3600))
+RAW_CACHE_MB = int(os.environ.get("STEREO_RAW_CACHE_MB", 256))
+
+logger = logging.getLogger(__name__)
+
+
+def result_key(*parts):
+    """
+    Builds a cache key from hashable/JSON-serializable parts, e.g. the image hashes, the algorithm
+    and the parameter dictionary
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Two tier cache of rendered results. The first tier is an in-process LRU bounded by entries and bytes.
+    The optional second tier is a Redis server shared by all gunicorn workers, so a result computed by
+    one worker is a hit for the others.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_ENTRIES, max_bytes=RESULT_CACHE_MB * 1024 * 1024,
+                 redis_url=REDIS_URL, ttl=REDIS_TTL, prefix="stereo-result:v2:"):
+        self.local = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.prefix = prefix
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.redis_errors = 0
+
+    def _client(self):
+        return get_redis_client(self.redis_url)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        client = self._client()
+        if client is None:
+            return None
+        try:
+            raw = client.get(self.prefix + key)
+        except redis.RedisError as e:
+            self.redis_errors += 1
+            logger.warning("Redis cache unavailable: %s", e)
+            return None
+        if raw is None:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        value = pickle.loads(raw)
+        self.local.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.local.put(key, value)
+
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.set(self.prefix + key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ex=self.ttl)
+        except redis.RedisError as e:
+            self.redis_errors += 1
+            logger.warning("Redis cache unavailable: %s", e)
+
+    def stats(self):
+        stats = dict(local=self.local.stats())
+        if self.redis_url:
+            stats["redis"] = dict(url=self.redis_url,
+                                  enabled=redis is not None,
+                                  hits=self.redis_hits,
+                                  misses=self.redis_misses,
+                                  errors=self.redis_errors)
+        return stats
+
+
+result_cache = ResultCache()
+
+# Raw int16 left/right matcher outputs of WLS runs and matching costs of the NumPy StereoBM engine. They are much
+# bigger than the rendered results and only useful to the worker that keeps computing for the session, so they stay
+# in-process.
+raw_disparities = LRUCache(max_bytes=RAW_CACHE_MB * 1024 * 1024)
@@ -0,0 +1,356 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import cv2
+import numpy as np
+
+from batch import find_pairs
+from disparity_map import read_grayscale
+from evaluation import evaluate_disparity, load_ground_truth
+from matcher_pool import MatcherSet
+from parameter_space import CHOICES, SearchSpace, algorithm_parameters, default_parameters
+from pipeline import compute_disparity, disparity_to_float, matcher_parameters
+from preview import scale_parameters
+
+OBJECTIVES = {}
+
+# Per worker process state, set by _init_worker
+_worker = {}
+
+
+def objective(name):
+    """
+    Registers a scoring function under name. Objectives receive a Sample, the disparity map computed for it,
+    the algorithm, the parameters and the MatcherSet of the worker, and return a score where higher is better.
+    """
+    def register(function):
+        OBJECTIVES[name] = function
+        return function
+    return register
+
+
+@objective("density")
+def valid_density(sample, disparity_map, algo, params, matchers=None):
+    """
+    Fraction of pixels with a valid disparity
+    """
+    disparity = disparity_to_float(disparity_map, params["min_disp"])
+    return float(np.isfinite(disparity).mean())
+
+
+@objective("lr_consistency")
+def left_right_consistency(sample, disparity_map, algo, params, matchers=None, max_difference=1.0):
+    """
+    Fraction of pixels whose left disparity agrees (within max_difference) with the disparity of the matching
+    pixel in the right view. Invalid pixels count as inconsistent, so sparse maps are penalized as well.
+    :param matchers: MatcherSet whose matchers are reconfigured instead of creating new ones for every sample
+    """
+    if matchers is None:
+        matchers = MatcherSet()
+    with matchers.lock:
+        matchers.get_matcher(algo, matcher_parameters(params))
+        right_matcher = matchers.get_right_matcher()
+        right_disparity = -right_matcher.compute(sample.right, sample.left).astype(np.float32) / \
+            cv2.StereoMatcher_DISP_SCALE
+    # Invalid right pixels come out as min_disp + num_disp, outside the range of the left disparities
+    right_disparity[right_disparity >= params["min_disp"] + params["num_disp"]] = np.nan
+
+    disparity = disparity_to_float(disparity_map, params["min_disp"])
+    height, width = disparity.shape
+    xs = np.arange(width)[None, :] - np.nan_to_num(disparity, nan=-width)
+    valid = np.isfinite(disparity) & (xs >= 0) & (xs <= width - 1)
+    rows = np.broadcast_to(np.arange(height)[:, None], disparity.shape)
+    matched = right_disparity[rows[valid], np.round(xs[valid]).astype(int)]
+    consistent = np.abs(disparity[valid] - matched) <= max_difference
+    return float(consistent.sum()) / disparity.size
+
+
+@objective("ground_truth")
+def ground_truth_accuracy(sample, disparity_map, algo, params, matchers=None, threshold=2.0):
+    """
+    1 - bad-2 rate against the ground truth. Pixels without a computed disparity count as errors.
+    """
+    if sample.ground_truth is None:
+        raise ValueError("The ground_truth objective needs ground truth disparities")
+    metrics = evaluate_disparity(disparity_map, sample.ground_truth, params["min_disp"], thresholds=(threshold,))
+    return 1.0 - metrics[f"bad_{threshold:g}"]
+
+
+class Sample:
+    """
+    Stereo pair (and optional ground truth) at one pyramid level
+    """
+
+    def __init__(self, left, right, ground_truth=None):
+        self.left = left
+        self.right = right
+        self.ground_truth = ground_truth
+
+    def downsampled(self):
+        ground_truth = None
+        if self.ground_truth is not None:
+            height, width = (self.left.shape[0] + 1) // 2, (self.left.shape[1] + 1) // 2
+            ground_truth = cv2.resize(self.ground_truth, (width, height), interpolation=cv2.INTER_NEAREST) / 2.0
+        return Sample(cv2.pyrDown(self.left), cv2.pyrDown(self.right), ground_truth)
+
+
+def fit_to_image(algo, params, shape):
+    """
+    Limits the disparity range and the block to an image: StereoBM raises on blocks larger than the image, the
+    WLS filter on blocks wider than the columns left by the disparity range, and disparities past half the width
+    leave few pixels to match. Random samples of the full slider ranges are
+    often too large for the coarse pyramid levels.
+    :param shape: (height, width) of the smallest image the parameters are used on
+    :return: new parameter dictionary
+    """
+    height, width = shape[:2]
+    fitted = dict(params)
+    max_range = width // 2
+    fitted["num_disp"] = max(16, min(params["num_disp"], max_range // 16 * 16))
+    fitted["min_disp"] = max(-1, min(params["min_disp"], max_range - fitted["num_disp"]))
+    # The block must also fit in the columns left by the disparity range, else the WLS filter has no valid ROI
+    limit = min(height, width - max(0, fitted["min_disp"]) - fitted["num_disp"])
+    max_block = limit - 1 - limit % 2
+    fitted["block_size"] = max(5 if algo == "bm" else 1, min(params["block_size"], max_block))
+    return fitted
+
+
+def _init_worker(paths, levels, threads):
+    cv2.setNumThreads(threads)
+    pyramids = []
+    for left_path, right_path, ground_truth_path in paths:
+        sample = Sample(read_grayscale(left_path), read_grayscale(right_path),
+                        load_ground_truth(ground_truth_path) if ground_truth_path else None)
+        pyramid = [sample]
+        for _ in range(1, levels):
+            pyramid.append(pyramid[-1].downsampled())
+        pyramids.append(pyramid)
+    _worker["pyramids"] = pyramids
+    _worker["matchers"] = {}
+
+
+def evaluate(task):
+    """
+    Scores one candidate on every pair. Runs in the worker processes.
+    :param task: (candidate id, algorithm, parameters, pyramid level, objective name)
+    :return: (candidate id, level, mean score or None if the matcher failed, seconds)
+    """
+    candidate, algo, params, level, objective_name = task
+    t_start = time.time()
+    scoring = OBJECTIVES[objective_name]
+    matchers = _worker["matchers"].setdefault(level, MatcherSet())
+    scores = []
+    try:
+        for pyramid in _worker["pyramids"]:
+            sample = pyramid[level]
+            level_params = fit_to_image(algo, scale_parameters(algo, params, level), sample.left.shape)
+            disparity_map, _ = compute_disparity(sample.left, sample.right, algo, level_params, matchers=matchers)
+            scores.append(scoring(sample, disparity_map, algo, level_params, matchers=matchers))
+    except cv2.error:
+        # e.g. more disparities than the image width
+        return candidate, level, None, time.time() - t_start
+    return candidate, level, float(np.mean(scores)), time.time() - t_start
+
+
+class ParameterSearch:
+    """
+    Explores a SearchSpace with a process pool. Strategies:
+
+    * grid: every combination of the dimensions
+    * random: max_evals random candidates
+    * halving: successive halving, max_evals random candidates are scored on the coarsest pyramid level,
+      the best 1/eta move on to the next finer level until the full resolution is reached
+
+    Grid and random searches stop early after ``patience`` evaluations without improvement or when a score
+    reaches ``target``.
+    """
+
+    def __init__(self, space, paths, objective_name="lr_consistency", workers=None, threads=1, max_evals=100,
+                 patience=None, target=None, levels=3, eta=3, seed=0):
+        if objective_name not in OBJECTIVES:
+            raise ValueError(f"Unknown objective {objective_name!r}, available: {', '.join(OBJECTIVES)}")
+        self.space = space
+        self.paths = paths
+        # Candidates are fitted to the smallest pair, so the saved parameters are the ones that were scored
+        shapes = [read_grayscale(left).shape for left, _, _ in paths]
+        self.shape = (min(shape[0] for shape in shapes), min(shape[1] for shape in shapes))
+        self.objective_name = objective_name
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.max_evals = max_evals
+        self.patience = patience
+        self.target = target
+        self.levels = levels
+        self.eta = eta
+        self.rng = random.Random(seed)
+        self.history = []
+
+    def _candidates(self, strategy):
+        if strategy == "grid":
+            size = self.space.size()
+            if size > self.max_evals:
+                print(f"Grid has {size} points, only the first {self.max_evals} are evaluated")
+            grid = self.space.grid()
+            return [next(grid) for _ in range(min(size, self.max_evals))]
+
+        candidates, seen = [], set()
+        # Random sampling may repeat itself on small spaces, give up after a few failed draws
+        for _ in range(10 * self.max_evals):
+            if len(candidates) == self.max_evals:
+                break
+            params = self.space.sample(self.rng)
+            key = json.dumps(params, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                candidates.append(params)
+        return candidates
+
+    def _run(self, pool, candidates, level, early_stopping):
+        """
+        Evaluates candidates on a pyramid level
+        :return: list of (score, candidate id)
+        """
+        tasks = [(i, self.space.algo, params, level, self.objective_name) for i, params in candidates]
+        params_by_id = dict(candidates)
+        results = []
+        failed = 0
+        best, since_best = None, 0
+        for done, (i, lvl, score, seconds) in enumerate(pool.imap_unordered(evaluate, tasks), 1):
+            self.history.append(dict(params=params_by_id[i], level=lvl, score=score, seconds=seconds))
+            if score is None:
+                failed += 1
+                continue
+            results.append((score, i))
+            if best is None or score > best:
+                best, since_best = score, 0
+                print(f"[{done}/{len(tasks)}] level {lvl}: new best {score:.4f}")
+            else:
+                since_best += 1
+            if early_stopping and ((self.target is not None and best >= self.target) or
+                                   (self.patience is not None and since_best >= self.patience)):
+                print(f"Stopping early after {done} evaluations")
+                break
+        if failed:
+            print(f"Level {level}: {failed} of {len(tasks)} candidates failed (OpenCV error)")
+        return results
+
+    def run(self, strategy="random"):
+        """
+        :return: best parameters and their score
+        """
+        candidates = list(enumerate(fit_to_image(self.space.algo, params, self.shape)
+                                    for params in self._candidates(strategy)))
+        print(f"{strategy} search over {len(candidates)} candidates with {self.workers} workers")
+        levels = self.levels if strategy == "halving" else 1
+        with multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                  initargs=(self.paths, levels, self.threads)) as pool:
+            if strategy != "halving":
+                results = self._run(pool, candidates, 0, early_stopping=True)
+            else:
+                results = []
+                for level in reversed(range(levels)):
+                    results = self._run(pool, candidates, level, early_stopping=False)
+                    # Failed candidates take their share: they are not replaced by worse ones
+                    keep = max(1, len(candidates) // self.eta) if level else len(candidates)
+                    survivors = {i for _, i in sorted(results, reverse=True)[:keep]}
+                    candidates = [(i, params) for i, params in candidates if i in survivors]
+                    print(f"Level {level}: {len(candidates)} candidates kept")
+
+        if not results:
+            raise RuntimeError("No candidate could be evaluated")
+        score, best = max(results)
+        return dict(candidates)[best], score
+
+
+def parse_range(text):
+    """
+    Parses "name=min:max:step" (any part may be empty) for sliders or "name=a,b" for choices
+    """
+    name, _, spec = text.partition("=")
+    if name in CHOICES:
+        values = [{"True": True, "False": False}.get(v, v) for v in spec.split(",")] if spec else None
+        return name, values
+    parts = [float(p) if "." in p else int(p) if p else None for p in spec.split(":")] if spec else []
+    return name, tuple(parts + [None] * (3 - len(parts)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Searches the matcher parameters automatically')
+    parser.add_argument('-l', '--left', nargs='+', default=[], help='Left images')
+    parser.add_argument('-r', '--right', nargs='+', default=[], help='Right images (same order as --left)')
+    parser.add_argument('-g', '--ground-truth', nargs='+', default=[], help='Ground truth disparities (.pfm, .npy, '
+                                                                           'or 16 bit PNG storing 256 x disparity)')
+    parser.add_argument('-d', '--pairs-dir', default=None, help='Directory of left/right pairs (batch.py naming)')
+    parser.add_argument('-a', '--algo', default='bm', choices=['bm', 'sgbm'])
+    parser.add_argument('-s', '--strategy', default='random', choices=['grid', 'random', 'halving'])
+    parser.add_argument('--objective', default='lr_consistency', choices=sorted(OBJECTIVES))
+    parser.add_argument('--space', nargs='+', default=None, metavar='NAME=MIN:MAX:STEP',
+                        help='Parameters to search (default: all parameters of the algorithm over the slider '
+                             'ranges). Choices are given as NAME=a,b')
+    parser.add_argument('--base', default=None, help='Parameter JSON with the values of the other parameters')
+    parser.add_argument('--grid-points', default=5, type=int, help='Values per dimension of grid searches')
+    parser.add_argument('-n', '--max-evals', default=100, type=int)
+    parser.add_argument('--patience', default=None, type=int, help='Stop after this many evaluations without '
+                                                                   'improvement')
+    parser.add_argument('--target', default=None, type=float, help='Stop when a score reaches this value')
+    parser.add_argument('--levels', default=3, type=int, help='Pyramid levels used by successive halving')
+    parser.add_argument('--eta', default=3, type=int, help='Successive halving keeps 1/eta of the candidates')
+    parser.add_argument('-w', '--workers', default=os.cpu_count() or 1, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('-o', '--output-dir', default='./bm_parameters')
+    parser.add_argument('--prefix', default=None, help='Prefix of the parameter file (default: from the first '
+                                                       'left image name)')
+    parser.add_argument('--log', default=None, help='Write every evaluation to this JSON file')
+    args = parser.parse_args()
+
+    if args.pairs_dir:
+        pairs = find_pairs(args.pairs_dir)
+    else:
+        pairs = list(zip(args.left, args.right))
+    if not pairs:
+        parser.error("No stereo pairs given")
+    ground_truth = args.ground_truth + [None] * (len(pairs) - len(args.ground_truth))
+    paths = [(left, right, gt) for (left, right), gt in zip(pairs, ground_truth)]
+
+    base = None
+    if args.base:
+        with open(args.base) as infile:
+            # The file may only give some parameters, the others keep their initial values
+            base = dict(default_parameters(args.algo), **json.load(infile))
+    ranges = dict(parse_range(text) for text in args.space) if args.space else None
+    if ranges:
+        unknown = set(ranges) - set(algorithm_parameters(args.algo))
+        if unknown:
+            parser.error(f"Not parameters of {args.algo}: {', '.join(sorted(unknown))}")
+    space = SearchSpace.from_ranges(args.algo, ranges, base=base,
+                                    max_points=args.grid_points if args.strategy == 'grid' else None)
+
+    search = ParameterSearch(space, paths, objective_name=args.objective, workers=args.workers,
+                             max_evals=args.max_evals, patience=args.patience, target=args.target,
+                             levels=args.levels, eta=args.eta, seed=args.seed)
+    t_start = time.time()
+    best, score = search.run(args.strategy)
+    print(f"Best {args.objective} score {score:.4f} after {len(search.history)} evaluations "
+          f"in {time.time() - t_start:.1f} s")
+
+    if args.log:
+        with open(args.log, 'w') as outfile:
+            json.dump(search.history, outfile, indent=2)
+            print(f"Saved {args.log}")
+
+    if score <= 0:
+        # A zero score is a disparity map without a single good pixel, not a configuration to deploy
+        parser.exit(1, "No candidate scored above 0, the parameters are not saved. Narrow the --space ranges.\n")
+    os.makedirs(args.output_dir, exist_ok=True)
+    prefix = args.prefix or os.path.basename(pairs[0][0]).split("_")[0]
+    output_fn = os.path.join(args.output_dir, f"parameters_{prefix}_stereo-{args.algo}.json")
+    with open(output_fn, 'w') as outfile:
+        json.dump({name: best[name] for name in algorithm_parameters(args.algo)}, outfile)
+        print(f"Saved {output_fn}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from batch import IMAGE_EXTENSIONS, find_pairs, load_parameters, write_disparity
+from disparity_map import read_grayscale
+from matcher_pool import MatcherSet
+from parameter_space import default_parameters, make_valid
+from pipeline import compute_disparity
+from rectification import RECTIFY_ALPHA, Rectifier
+from timing import Histogram, PERCENTILES, start_timer, stop_timer
+
+# Frames decoded ahead of the matcher and disparity maps waiting to be written. Both queues are bounded, so
+# memory does not grow with the length of the sequence: a slow stage blocks the ones feeding it.
+PREFETCH_FRAMES = int(os.environ.get("STEREO_STREAM_PREFETCH", 4))
+WRITE_QUEUE_FRAMES = int(os.environ.get("STEREO_STREAM_WRITE_QUEUE", 4))
+
+# Marks the end of a queue
+_END = object()
+
+
+def video_frames(left_path, right_path):
+    """
+    Reads two synchronized video files frame by frame, stopping at the end of the shorter one
+    :return: generator of (frame index, left grayscale frame, right grayscale frame)
+    """
+    captures = [cv2.VideoCapture(left_path), cv2.VideoCapture(right_path)]
+    try:
+        for capture, path in zip(captures, (left_path, right_path)):
+            if not capture.isOpened():
+                raise IOError(f"Could not open video {path}")
+        index = 0
+        while True:
+            frames = []
+            for capture in captures:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                # Same luminance weights as the grayscale decoding of the app and batch.py
+                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim > 2 else frame)
+            yield index, frames[0], frames[1]
+            index += 1
+    finally:
+        for capture in captures:
+            capture.release()
+
+
+def sequence_pairs(left_dir, right_dir=None, left_token="left", right_token="right"):
+    """
+    Pairs the frames of two image directories. Names are matched like batch.py does; when nothing matches and
+    the directories differ, frames with the same file name are paired (e.g. KITTI image_02 / image_03).
+    :return: sorted list of (left path, right path)
+    """
+    pairs = find_pairs(left_dir, right_dir, left_token, right_token)
+    if pairs or not right_dir or right_dir == left_dir:
+        return pairs
+    right_files = set(os.listdir(right_dir))
+    return [(os.path.join(left_dir, name), os.path.join(right_dir, name)) for name in sorted(os.listdir(left_dir))
+            if name.lower().endswith(IMAGE_EXTENSIONS) and name in right_files]
+
+
+def rectified_frames(frames, rectifier, stats):
+    """
+    Rectifies the frames as they are read, so the remapping runs in the reader thread of prefetch, ahead of the
+    matcher
+    :param rectifier: rectification.Rectifier, its remap tables are computed (or loaded) on the first frame
+    :return: generator of (frame index, rectified left frame, rectified right frame)
+    """
+    for index, left, right in frames:
+        t_start = time.perf_counter()
+        left, right = rectifier(left, right)
+        stats.add("rectify", time.perf_counter() - t_start)
+        yield index, left, right
+
+
+def directory_frames(pairs):
+    """
+    :param pairs: (left path, right path) of every frame, in order
+    :return: generator of (frame index, left grayscale frame, right grayscale frame)
+    """
+    for index, (left_path, right_path) in enumerate(pairs):
+        yield index, read_grayscale(left_path), read_grayscale(right_path)
+
+
+class StreamStats:
+    """
+    Per-stage latency histograms (milliseconds) and throughput of a stream. Stages are updated from the reader,
+    matcher and writer threads.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.frames = 0
+        self.t_start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram(0.01)
+            histogram.add(1000 * seconds)
+
+    def fps(self):
+        elapsed = time.perf_counter() - self.t_start
+        return self.frames / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        with self._lock:
+            stages = {name: histogram.summary() for name, histogram in self.stages.items()}
+        return dict(frames=self.frames, seconds=round(time.perf_counter() - self.t_start, 3),
+                    fps=round(self.fps(), 3), stages=stages)
+
+
+def _put(items, item, stop):
+    """
+    Blocking put that gives up when stop is set, so threads never hang on a queue nobody reads anymore
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def prefetch(frames, depth, stats, stop):
+    """
+    Decodes the frames in a background thread, at most depth frames ahead of the consumer
+    :param frames: generator of (index, left, right)
+    :return: generator of the same items
+    """
+    items = queue.Queue(maxsize=depth)
+
+    def read():
+        try:
+            while not stop.is_set():
+                t_start = time.perf_counter()
+                try:
+                    item = next(frames)
+                except StopIteration:
+                    break
+                stats.add("read", time.perf_counter() - t_start)
+                if not _put(items, item, stop):
+                    return
+        except Exception as e:
+            _put(items, e, stop)
+            return
+        _put(items, _END, stop)
+
+    reader = threading.Thread(target=read, name="stream-reader", daemon=True)
+    reader.start()
+    while True:
+        t_start = time.perf_counter()
+        try:
+            item = items.get(timeout=0.1)
+        except queue.Empty:
+            # The writer failed, its error is raised when it is closed
+            if stop.is_set():
+                return
+            continue
+        # Time the matcher waited for frames: high values mean decoding is the bottleneck
+        stats.add("wait", time.perf_counter() - t_start)
+        if item is _END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class FrameWriter:
+    """
+    Writes disparity maps from a background thread through a bounded queue. Nothing is written without an
+    output directory, the frames are only counted.
+    """
+
+    def __init__(self, output_dir, fmt, depth, stats, stop):
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.stats = stats
+        self.stop = stop
+        self.error = None
+        self.items = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._run, name="stream-writer", daemon=True)
+        self.thread.start()
+
+    def path(self, index):
+        return os.path.join(self.output_dir, f"{index:06d}_disparity.{'npy' if self.fmt == 'npy' else 'png'}")
+
+    def _run(self):
+        while True:
+            item = self.items.get()
+            if item is _END:
+                return
+            index, disparity_map = item
+            t_start = time.perf_counter()
+            try:
+                if self.output_dir:
+                    write_disparity(self.path(index), disparity_map, self.fmt)
+            except Exception as e:
+                self.error = e
+                self.stop.set()
+                return
+            self.stats.add("write", time.perf_counter() - t_start)
+
+    def put(self, index, disparity_map):
+        if self.error is not None:
+            raise self.error
+        _put(self.items, (index, disparity_map), self.stop)
+
+    def close(self):
+        _put(self.items, _END, self.stop)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def run_stream(frames, algo, params, output_dir=None, fmt="png16", max_frames=None, prefetch_frames=PREFETCH_FRAMES,
+               write_queue_frames=WRITE_QUEUE_FRAMES, report_every=30, rectifier=None):
+    """
+    Computes the disparity of every frame of a stereo sequence with one matcher (and WLS filter) configured
+    once and reused for the whole stream
+    :param frames: generator of (index, left, right), see video_frames and directory_frames
+    :param params: parameters as saved by the app
+    :param output_dir: where the disparity maps are written, None to only measure
+    :param max_frames: stop after this many frames
+    :param report_every: print the throughput every this many frames, 0 to disable
+    :param rectifier: optional rectification.Rectifier applied to the frames before matching
+    :return: StreamStats
+    """
+    stats = StreamStats()
+    if rectifier is not None:
+        frames = rectified_frames(frames, rectifier, stats)
+    stop = threading.Event()
+    matchers = MatcherSet()
+    writer = FrameWriter(output_dir, fmt, write_queue_frames, stats, stop)
+    try:
+        for index, left, right in prefetch(frames, prefetch_frames, stats, stop):
+            timer = start_timer()
+            t_start = time.perf_counter()
+            try:
+                disparity_map, _ = compute_disparity(left, right, algo, params, matchers=matchers)
+            finally:
+                stop_timer()
+            stats.add("frame", time.perf_counter() - t_start)
+            for name, seconds in timer.durations.items():
+                stats.add(name, seconds)
+
+            t_start = time.perf_counter()
+            writer.put(index, disparity_map)
+            # Time the matcher was blocked by a full write queue: high values mean writing is the bottleneck
+            stats.add("backpressure", time.perf_counter() - t_start)
+
+            stats.frames += 1
+            if report_every and stats.frames % report_every == 0:
+                print(f"{stats.frames} frames - {stats.fps():.2f} fps")
+            if max_frames and stats.frames >= max_frames:
+                break
+        writer.close()
+    finally:
+        stop.set()
+    return stats
+
+
+def print_stats(stats):
+    summary = stats.summary()
+    print(f"Processed {summary['frames']} frames in {summary['seconds']:.1f} s ({summary['fps']:.2f} fps)")
+    header = "".join(f"{'p' + str(q):>10}" for q in PERCENTILES)
+    print(f"{'stage (ms)':>14}{header}{'mean':>10}")
+    for name, values in summary["stages"].items():
+        percentiles = "".join(f"{values['p' + str(q)]:10.2f}" for q in PERCENTILES)
+        print(f"{name:>14}{percentiles}{values['mean']:10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Computes disparities of stereo video or image sequences')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--videos', nargs=2, metavar=('LEFT', 'RIGHT'), help='Left and right video files')
+    source.add_argument('--dirs', nargs=2, metavar=('LEFT_DIR', 'RIGHT_DIR'),
+                        help='Directories with the left and right frames (can be the same directory)')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='Directory where disparity maps are written (default: only measure)')
+    parser.add_argument('-a', '--algo', default='bm', choices=['bm', 'sgbm'])
+    parser.add_argument('-p', '--params', default=None, help='Parameter JSON (default: initial values of the app)')
+    parser.add_argument('--left-token', default='left')
+    parser.add_argument('--right-token', default='right')
+    parser.add_argument('-f', '--format', default='png16', choices=['png16', 'png8', 'npy'])
+    parser.add_argument('-n', '--max-frames', default=None, type=int)
+    parser.add_argument('-t', '--threads', default=None, type=int, help='OpenCV threads (default: all CPUs)')
+    parser.add_argument('--prefetch', default=PREFETCH_FRAMES, type=int, help='Frames decoded ahead')
+    parser.add_argument('--write-queue', default=WRITE_QUEUE_FRAMES, type=int,
+                        help='Disparity maps waiting to be written')
+    parser.add_argument('--report-every', default=30, type=int)
+    parser.add_argument('--calibration', default=None,
+                        help='Stereo calibration (JSON or OpenCV YAML/XML with K1 D1 K2 D2 R T) to rectify the '
+                             'frames with before matching')
+    parser.add_argument('--alpha', default=RECTIFY_ALPHA, type=float,
+                        help='Free scaling of the rectification, 0 (valid pixels only) to 1 (all pixels)')
+    parser.add_argument('--stats', default=None, help='Write the throughput and stage latencies to this JSON file')
+    args = parser.parse_args()
+
+    if args.threads:
+        cv2.setNumThreads(args.threads)
+    params = load_parameters(args.params) if args.params else make_valid(args.algo, default_parameters(args.algo))
+    rectifier = Rectifier.from_file(args.calibration, alpha=args.alpha) if args.calibration else None
+    if args.videos:
+        frames = video_frames(*args.videos)
+    else:
+        pairs = sequence_pairs(args.dirs[0], args.dirs[1], args.left_token, args.right_token)
+        if not pairs:
+            parser.error(f"No frame pairs found in {args.dirs[0]} and {args.dirs[1]}")
+        print(f"Found {len(pairs)} frame pairs")
+        frames = directory_frames(pairs)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    stats = run_stream(frames, args.algo, params, output_dir=args.output_dir, fmt=args.format,
+                       max_frames=args.max_frames, prefetch_frames=args.prefetch, write_queue_frames=args.write_queue,
+                       report_every=args.report_every, rectifier=rectifier)
+    print_stats(stats)
+    if args.stats:
+        with open(args.stats, 'w') as outfile:
+            json.dump(stats.summary(), outfile, indent=2)
+            print(f"Saved {args.stats}")
+
+
+if __name__ == "__main__":
+    main()
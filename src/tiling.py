@@ -0,0 +1,89 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from disparity_map import get_stereo_bm_object, to_grayscale
+
+# Number of threads of the tiled StereoBM engine, 0 disables it
+TILED_THREADS = int(os.environ.get("STEREO_TILED_THREADS", 0))
+# Images with fewer rows per thread than this are not worth splitting
+MIN_STRIP_ROWS = 64
+
+_executors = {}
+
+
+def _executor(threads):
+    # One pool per thread count and process: pools must not be inherited by forked workers
+    key = (os.getpid(), threads)
+    executor = _executors.get(key)
+    if executor is None:
+        executor = _executors[key] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="stereo-strip")
+    return executor
+
+
+def strip_halo(block_size=5, prefilter_size=5, use_xsobel=False, **_):
+    """
+    Number of rows above and below a strip that StereoBM reads to compute the strip: half the matching block
+    plus half the prefilter window (3x3 for XSobel), plus one row of margin.
+    """
+    prefilter_radius = 1 if use_xsobel else prefilter_size // 2
+    return block_size // 2 + prefilter_radius + 1
+
+
+def split_rows(height, strips):
+    """
+    :return: list of (start, end) row ranges covering the image
+    """
+    bounds = np.linspace(0, height, strips + 1).astype(int)
+    return [(int(y0), int(y1)) for y0, y1 in zip(bounds[:-1], bounds[1:]) if y1 > y0]
+
+
+def compute_tiled_bm_disparity_map(left_img, right_img, threads=None, strips=None, **params):
+    """
+    StereoBM computed over horizontal strips in a thread pool (OpenCV releases the GIL while matching).
+    Every strip is matched with enough overlap for the block and prefilter windows, so the stitched map is
+    identical to ``generate_stereo_bm_disparity_map``. Speckle filtering connects pixels across the whole
+    image, so it is disabled per strip and applied once on the stitched map.
+    :param left_img: left image
+    :param right_img: right image
+    :param threads: number of worker threads, defaults to STEREO_TILED_THREADS or the number of CPUs
+    :param strips: number of strips, defaults to the number of threads
+    :param params: keyword arguments of get_stereo_bm_object
+    :return: disparity map
+    """
+    left_img = to_grayscale(left_img)
+    right_img = to_grayscale(right_img)
+    threads = threads or TILED_THREADS or os.cpu_count() or 1
+    height = left_img.shape[0]
+    strips = max(1, min(strips or threads, height // MIN_STRIP_ROWS))
+
+    strip_params = dict(params, speckle_windows_size=0)
+    halo = strip_halo(**params)
+
+    def compute_strip(rows):
+        y0, y1 = rows
+        top, bottom = max(0, y0 - halo), min(height, y1 + halo)
+        # The XSobel prefilter processes the rows in pairs from the top and treats the last row of an odd height
+        # image apart: an even top keeps the pairs and the row parity of the bottom strip those of the full image
+        top -= top % 2
+        # StereoBM objects hold per-call buffers, each strip gets its own
+        stereo = get_stereo_bm_object(**strip_params)
+        disparity = stereo.compute(left_img[top:bottom], right_img[top:bottom])
+        return disparity[y0 - top:y1 - top]
+
+    rows = split_rows(height, strips)
+    if len(rows) == 1:
+        parts = [compute_strip(rows[0])]
+    else:
+        parts = list(_executor(threads).map(compute_strip, rows))
+    disparity_map = np.vstack(parts)
+
+    speckle_windows_size = params.get("speckle_windows_size", 0)
+    speckle_range = params.get("speckle_range", 0)
+    if speckle_windows_size > 0 and speckle_range >= 0:
+        # Same call as StereoBM::compute: the range is compared against the fixed-point (x16) disparities
+        new_value = (params.get("min_disp", 0) - 1) * cv2.StereoMatcher_DISP_SCALE
+        cv2.filterSpeckles(disparity_map, new_value, speckle_windows_size, speckle_range)
+    return disparity_map
@@ -0,0 +1,249 @@
+import contextlib
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+
+from cache import get_redis_client, redis
+
+# Resolution buckets of the metrics: name and largest size in megapixels, named after the benchmark resolutions
+RESOLUTION_BUCKETS = (("vga", 0.35), ("hd", 1.0), ("fhd", 2.2), ("mp5", 5.2), ("mp12", 12.5))
+PERCENTILES = (50, 95, 99)
+
+logger = logging.getLogger(__name__)
+
+# Timer of the request being handled by the current thread, None outside of instrumented requests
+_current_timer = contextvars.ContextVar("stage_timer", default=None)
+
+
+def resolution_bucket(shape):
+    """
+    :param shape: image shape, or (width, height)
+    :return: name of the resolution bucket of the image
+    """
+    megapixels = shape[0] * shape[1] / 1e6
+    for name, limit in RESOLUTION_BUCKETS:
+        if megapixels <= limit:
+            return name
+    return "larger"
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in each stage of one request. Stages entered several times (e.g. encoding the
+    disparity map and the left image) add up.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.labels = dict(algo="none", resolution="none")
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def server_timing(self, response_bytes=None):
+        """
+        :return: value of the Server-Timing header, durations in milliseconds
+        """
+        entries = [f"{name};dur={1000 * seconds:.2f}" for name, seconds in self.durations.items()]
+        if response_bytes is not None:
+            entries.append(f'size;desc="{response_bytes} B"')
+        return ", ".join(entries)
+
+
+def start_timer():
+    timer = StageTimer()
+    _current_timer.set(timer)
+    return timer
+
+
+def stop_timer():
+    """
+    :return: the timer of the current request, which is detached from the thread
+    """
+    timer = _current_timer.get()
+    _current_timer.set(None)
+    return timer
+
+
+def label_request(**labels):
+    """
+    Sets the labels (algo, resolution) the timings of the current request are aggregated under
+    """
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.labels.update(labels)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times the block as the given stage of the current request. Outside of instrumented requests (batch, search,
+    benchmarks) it does nothing.
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - t_start)
+
+
+class Histogram:
+    """
+    Counts of observations in logarithmic buckets: bucket i holds values up to start * factor ** i, so
+    percentiles are estimated with a relative error below factor - 1. Counts of different processes can be
+    summed bucket by bucket.
+    """
+
+    def __init__(self, start, factor=1.2, size=100):
+        self.start = start
+        self.factor = factor
+        self.size = size
+        self.counts = [0] * size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def bucket(self, value):
+        if value <= self.start:
+            return 0
+        return min(self.size - 1, int(math.ceil(math.log(value / self.start, self.factor))))
+
+    def upper_bound(self, bucket):
+        return self.start * self.factor ** bucket
+
+    def add(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        bound = self.upper_bound(bucket)
+        # The maximum is only known in-process, merged histograms report the bucket bound
+        return min(bound, self.max) if self.max else bound
+
+    def summary(self):
+        summary = dict(count=self.count, mean=round(self.total / self.count, 3) if self.count else None)
+        if self.max:
+            summary["max"] = round(self.max, 3)
+        for q in PERCENTILES:
+            percentile = self.percentile(q)
+            summary[f"p{q}"] = None if percentile is None else round(percentile, 3)
+        return summary
+
+
+# Unit of each kind of series and the smallest bucket of its histograms
+UNITS = dict(time=("ms", 0.01), size=("bytes", 64))
+
+
+class StageMetrics:
+    """
+    Histograms of the stage timings and response sizes of the Dash callbacks, per stage, algorithm and
+    resolution bucket.
+
+    Every process keeps its own histograms. When Redis is configured the bucket counts are also added up there,
+    so the metrics route reports all gunicorn workers whichever worker answers it.
+    """
+
+    def __init__(self, prefix="stereo-metrics:v1:", ttl=7 * 24 * 3600):
+        self.prefix = prefix
+        self.ttl = ttl
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, kind):
+        return Histogram(UNITS[kind][1])
+
+    def record(self, timer, response_bytes=None):
+        observations = [(("time", name, timer.labels["algo"], timer.labels["resolution"]), 1000 * seconds)
+                        for name, seconds in timer.durations.items()]
+        if response_bytes is not None:
+            observations.append((("size", "response", timer.labels["algo"], timer.labels["resolution"]),
+                                 response_bytes))
+
+        with self._lock:
+            for series, value in observations:
+                histogram = self._series.get(series)
+                if histogram is None:
+                    histogram = self._series[series] = self._histogram(series[0])
+                histogram.add(value)
+
+        client = get_redis_client()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for series, value in observations:
+                    key = self.prefix + "|".join(series)
+                    pipe.hincrby(key, self._series[series].bucket(value), 1)
+                    pipe.hincrbyfloat(key, "total", value)
+                    pipe.expire(key, self.ttl)
+                    pipe.sadd(self.prefix + "series", "|".join(series))
+                pipe.expire(self.prefix + "series", self.ttl)
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning("Redis metrics unavailable: %s", e)
+
+    def _shared_series(self):
+        """
+        :return: histograms merged over all processes from Redis, or None when Redis is not available
+        """
+        client = get_redis_client()
+        if client is None:
+            return None
+        try:
+            names = sorted(name.decode() for name in client.smembers(self.prefix + "series"))
+            pipe = client.pipeline(transaction=False)
+            for name in names:
+                pipe.hgetall(self.prefix + name)
+            values = pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Redis metrics unavailable: %s", e)
+            return None
+
+        merged = {}
+        for name, fields in zip(names, values):
+            series = tuple(name.split("|"))
+            histogram = merged[series] = self._histogram(series[0])
+            for field, value in fields.items():
+                field = field.decode()
+                if field == "total":
+                    histogram.total = float(value)
+                else:
+                    histogram.counts[int(field)] += int(value)
+                    histogram.count += int(value)
+        return merged
+
+    def snapshot(self, shared=True):
+        """
+        :param shared: report the counts of all processes when Redis is configured
+        :return: JSON serializable summary of every series
+        """
+        merged = self._shared_series() if shared else None
+        scope = "shared"
+        if merged is None:
+            scope = "process"
+            with self._lock:
+                merged = dict(self._series)
+        series = []
+        for (kind, name, algo, resolution), histogram in sorted(merged.items()):
+            series.append(dict(kind=kind, stage=name, algo=algo, resolution=resolution, unit=UNITS[kind][0],
+                               **histogram.summary()))
+        return dict(pid=os.getpid(), scope=scope, series=series)
+
+
+stage_metrics = StageMetrics()
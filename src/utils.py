@@ -1,9 +1,9 @@
+import functools
 import os
 import pathlib
 import json
 
 import dash_core_components as dcc
-import plotly.graph_objs as go
 import dash_reusable_components as drc
 
 from PIL import Image, ImageFilter, ImageDraw, ImageEnhance
@@ -16,10 +16,23 @@ STORAGE_PLACEHOLDER = json.dumps(
     {"filename": None, "image_signature": None, "action_stack": []}
 )
 
-IMAGE_STRING_PLACEHOLDER = drc.pil_to_b64(
-    Image.open(os.path.join(APP_PATH, os.path.join("images", "default.jpg"))).copy(),
-    enc_format="jpeg",
-)
+
+@functools.lru_cache(maxsize=None)
+def default_image_string():
+    """
+    Base64 JPEG of the default image, encoded on first use instead of at import time
+    """
+    return drc.pil_to_b64(
+        Image.open(os.path.join(APP_PATH, os.path.join("images", "default.jpg"))).copy(),
+        enc_format="jpeg",
+    )
+
+
+def __getattr__(name):
+    # IMAGE_STRING_PLACEHOLDER stays available as a module attribute, computed lazily
+    if name == "IMAGE_STRING_PLACEHOLDER":
+        return default_image_string()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 GRAPH_PLACEHOLDER = dcc.Graph(
@@ -127,6 +140,9 @@ def apply_enhancements(image, zone, enhancement, enhancement_factor, mode):
 
 
 def show_histogram(image):
+    # plotly figure classes are only imported when a histogram is drawn
+    import plotly.graph_objs as go
+
     def hg_trace(name, color, hg):
         line = go.Scatter(
             x=list(range(0, 256)),
@@ -197,3 +213,52 @@ def show_histogram(image):
     )
 
     return go.Figure(data=data, layout=layout)
+
+
+def show_disparity_histogram(stats):
+    """
+    Histogram of a disparity map from disparity_stats.disparity_statistics. The bins are sent as their counts with
+    the first bin and the bin width (x0/dx), and the percentiles as vertical lines.
+    """
+    percentiles = stats["percentiles"] or []
+    title = f"Valid pixels: {100 * stats['valid_ratio']:.1f}%"
+    if percentiles:
+        title += "  |  " + "  ".join(f"p{q}: {value:.2f}" for q, value in percentiles)
+
+    return {
+        "data": [
+            {
+                "type": "bar",
+                "x0": stats["start"] + stats["step"] / 2,
+                "dx": stats["step"],
+                "y": stats["counts"],
+                "name": "Disparity",
+                "marker": {"color": "#2ECC40", "line": {"width": 0}},
+                "hoverinfo": "x+y",
+            }
+        ],
+        "layout": {
+            "autosize": True,
+            "title": {"text": title, "font": {"size": 12}},
+            "bargap": 0,
+            "margin": dict(l=50, r=30, t=40, b=30),
+            "paper_bgcolor": "#31343a",
+            "plot_bgcolor": "#272a31",
+            "font": dict(color="darkgray"),
+            "xaxis": dict(gridcolor="#43454a", title="Disparity (pixels)"),
+            "yaxis": dict(gridcolor="#43454a"),
+            "shapes": [
+                {
+                    "type": "line",
+                    "xref": "x",
+                    "yref": "paper",
+                    "x0": value,
+                    "x1": value,
+                    "y0": 0,
+                    "y1": 1,
+                    "line": {"color": "#FF4136" if q == 50 else "gray", "width": 1, "dash": "dot"},
+                }
+                for q, value in percentiles
+            ],
+        },
+    }